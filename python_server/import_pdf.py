@@ -9,7 +9,6 @@ import os
 import sys
 from pathlib import Path
 import argparse
-from pdf2image import convert_from_path
 import logging
 
 # ポータブルPoppler設定
@@ -60,6 +59,9 @@ def convert_pdf_to_images(pdf_path: str, output_dir: str, dpi: int = 200) -> lis
     
     logger.info(f"PDF変換開始: {pdf_file.name}")
     
+    # pdf2image(Pillow)は変換するときだけ読み込む（--help などの起動を速くする）
+    from pdf2image import convert_from_path
+    
     try:
         # PDFを画像に変換（ポータブルPoppler対応）
         if poppler_path:
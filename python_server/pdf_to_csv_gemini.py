@@ -12,8 +12,6 @@ from pathlib import Path
 import argparse
 import logging
 from typing import List, Dict
-import google.generativeai as genai
-from PIL import Image
 import time
 
 # ログ設定
@@ -23,6 +21,9 @@ logger = logging.getLogger(__name__)
 class PDFToCSVConverter:
     def __init__(self, api_key: str):
         """Gemini APIクライアントを初期化"""
+        # google.generativeai は import に時間がかかるので、変換を始めるときに読み込む
+        import google.generativeai as genai
+        
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel('gemini-1.5-pro')
         self.retry_model = genai.GenerativeModel('gemini-1.5-flash')  # リトライ用高速モデル
@@ -41,6 +42,8 @@ class PDFToCSVConverter:
         """
         try:
             # 画像を読み込み
+            from PIL import Image
+            
             image = Image.open(image_path)
             
             # ナレッジベース用に最適化されたプロンプト
@@ -3,16 +3,8 @@
 FAISS データベース再構築スクリプト
 """
 import os
-import pandas as pd
-from langchain.schema.document import Document
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from src import lazy_imports as lazy
 from src.config import settings
-import google.generativeai as genai
-
-# Google AI API設定
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-os.environ["GOOGLE_API_KEY"] = settings.GOOGLE_API_KEY
 
 def rebuild_qa_database():
     """QAデータベースを再構築"""
@@ -31,17 +23,17 @@ def rebuild_qa_database():
     for i, qa in enumerate(sample_qa_data):
         content = f"Q: {qa['question']}\nA: {qa['answer']}"
         
-        doc = Document(
+        doc = lazy.Document(
             page_content=content,
             metadata={"source": f"qa_{i}", "row": i, "question": qa['question']}
         )
         documents.append(doc)
     
     # 埋め込みモデル作成
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+    embeddings = lazy.GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=settings.GOOGLE_API_KEY)
     
     # FAISSデータベース作成
-    vectorstore = FAISS.from_documents(documents, embeddings)
+    vectorstore = lazy.FAISS.from_documents(documents, embeddings)
     
     # 保存
     vectorstore.save_local("faiss_qa")
@@ -55,7 +47,7 @@ def rebuild_knowledge_database():
     
     # CSVファイルを読み込み（新しい2025ナレッジデータ）
     knowledge_csv_path = "faiss_knowledge/2025_all_knowledge.csv"
-    df = pd.read_csv(knowledge_csv_path, encoding='utf-8-sig')
+    df = lazy.pd.read_csv(knowledge_csv_path, encoding='utf-8-sig')
     
     documents = []
     for i, row in df.iterrows():
@@ -70,17 +62,17 @@ def rebuild_knowledge_database():
             "title": title
         }
         
-        doc = Document(
+        doc = lazy.Document(
             page_content=page_content,
             metadata=metadata
         )
         documents.append(doc)
     
     # 埋め込みモデル作成
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+    embeddings = lazy.GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=settings.GOOGLE_API_KEY)
     
     # FAISSデータベース作成
-    vectorstore = FAISS.from_documents(documents, embeddings)
+    vectorstore = lazy.FAISS.from_documents(documents, embeddings)
     
     # 保存
     vectorstore.save_local("faiss_knowledge")
@@ -94,13 +86,13 @@ def test_databases():
     
     try:
         # QAデータベーステスト
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-        qa_db = FAISS.load_local("faiss_qa", embeddings, allow_dangerous_deserialization=True)
+        embeddings = lazy.GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=settings.GOOGLE_API_KEY)
+        qa_db = lazy.FAISS.load_local("faiss_qa", embeddings, allow_dangerous_deserialization=True)
         qa_results = qa_db.similarity_search("Nitto技術", k=2)
         print(f"QAテスト成功: {len(qa_results)}件の結果")
         
         # 知識データベーステスト
-        knowledge_db = FAISS.load_local("faiss_knowledge", embeddings, allow_dangerous_deserialization=True)
+        knowledge_db = lazy.FAISS.load_local("faiss_knowledge", embeddings, allow_dangerous_deserialization=True)
         knowledge_results = knowledge_db.similarity_search("AI技術", k=2)
         print(f"知識DBテスト成功: {len(knowledge_results)}件の結果")
         
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from src.config import settings
+from src.metrics import record_audio_cache
+
+LOGGER = logging.getLogger(__name__)
+
+# 保存できる音声の拡張子と Content-Type
+MEDIA_TYPES = {
+    ".wav": "audio/wav",
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".opus": "audio/ogg",
+}
+
+# writev に一度に渡す断片の数の上限(Linux の IOV_MAX)
+_IOV_MAX = 1024
+
+
+def audio_cache_key(text: str, **params: Any) -> str:
+    """テキストと合成パラメータ(バックエンド・ボイス・モデル・話速・ピッチ・出力形式など)から決めるキー
+
+    大文字・小文字や全角・半角で読みが変わりうるので、テキストは正規化しない(合成するテキストそのままで引く)
+    """
+    source = json.dumps({"text": text, "params": params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def _write_parts(f, parts: list[bytes]) -> None:
+    """断片を連結せずに書き込む(writev が使えれば、バッファを経由せずに最大 _IOV_MAX 個ずつ1回のシステムコールで書く)"""
+    if not hasattr(os, "writev"):
+        f.writelines(parts)
+        return
+    f.flush()
+    views = [memoryview(part) for part in parts if part]
+    i = 0
+    while i < len(views):
+        written = os.writev(f.fileno(), views[i : i + _IOV_MAX])
+        # 書ききれなかった断片は残りから続ける
+        while i < len(views) and written >= len(views[i]):
+            written -= len(views[i])
+            i += 1
+        if written:
+            views[i] = views[i][written:]
+
+
+@dataclass
+class CachedAudio:
+    """キャッシュ済みの音声ファイル"""
+
+    path: pathlib.Path
+    size: int
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.path.suffix]
+
+
+class AudioCache:
+    """合成した音声をキーのハッシュで保存するディスクキャッシュ
+
+    ファイルは <cache_dir>/<key 先頭2文字>/<key><拡張子> に置き、どのキーがどこにあるかはメモリ上の索引で引く。
+    合計サイズが max_bytes を超えたら最後に使われたのが古いものから削除する(使った時刻は mtime に残すので再起動後も引き継ぐ)。
+    索引は初めて使うときにディレクトリを走査して作る。
+    """
+
+    def __init__(self, cache_dir: pathlib.Path, *, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index: OrderedDict[str, CachedAudio] | None = None
+        # 同じキーで別の形式に置き換えたが、読み込み中で削除できなかったファイル(容量には数えたまま、次の put で削除を試みる)
+        self._stale: list[CachedAudio] = []
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load_index())
+
+    def read(self, key: str) -> tuple[bytes, str] | None:
+        """キャッシュ済みの音声の (バイト列, Content-Type)(なければ None)
+
+        ディスクを読むので asyncio.to_thread で呼ぶ。ファイルは索引のロック中に開くので、読んでいる間に put で追い出されても最後まで読める
+        """
+        with self._lock:
+            index = self._load_index()
+            cached = index.get(key)
+            if cached is None:
+                return None
+            try:
+                f = open(cached.path, "rb")  # noqa: SIM115
+            except FileNotFoundError:
+                # 外から消されていた
+                del index[key]
+                self._total_bytes -= cached.size
+                record_audio_cache(self._total_bytes)
+                return None
+            index.move_to_end(key)
+        with f:
+            os.utime(f.fileno())
+            return f.read(), cached.media_type
+
+    def put(self, key: str, audio: bytes | list[bytes], *, suffix: str = ".wav") -> CachedAudio:
+        """音声を保存する(書き込み途中のファイルを読まれないよう、一時ファイルに書いてからリネームする)
+
+        audio は連結前の断片(WAV ヘッダーと PCM のチャンクなど)のリストでもよい(連結せずに順に書き込む)
+        """
+        parts = [audio] if isinstance(audio, bytes) else audio
+        if suffix not in MEDIA_TYPES:
+            raise ValueError(f"unsupported audio suffix: {suffix}")
+        path = self.cache_dir / key[:2] / f"{key}{suffix}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=path.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                _write_parts(f, parts)
+            os.replace(tmp_path, path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+        cached = CachedAudio(path=path, size=sum(len(part) for part in parts))
+        with self._lock:
+            index = self._load_index()
+            previous = index.pop(key, None)
+            if previous is not None:
+                if previous.path == path or _unlink(previous.path):
+                    self._total_bytes -= previous.size
+                else:
+                    self._stale.append(previous)
+            index[key] = cached
+            self._total_bytes += cached.size
+            evicted = self._evict(keep=key)
+            record_audio_cache(self._total_bytes, evicted)
+        return cached
+
+    def _evict(self, *, keep: str) -> int:
+        """合計サイズが max_bytes に収まるまで古いものから削除し、削除した件数を返す
+
+        ファイルを削除できてから索引から外す。Windows では read が開いているファイルは削除できないので、索引に残して次の put で再び試みる
+        """
+        for cached in list(self._stale):
+            if _unlink(cached.path):
+                self._stale.remove(cached)
+                self._total_bytes -= cached.size
+        index = self._index
+        evicted = 0
+        for key, cached in list(index.items()):
+            if self._total_bytes <= self.max_bytes or len(index) <= 1:
+                break
+            if key == keep or not _unlink(cached.path):
+                continue
+            del index[key]
+            self._total_bytes -= cached.size
+            evicted += 1
+        return evicted
+
+    def _load_index(self) -> OrderedDict[str, CachedAudio]:
+        if self._index is not None:
+            return self._index
+
+        entries: list[tuple[float, str, CachedAudio]] = []
+        if self.cache_dir.exists():
+            for path in self.cache_dir.glob("*/*"):
+                if path.name.startswith(".tmp_"):
+                    # 書き込み途中で止まったファイル
+                    path.unlink(missing_ok=True)
+                    continue
+                if path.suffix not in MEDIA_TYPES:
+                    continue
+                stat = path.stat()
+                entries.append((stat.st_mtime, path.stem, CachedAudio(path=path, size=stat.st_size)))
+        entries.sort(key=lambda entry: entry[0])
+
+        self._index = OrderedDict((key, cached) for _, key, cached in entries)
+        self._total_bytes = sum(cached.size for cached in self._index.values())
+        evicted = self._evict(keep="")
+        record_audio_cache(self._total_bytes, evicted)
+        LOGGER.info(f"音声キャッシュを読み込みました ({len(self._index)} 件, {self._total_bytes / 1024 / 1024:.1f}MiB)")
+        return self._index
+
+
+audio_cache = AudioCache(settings.TTS_CACHE_DIR, max_bytes=settings.TTS_CACHE_MAX_BYTES)
+
+
+def _unlink(path: pathlib.Path) -> bool:
+    """ファイルを削除する(読み込み中で削除できなければ False)"""
+    try:
+        path.unlink(missing_ok=True)
+    except PermissionError:
+        return False
+    return True
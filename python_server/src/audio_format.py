@@ -0,0 +1,159 @@
+import asyncio
+import shutil
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from src.audio_cache import MEDIA_TYPES
+from src.config import PCM_SAMPLE_RATES, settings
+
+_CODEC_SUFFIXES = {
+    "wav": ".wav",
+    "mp3": ".mp3",
+    "opus": ".ogg",
+}
+
+
+class AudioFormatUnavailableError(RuntimeError):
+    """プロバイダが直接出力できず、ローカルでも変換できない出力形式"""
+
+
+@dataclass(frozen=True)
+class AudioFormat:
+    """/voice* の音声出力形式(16bit mono)"""
+
+    name: str
+    codec: str
+    sample_rate: int
+    bitrate_kbps: int | None = None
+
+    @property
+    def is_pcm(self) -> bool:
+        return self.codec == "wav"
+
+    @property
+    def suffix(self) -> str:
+        return _CODEC_SUFFIXES[self.codec]
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.suffix]
+
+
+def _pcm(sample_rate: int) -> AudioFormat:
+    return AudioFormat(f"wav_{sample_rate}", "wav", sample_rate)
+
+
+# format クエリで指定できる出力形式(圧縮形式は、少なくとも一方のプロバイダが直接出力できるものに絞る)
+AUDIO_FORMATS = {
+    audio_format.name: audio_format
+    for audio_format in (
+        *(_pcm(sample_rate) for sample_rate in PCM_SAMPLE_RATES),
+        AudioFormat("mp3_22050_32", "mp3", 22050, 32),
+        AudioFormat("mp3_24000_48", "mp3", 24000, 48),
+        AudioFormat("mp3_44100_128", "mp3", 44100, 128),
+        AudioFormat("opus_16000", "opus", 16000, 32),
+        AudioFormat("opus_24000", "opus", 24000, 48),
+    )
+}
+
+# Accept ヘッダーの Content-Type -> その Content-Type で返す出力形式(None は既定の出力形式)
+_ACCEPT_FORMATS = {
+    "audio/wav": None,
+    "audio/wave": None,
+    "audio/x-wav": None,
+    "audio/*": None,
+    "*/*": None,
+    "audio/mpeg": "mp3_22050_32",
+    "audio/ogg": "opus_24000",
+    "audio/opus": "opus_24000",
+}
+
+# プロバイダが直接出力できる形式(出力形式 -> プロバイダの指定値)
+ELEVENLABS_OUTPUT_FORMATS = {
+    **{f"wav_{sample_rate}": f"pcm_{sample_rate}" for sample_rate in PCM_SAMPLE_RATES},
+    "mp3_22050_32": "mp3_22050_32",
+    "mp3_44100_128": "mp3_44100_128",
+}
+AZURE_OUTPUT_FORMATS = {
+    "wav_16000": "Raw16Khz16BitMonoPcm",
+    "wav_22050": "Raw22050Hz16BitMonoPcm",
+    "wav_24000": "Raw24Khz16BitMonoPcm",
+    "wav_44100": "Raw44100Hz16BitMonoPcm",
+    "mp3_24000_48": "Audio24Khz48KBitRateMonoMp3",
+    "opus_16000": "Ogg16Khz16BitMonoOpus",
+    "opus_24000": "Ogg24Khz16BitMonoOpus",
+}
+
+
+def default_audio_format() -> AudioFormat:
+    """指定がない場合の出力形式(TTS_SAMPLE_RATE の WAV)"""
+    return AUDIO_FORMATS[f"wav_{settings.TTS_SAMPLE_RATE}"]
+
+
+def negotiate_audio_format(name: str | None, accept: str | None = None, *, servable: Callable[[AudioFormat], bool] = lambda audio_format: True) -> AudioFormat:
+    """format クエリ(優先)か Accept ヘッダーから出力形式を決める(未知の format は ValueError)
+
+    Accept は q 値の高い順に、servable で返せる形式を選ぶ(返せる形式がなければ最も q 値の高い形式を返すので、呼び出し元で 406 にする)。
+    知らない Content-Type は無視し、Accept がなければ既定の出力形式にする
+    """
+    if name:
+        try:
+            return AUDIO_FORMATS[name]
+        except KeyError:
+            raise ValueError(f"unsupported audio format: {name} (supported: {', '.join(AUDIO_FORMATS)})") from None
+    acceptable = [audio_format for _, audio_format in sorted(_parse_accept(accept or ""), key=lambda entry: -entry[0])]
+    if not acceptable:
+        return default_audio_format()
+    return next((audio_format for audio_format in acceptable if servable(audio_format)), acceptable[0])
+
+
+def _parse_accept(accept: str) -> list[tuple[float, AudioFormat]]:
+    """Accept ヘッダーの (q 値, 出力形式) のリスト(書かれた順。q=0 と知らない Content-Type は除く)"""
+    entries = []
+    for media_range in accept.split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        media_type = media_type.lower()
+        if media_type not in _ACCEPT_FORMATS:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            format_name = _ACCEPT_FORMATS[media_type]
+            entries.append((q, AUDIO_FORMATS[format_name] if format_name else default_audio_format()))
+    return entries
+
+
+def transcoder_available() -> bool:
+    return shutil.which(settings.TTS_FFMPEG_PATH) is not None
+
+
+async def transcode(pcm: bytes, audio_format: AudioFormat) -> bytes:
+    """audio_format と同じサンプルレートの 16bit mono PCM を ffmpeg で audio_format に変換する
+
+    プロバイダが audio_format を直接出力できない場合のフォールバック(ffmpeg がなければ AudioFormatUnavailableError)
+    """
+    if not transcoder_available():
+        raise AudioFormatUnavailableError(f"{audio_format.name} needs ffmpeg for this voice, but it is not installed")
+    codec_args = {
+        "mp3": ["-c:a", "libmp3lame", "-f", "mp3"],
+        "opus": ["-c:a", "libopus", "-f", "ogg"],
+    }[audio_format.codec]
+    process = await asyncio.create_subprocess_exec(
+        settings.TTS_FFMPEG_PATH,
+        *("-hide_banner", "-loglevel", "error"),
+        *("-f", "s16le", "-ar", str(audio_format.sample_rate), "-ac", "1", "-i", "pipe:0"),
+        *("-b:a", f"{audio_format.bitrate_kbps}k", *codec_args, "pipe:1"),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    encoded, error = await process.communicate(pcm)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({audio_format.name}): {error.decode(errors='replace')[-500:]}")
+    return encoded
@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+from src.audio_format import AudioFormat
+from src.metrics import record_audio_handles
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AudioHandleError(RuntimeError):
+    """先行合成が失敗した(原因は __cause__)"""
+
+
+class AudioHandle:
+    """/reply で先行して合成を始めた音声
+
+    合成中に届いたチャンクも溜めておき、取得したときに最初から返す(同じハンドルを何度・何人が取得してもよい)。
+    """
+
+    def __init__(self, handle_id: str, voice: str, text: str, audio_format: AudioFormat) -> None:
+        self.id = handle_id
+        self.voice = voice
+        self.text = text
+        self.audio_format = audio_format
+        self.chunks: list[bytes] = []
+        self.size = 0
+        # chunks が長さ未定の WAV ヘッダー + PCM(合成しながら溜めた)なら True、音声ファイル全体なら False
+        self.streamed_wav = False
+        self.error: BaseException | None = None
+        self.finished_at: float | None = None
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def append(self, chunk: bytes) -> None:
+        if chunk:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self._notify()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _notify(self) -> None:
+        # 待っている読み手をすべて起こし、次の変化は新しい Event で待たせる
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """溜まったチャンクを最初から返し、合成中なら続きが届くのを待つ(失敗していれば AudioHandleError)"""
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise AudioHandleError(f"pre-synthesis of audio {self.id} failed") from self.error
+                return
+            await changed.wait()
+
+    async def wait(self) -> list[bytes]:
+        """合成が終わるまで待ってチャンクをすべて返す(失敗していれば AudioHandleError)"""
+        while not self.done:
+            await self._changed.wait()
+        if self.error is not None:
+            raise AudioHandleError(f"pre-synthesis of audio {self.id} failed") from self.error
+        return self.chunks
+
+
+class AudioHandleStore:
+    """先行合成した音声のハンドルの置き場
+
+    合成が終わったハンドルは ttl_sec 秒で期限切れにする。件数が max_entries、合成済みの合計サイズが max_bytes を超えたら、
+    合成済みのものを古い順に(それでも件数を超える場合は合成中のものも)追い出す。追い出しは start / get のついでに行う。
+    合成中に追い出したハンドルの合成はキャンセルする(同じテキストの /voice* と共有している合成は single-flight 側で続く)。
+    """
+
+    def __init__(self, *, max_entries: int, max_bytes: int, ttl_sec: float) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self._handles: OrderedDict[str, AudioHandle] = OrderedDict()
+        # ハンドルID -> 合成中のタスク
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def start(self, voice: str, text: str, audio_format: AudioFormat, produce: Callable[[AudioHandle], Awaitable[None]]) -> AudioHandle:
+        """ハンドルを登録し、produce(handle) をバックグラウンドで実行する(produce は handle.append でチャンクを溜める)"""
+        handle = AudioHandle(secrets.token_urlsafe(16), voice, text, audio_format)
+        self._handles[handle.id] = handle
+        self._evict()
+        # 呼び出し元のリクエストのトレースに Span を足し続けないよう、空のコンテキストで実行する
+        task = asyncio.create_task(self._run(handle, produce), context=contextvars.Context())
+        self._tasks[handle.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(handle.id, None))
+        return handle
+
+    def get(self, handle_id: str) -> AudioHandle | None:
+        """ハンドル(期限切れ・追い出し済みなら None)"""
+        self._evict()
+        return self._handles.get(handle_id)
+
+    async def close(self) -> None:
+        """合成中のタスクをキャンセルする"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, handle: AudioHandle, produce: Callable[[AudioHandle], Awaitable[None]]) -> None:
+        try:
+            await produce(handle)
+        except asyncio.CancelledError as e:
+            handle.finish(e)
+            raise
+        except Exception as e:
+            LOGGER.warning(f"音声の先行合成に失敗: audio_id={handle.id} voice={handle.voice}: {type(e).__name__}: {e}")
+            handle.finish(e)
+        else:
+            handle.finish()
+        finally:
+            self._evict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        expired = [h.id for h in self._handles.values() if h.done and now - h.finished_at > self.ttl_sec]
+        for handle_id in expired:
+            del self._handles[handle_id]
+
+        evicted = 0
+        done_bytes = sum(h.size for h in self._handles.values() if h.done)
+        for handle in [h for h in self._handles.values() if h.done]:
+            if len(self._handles) <= self.max_entries and done_bytes <= self.max_bytes:
+                break
+            del self._handles[handle.id]
+            done_bytes -= handle.size
+            evicted += 1
+        while len(self._handles) > self.max_entries:
+            handle_id, _ = self._handles.popitem(last=False)
+            if (task := self._tasks.get(handle_id)) is not None:
+                task.cancel()
+            evicted += 1
+
+        pending = sum(1 for h in self._handles.values() if not h.done)
+        record_audio_handles(pending=pending, done=len(self._handles) - pending, expired=len(expired), evicted=evicted)
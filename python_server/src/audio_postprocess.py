@@ -0,0 +1,140 @@
+import math
+from dataclasses import dataclass
+
+from src import lazy_imports as lazy
+from src.config import settings
+
+# 無音判定の単位(ミリ秒)
+FRAME_MS = 10
+
+# TTS_POSTPROCESS に書ける後処理
+POSTPROCESS_STEPS = ("trim", "peak", "loudness")
+
+
+class SilentAudioError(RuntimeError):
+    """合成した音声に声が入っていない(すべてのフレームが無音のしきい値未満)"""
+
+
+@dataclass(frozen=True)
+class PostProcess:
+    """16bit mono PCM の後処理(前後の無音の除去・音量の正規化)の設定"""
+
+    trim: bool = False
+    # None / "peak"(最大振幅を peak_dbfs に揃える) / "loudness"(声の部分の RMS を loudness_dbfs に揃える)
+    normalize: str | None = None
+    silence_threshold_dbfs: float = -50.0
+    padding_ms: int = 100
+    peak_dbfs: float = -1.0
+    loudness_dbfs: float = -20.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.trim or self.normalize is not None
+
+
+def postprocess_for(voice: str) -> PostProcess:
+    """エンドポイントごとの後処理の設定(TTS_POSTPROCESS)"""
+    steps = settings.TTS_POSTPROCESS.get(voice, [])
+    unknown = set(steps) - set(POSTPROCESS_STEPS)
+    if unknown:
+        raise ValueError(f"unknown postprocess steps for {voice}: {', '.join(sorted(unknown))}")
+    return PostProcess(
+        trim="trim" in steps,
+        normalize="loudness" if "loudness" in steps else "peak" if "peak" in steps else None,
+        silence_threshold_dbfs=settings.TTS_SILENCE_THRESHOLD_DBFS,
+        padding_ms=settings.TTS_SILENCE_PADDING_MS,
+        peak_dbfs=settings.TTS_PEAK_DBFS,
+        loudness_dbfs=settings.TTS_LOUDNESS_DBFS,
+    )
+
+
+def _amplitude(dbfs: float) -> float:
+    return 32768 * 10 ** (dbfs / 20)
+
+
+def _frame_energy(samples, frame: int):
+    """フレームごとの平均二乗振幅(端数のサンプルは含めない)"""
+    np = lazy.np
+    n_frames = len(samples) // frame
+    frames = samples[: n_frames * frame].reshape(n_frames, frame).astype(np.float32)
+    return np.einsum("ij,ij->i", frames, frames) / frame
+
+
+def postprocess_pcm(pcm: bytes, sample_rate: int, config: PostProcess) -> bytes | memoryview:
+    """PCM の前後の無音を落とし、音量を正規化する。声が入っているかどうかも同じフレームの計算で確かめる(無音だけなら SilentAudioError)
+
+    音量を変えない場合はコピーせず、pcm の範囲を指す memoryview を返す
+    """
+    np = lazy.np
+    samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2)
+    frame = min(len(samples), sample_rate * FRAME_MS // 1000)
+    if frame == 0:
+        raise SilentAudioError("audio is empty")
+    energy = _frame_energy(samples, frame)
+    voiced = energy >= _amplitude(config.silence_threshold_dbfs) ** 2
+    indices = np.flatnonzero(voiced)
+    if len(indices) == 0:
+        raise SilentAudioError(f"audio is silent (below {config.silence_threshold_dbfs}dBFS)")
+
+    start, end = 0, len(samples)
+    if config.trim:
+        padding = sample_rate * config.padding_ms // 1000
+        start = max(0, int(indices[0]) * frame - padding)
+        end = min(len(samples), (int(indices[-1]) + 1) * frame + padding)
+
+    gain = 1.0
+    if config.normalize is not None:
+        trimmed = samples[start:end]
+        peak = max(int(trimmed.max()), -int(trimmed.min()))
+        # どちらの正規化でもクリップはさせない
+        gain = _amplitude(config.peak_dbfs) / peak
+        if config.normalize == "loudness":
+            rms = math.sqrt(float(energy[voiced].mean()))
+            gain = min(gain, _amplitude(config.loudness_dbfs) / rms)
+    if abs(gain - 1.0) < 0.01:
+        return memoryview(pcm)[start * 2 : end * 2]
+    scaled = samples[start:end] * np.float32(gain)
+    return np.clip(np.rint(scaled, out=scaled), -32768, 32767, out=scaled).astype("<i2").tobytes()
+
+
+class LeadingSilenceTrimmer:
+    """ストリーミング中の PCM の先頭の無音を落とす(声が始まった後は届いたチャンクをそのまま通す)
+
+    最後まで声が始まらなかった場合に備えて、落とした無音も声が始まるまでは持っておく(flush で返す)
+    """
+
+    def __init__(self, sample_rate: int, config: PostProcess) -> None:
+        self._frame_bytes = sample_rate * FRAME_MS // 1000 * 2
+        self._padding_bytes = sample_rate * config.padding_ms // 1000 * 2
+        self._threshold = _amplitude(config.silence_threshold_dbfs) ** 2
+        self._pending = b""
+        self._dropped: list[bytes] = []
+        self._started = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        """チャンクを受け取り、送ってよい部分を返す(声が始まるまでは空)"""
+        if self._started:
+            return chunk
+        data = self._pending + chunk
+        usable = len(data) - len(data) % self._frame_bytes
+        if usable:
+            np = lazy.np
+            energy = _frame_energy(np.frombuffer(data, dtype="<i2", count=usable // 2), self._frame_bytes // 2)
+            indices = np.flatnonzero(energy >= self._threshold)
+            if len(indices):
+                self._started, self._pending, self._dropped = True, b"", []
+                return data[max(0, int(indices[0]) * self._frame_bytes - self._padding_bytes) :]
+        # 声が始まったときに前に付ける分だけ残す(サンプルの境界から)
+        keep_from = max(0, usable - self._padding_bytes)
+        if keep_from:
+            self._dropped.append(data[:keep_from])
+        self._pending = data[keep_from:]
+        return b""
+
+    def flush(self) -> bytes:
+        """ストリームの終わりに呼ぶ。最後まで声が始まらなかった(無音だけの)場合は、落とした分も含めて受け取った PCM をそのまま返す"""
+        if self._started:
+            return b""
+        pcm = b"".join([*self._dropped, self._pending])
+        self._dropped, self._pending = [], b""
+        return pcm
@@ -1,42 +1,65 @@
+import re
 import struct
 
-import azure.cognitiveservices.speech as speechsdk
-
+from src import lazy_imports as lazy
+from src.audio_format import AZURE_OUTPUT_FORMATS
 from src.config import settings
 
 
+# 合成パラメータの既定値
+DEFAULT_VOICE_NAME = "ja-JP-KeitaNeural"
+DEFAULT_PITCH = "+10%"
+DEFAULT_RATE = "-5%"
+
+_NON_ZERO_BYTE_RE = re.compile(rb"[^\x00]")
+
+
+def default_pcm_output_format() -> str:
+    """TTS_SAMPLE_RATE の PCM の SpeechSynthesisOutputFormat の名前"""
+    return AZURE_OUTPUT_FORMATS[f"wav_{settings.TTS_SAMPLE_RATE}"]
+
+
+class AzureSynthesisCanceledError(RuntimeError):
+    """Azure TTS がエラーで合成を中止した(error_code は CancellationErrorCode の名前)"""
+
+    def __init__(self, error_code: str, error_details: str) -> None:
+        super().__init__(f"{error_code}: {error_details}")
+        self.error_code = error_code
+
+
 class AzureSpeechSynthesizer:
     """Azureの音声合成をストリームに保存するためのクラス"""
 
-    def __init__(self, voice_name="ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%") -> None:
-        self.speech_config = speechsdk.SpeechConfig(subscription=settings.AZURE_SPEECH_KEY, region="japaneast")
+    def __init__(self, voice_name=DEFAULT_VOICE_NAME, pitch: str = DEFAULT_PITCH, rate: str = DEFAULT_RATE, output_format: str | None = None) -> None:
+        """output_format は SpeechSynthesisOutputFormat の名前(省略時は TTS_SAMPLE_RATE の PCM)"""
+        output_format = output_format or default_pcm_output_format()
+        self.speech_config = lazy.speechsdk.SpeechConfig(subscription=settings.AZURE_SPEECH_KEY, region="japaneast")
         self.speech_config.speech_synthesis_voice_name = voice_name
-        self.speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Raw44100Hz16BitMonoPcm)
+        self.speech_config.set_speech_synthesis_output_format(getattr(lazy.speechsdk.SpeechSynthesisOutputFormat, output_format))
         self.voice_name = voice_name
-        self.speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=self.speech_config, audio_config=None)
+        self.speech_synthesizer = lazy.speechsdk.SpeechSynthesizer(speech_config=self.speech_config, audio_config=None)
         self.pitch = pitch
         self.rate = rate
 
+    def open_connection(self) -> None:
+        """合成サーバーへの接続を先に開いておく(初回の合成で接続を待たないようにする)"""
+        self.connection = lazy.speechsdk.Connection.from_speech_synthesizer(self.speech_synthesizer)
+        self.connection.open(True)
+
     def speech_synthesis_to_audio_data_stream(self, text: str) -> bytes | None:
-        """音声合成した結果をwavのバイト列として返す"""
+        """音声合成した結果を output_format のバイト列として返す(PCM の場合は WAV ヘッダーなし)
+
+        エラーで中止された場合は AzureSynthesisCanceledError を送出する
+        """
         ssml_text = self._create_ssml(text, self.pitch, self.rate)
 
         # SSMLを使用して音声合成を行う
         result = self.speech_synthesizer.speak_ssml_async(ssml_text).get()
 
-        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            audio_data_stream = speechsdk.AudioDataStream(result)
-            audio_data_stream.position = 0
-
-            audio_chunks = []
-            while True:
-                audio_buffer = bytes(4096)  # Create a byte buffer of size 4096
-                filled_size = audio_data_stream.read_data(audio_buffer)
-                if filled_size == 0:
-                    break
-                audio_chunks.append(audio_buffer[:filled_size])
-
-            audio_data = b"".join(audio_chunks)
+        if result.reason == lazy.speechsdk.ResultReason.SynthesizingAudioCompleted:
+            # 合成結果は SDK が result.audio_data に1つのバッファとして読み込み済みなので、
+            # AudioDataStream で小分けに読み直して連結せずにそのまま使う
+            audio_data = result.audio_data
 
             if self._is_valid_audio(audio_data):
                 return audio_data
@@ -44,11 +67,12 @@ class AzureSpeechSynthesizer:
             print("Error: Audio data is empty or invalid.")
             return None
 
-        elif result.reason == speechsdk.ResultReason.Canceled:
+        elif result.reason == lazy.speechsdk.ResultReason.Canceled:
             cancellation_details = result.cancellation_details
             print(f"Speech synthesis canceled: {cancellation_details.reason}")
-            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+            if cancellation_details.reason == lazy.speechsdk.CancellationReason.Error:
                 print(f"Error details: {cancellation_details.error_details}")
+                raise AzureSynthesisCanceledError(cancellation_details.error_code.name, cancellation_details.error_details)
             return None
 
     def _create_ssml(self, text: str, pitch: str, rate: str) -> str:
@@ -66,20 +90,40 @@ class AzureSpeechSynthesizer:
 
     @classmethod
     def _is_valid_audio(cls, audio_data):
-        if audio_data.strip(b"\x00"):
-            return True
-        return False
+        # 無音(すべて 0)でなければよいので、最初の 0 以外のバイトで探索を打ち切る(バッファはコピーしない)
+        return _NON_ZERO_BYTE_RE.search(audio_data) is not None
 
 
-def add_wav_header(audio_data, *, sample_rate=44100) -> bytes:
-    """Adds a WAV header to the given audio data."""
+# 長さが決まっていないストリームの WAV ヘッダーに入れるサイズ
+UNKNOWN_WAV_SIZE = 0xFFFFFFFF
+
+
+def wav_header(data_size: int | None = None, *, sample_rate: int | None = None) -> bytes:
+    """16bit mono PCM の WAV ヘッダー(data_size が None ならストリーミング用に長さ未定とする。sample_rate の省略時は TTS_SAMPLE_RATE)"""
+    sample_rate = sample_rate or settings.TTS_SAMPLE_RATE
     num_channels = 1  # Mono
     sample_width = 2  # 2 bytes per sample
     byte_rate = sample_rate * num_channels * sample_width
     block_align = num_channels * sample_width
-    subchunk2_size = len(audio_data)
-    chunk_size = 36 + subchunk2_size
+    if data_size is None:
+        subchunk2_size = chunk_size = UNKNOWN_WAV_SIZE
+    else:
+        subchunk2_size = data_size
+        chunk_size = 36 + subchunk2_size
+
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", chunk_size, b"WAVE", b"fmt ", 16, 1, num_channels, sample_rate, byte_rate, block_align, sample_width * 8, b"data", subchunk2_size)
 
-    wav_header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", chunk_size, b"WAVE", b"fmt ", 16, 1, num_channels, sample_rate, byte_rate, block_align, sample_width * 8, b"data", subchunk2_size)
 
-    return wav_header + audio_data
+def wav_parts(pcm_chunks: list[bytes], *, sample_rate: int | None = None) -> list[bytes]:
+    """PCM のチャンクの前に WAV ヘッダーを付けたリスト(連結せずにファイル・レスポンスへ順に書き出す用)"""
+    return [wav_header(sum(len(chunk) for chunk in pcm_chunks), sample_rate=sample_rate), *pcm_chunks]
+
+
+def join_wav(pcm_chunks: list[bytes], *, sample_rate: int | None = None) -> bytes:
+    """PCM のチャンクを WAV ヘッダーごと1回のコピーで連結する"""
+    return b"".join(wav_parts(pcm_chunks, sample_rate=sample_rate))
+
+
+def add_wav_header(audio_data, *, sample_rate: int | None = None) -> bytes:
+    """Adds a WAV header to the given audio data."""
+    return join_wav([audio_data], sample_rate=sample_rate)
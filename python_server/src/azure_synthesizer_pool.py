@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from src.azure_speech_synthesizer import DEFAULT_PITCH, DEFAULT_RATE, DEFAULT_VOICE_NAME, AzureSpeechSynthesizer, default_pcm_output_format
+from src.metrics import STAGE_AZURE_POOL_WAIT, STAGE_AZURE_SYNTHESIS, record_azure_pool, stage_timer
+
+LOGGER = logging.getLogger(__name__)
+
+# (voice_name, pitch, rate, output_format)
+PoolKey = tuple[str, str, str, str]
+
+
+@dataclass
+class _Pool:
+    """同じ合成パラメータの AzureSpeechSynthesizer の置き場"""
+
+    name: str
+    slots: asyncio.Semaphore
+    idle: list[AzureSpeechSynthesizer] = field(default_factory=list)
+    in_use: int = 0
+
+    def record(self) -> None:
+        record_azure_pool(self.name, idle=len(self.idle), in_use=self.in_use)
+
+
+class AzureSynthesizerPool:
+    """AzureSpeechSynthesizer を (voice_name, pitch, rate, output_format) ごとに使い回すプール
+
+    SpeechConfig / SpeechSynthesizer の生成と接続はリクエストごとに行わず、接続を開いたまま貸し出す。
+    同じパラメータの合成は最大 size 件、全体では最大 concurrency 件まで並行し、それ以上は空くまで待つ(待ち時間は azure_pool_wait ステージに記録する)。
+    SDK の呼び出しはブロックするので専用のスレッドプールで実行する。
+    """
+
+    def __init__(self, *, size: int, threads: int, concurrency: int) -> None:
+        self.size = size
+        self._pools: dict[PoolKey, _Pool] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="azure_tts")
+
+    async def synthesize(
+        self, text: str, voice_name: str = DEFAULT_VOICE_NAME, pitch: str = DEFAULT_PITCH, rate: str = DEFAULT_RATE, output_format: str | None = None
+    ) -> bytes | None:
+        """プールの synthesizer で合成した音声を返す(output_format の省略時は TTS_SAMPLE_RATE の PCM。音声が得られなければ None)"""
+        key = (voice_name, pitch, rate, output_format or default_pcm_output_format())
+        pool = self._pool(key)
+        with stage_timer(STAGE_AZURE_POOL_WAIT):
+            await pool.slots.acquire()
+            try:
+                await self._slots.acquire()
+            except BaseException:
+                pool.slots.release()
+                raise
+        synthesizer = pool.idle.pop() if pool.idle else None
+        pool.in_use += 1
+        pool.record()
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._synthesize, synthesizer, text, key)
+        # 待つ側がキャンセルされても、スレッドでの合成が終わるまでは貸し出したままにする
+        future.add_done_callback(lambda f: self._check_in(pool, f))
+        with stage_timer(STAGE_AZURE_SYNTHESIS):
+            _, tts_data = await asyncio.shield(future)
+        return tts_data
+
+    async def prefill(
+        self, count: int | None = None, voice_name: str = DEFAULT_VOICE_NAME, pitch: str = DEFAULT_PITCH, rate: str = DEFAULT_RATE, output_format: str | None = None
+    ) -> None:
+        """接続を開いた synthesizer を count 個(省略時はプールの上限まで)用意しておく"""
+        key = (voice_name, pitch, rate, output_format or default_pcm_output_format())
+        pool = self._pool(key)
+        target = self.size if count is None else min(count, self.size)
+        missing = target - len(pool.idle) - pool.in_use
+        if missing <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        created = await asyncio.gather(*(loop.run_in_executor(self._executor, self._create, key) for _ in range(missing)))
+        # 用意している間にリクエストで作られた分があれば、上限を超えないようにする
+        pool.idle.extend(created[: max(0, self.size - len(pool.idle) - pool.in_use)])
+        pool.record()
+
+    def _pool(self, key: PoolKey) -> _Pool:
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = _Pool(name="/".join(key), slots=asyncio.Semaphore(self.size))
+        return pool
+
+    def _create(self, key: PoolKey) -> AzureSpeechSynthesizer:
+        voice_name, pitch, rate, output_format = key
+        synthesizer = AzureSpeechSynthesizer(voice_name=voice_name, pitch=pitch, rate=rate, output_format=output_format)
+        synthesizer.open_connection()
+        return synthesizer
+
+    def _synthesize(self, synthesizer: AzureSpeechSynthesizer | None, text: str, key: PoolKey) -> tuple[AzureSpeechSynthesizer, bytes | None]:
+        """(スレッドで実行)空きがなければ synthesizer を作ってから合成する"""
+        if synthesizer is None:
+            synthesizer = self._create(key)
+        return synthesizer, synthesizer.speech_synthesis_to_audio_data_stream(text)
+
+    def _check_in(self, pool: _Pool, future: asyncio.Future) -> None:
+        """合成が終わった synthesizer をプールに戻す(失敗した場合は接続の状態が分からないので捨てる)"""
+        pool.in_use -= 1
+        if not future.cancelled() and future.exception() is None:
+            synthesizer, tts_data = future.result()
+            if tts_data is not None:
+                pool.idle.append(synthesizer)
+            else:
+                LOGGER.warning(f"Azure TTS が音声を返さなかったため synthesizer を作り直します ({pool.name})")
+        self._slots.release()
+        pool.slots.release()
+        pool.record()
+
+    def close(self) -> None:
+        """スレッドプールを止める(実行中の合成は待たない)"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
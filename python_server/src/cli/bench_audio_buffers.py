@@ -0,0 +1,121 @@
+"""音声バッファの組み立てのベンチマーク
+
+長い発話の音声について、以前の実装と現在の実装で、組み立てにかかる時間とピークメモリ(入力の音声を除く)を比較する。
+
+- azure: Azure TTS の結果から WAV を作る
+  (以前: AudioDataStream で 4096 バイトずつ読み直して連結 -> strip で無音判定 -> ヘッダーと連結)
+- elevenlabs: ElevenLabs のチャンクから WAV を作る(以前: チャンクを連結 -> ヘッダーと連結)
+- stream_store: ストリーミングで送ったチャンクを音声キャッシュのファイルに書き込む(以前: 連結 -> ヘッダーと連結 -> 書き込み)
+
+    python -m src.cli.bench_audio_buffers --seconds 60 --repeat 5
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+
+from src.audio_cache import _write_parts
+from src.azure_speech_synthesizer import AzureSpeechSynthesizer, add_wav_header, join_wav, wav_header, wav_parts
+
+SAMPLE_RATE = 44100
+# ElevenLabs のストリームのチャンクサイズ(おおよそ)
+CHUNK_SIZE = 4096
+
+
+def _read_chunks_previous(audio_data: bytes) -> list[bytes]:
+    """以前の AudioDataStream の読み方(読むたびに 4096 バイトのバッファを確保し、読めた分を切り出す)
+
+    SDK は確保したバッファに直接書き込むが、ここでは読めた分の切り出しを元データのスライスで代用する(確保の回数・サイズは同じ)
+    """
+    chunks = []
+    position = 0
+    while True:
+        audio_buffer = bytes(4096)
+        filled_size = min(len(audio_buffer), len(audio_data) - position)
+        if filled_size == 0:
+            break
+        chunks.append(audio_data[position : position + filled_size])
+        position += filled_size
+    return chunks
+
+
+def azure_previous(audio_data: bytes, chunks: list[bytes], path: str) -> None:
+    pcm = b"".join(_read_chunks_previous(audio_data))
+    assert pcm.strip(b"\x00")
+    wav_header(len(pcm), sample_rate=SAMPLE_RATE) + pcm
+
+
+def azure_current(audio_data: bytes, chunks: list[bytes], path: str) -> None:
+    assert AzureSpeechSynthesizer._is_valid_audio(audio_data)
+    add_wav_header(audio_data, sample_rate=SAMPLE_RATE)
+
+
+def elevenlabs_previous(audio_data: bytes, chunks: list[bytes], path: str) -> None:
+    pcm = b"".join(chunks)
+    wav_header(len(pcm), sample_rate=SAMPLE_RATE) + pcm
+
+
+def elevenlabs_current(audio_data: bytes, chunks: list[bytes], path: str) -> None:
+    join_wav(chunks, sample_rate=SAMPLE_RATE)
+
+
+def stream_store_previous(audio_data: bytes, chunks: list[bytes], path: str) -> None:
+    pcm = b"".join(chunks)
+    with open(path, "wb") as f:
+        f.write(wav_header(len(pcm), sample_rate=SAMPLE_RATE) + pcm)
+
+
+def stream_store_current(audio_data: bytes, chunks: list[bytes], path: str) -> None:
+    with open(path, "wb") as f:
+        _write_parts(f, wav_parts(chunks, sample_rate=SAMPLE_RATE))
+
+
+CASES: dict[str, tuple[Callable, Callable]] = {
+    "azure": (azure_previous, azure_current),
+    "elevenlabs": (elevenlabs_previous, elevenlabs_current),
+    "stream_store": (stream_store_previous, stream_store_current),
+}
+
+
+def measure(build: Callable, audio_data: bytes, chunks: list[bytes], path: str, repeat: int) -> tuple[float, float]:
+    """(処理時間の中央値 ms, ピークメモリ MiB)"""
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build(audio_data, chunks, path)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # ピークメモリは時間を計らずに1回だけ計測する(tracemalloc 中は遅くなる)
+    tracemalloc.start()
+    build(audio_data, chunks, path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(latencies), peak / 1024 / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="音声バッファの組み立ての時間とピークメモリを以前の実装と比較する")
+    parser.add_argument("--seconds", type=float, default=60.0, help="発話の長さ(秒)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    size = int(args.seconds * SAMPLE_RATE) * 2
+    audio_data = random.Random(0).randbytes(size)
+    chunks = [audio_data[i : i + CHUNK_SIZE] for i in range(0, size, CHUNK_SIZE)]
+    print(f"audio: {args.seconds:.0f}s, {size / 1024 / 1024:.1f}MiB PCM, {len(chunks)} chunks")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "audio.wav")
+        for name, (previous, current) in CASES.items():
+            for label, build in (("previous", previous), ("current", current)):
+                latency_ms, peak_mib = measure(build, audio_data, chunks, path, args.repeat)
+                print(f"{name:13s} {label:9s} {latency_ms:8.2f}ms  peak {peak_mib:7.1f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""音声の後処理(src.audio_postprocess)のベンチマーク
+
+前後に無音のある合成音声(16bit mono PCM)について、後処理ごとに音声1秒あたりの処理時間(ms)と、削れたバイト数を表示する。
+比較のため、以前からある無音判定(AzureSpeechSynthesizer._is_valid_audio)の時間も表示する。
+
+    python -m src.cli.bench_audio_postprocess --seconds 10 --sample-rate 44100 --repeat 20
+"""
+
+import argparse
+import statistics
+import time
+from collections.abc import Callable
+
+import numpy as np
+
+from src.audio_postprocess import LeadingSilenceTrimmer, PostProcess, postprocess_pcm
+from src.azure_speech_synthesizer import AzureSpeechSynthesizer
+
+# ElevenLabs のストリームのチャンクサイズ(おおよそ)
+CHUNK_SIZE = 4096
+LEADING_SILENCE_SEC = 0.3
+TRAILING_SILENCE_SEC = 0.5
+
+
+def synthetic_speech(seconds: float, sample_rate: int) -> bytes:
+    """前後に無音(小さなノイズ)があり、途中に息継ぎの間がある音声"""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    # 約 3 音節/秒の抑揚と 2 秒ごとの息継ぎ
+    envelope = np.abs(np.sin(np.pi * 3 * t)) * (t % 2.0 < 1.8)
+    voice = np.sin(2 * np.pi * 180 * t) * envelope * 6000
+    samples = np.concatenate(
+        [
+            rng.normal(0, 4, int(LEADING_SILENCE_SEC * sample_rate)),
+            voice + rng.normal(0, 4, len(t)),
+            rng.normal(0, 4, int(TRAILING_SILENCE_SEC * sample_rate)),
+        ]
+    )
+    return samples.astype("<i2").tobytes()
+
+
+def stream_trim(pcm: bytes, sample_rate: int) -> bytes:
+    trimmer = LeadingSilenceTrimmer(sample_rate, PostProcess(trim=True))
+    return b"".join(trimmer.feed(pcm[i : i + CHUNK_SIZE]) for i in range(0, len(pcm), CHUNK_SIZE))
+
+
+def cases(sample_rate: int) -> dict[str, Callable[[bytes], bytes | memoryview | bool]]:
+    return {
+        "is_valid_audio (previous)": AzureSpeechSynthesizer._is_valid_audio,
+        "trim": lambda pcm: postprocess_pcm(pcm, sample_rate, PostProcess(trim=True)),
+        "trim + peak": lambda pcm: postprocess_pcm(pcm, sample_rate, PostProcess(trim=True, normalize="peak")),
+        "trim + loudness": lambda pcm: postprocess_pcm(pcm, sample_rate, PostProcess(trim=True, normalize="loudness")),
+        "stream leading trim": lambda pcm: stream_trim(pcm, sample_rate),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="音声の後処理の、音声1秒あたりの処理時間を計測する")
+    parser.add_argument("--seconds", type=float, default=10.0, help="声の部分の長さ(秒)")
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    pcm = synthetic_speech(args.seconds, args.sample_rate)
+    audio_seconds = len(pcm) / 2 / args.sample_rate
+    print(f"audio: {audio_seconds:.1f}s @ {args.sample_rate}Hz ({len(pcm) / 1024:.0f}KiB PCM)")
+    print(f"{'case':28s} {'ms/audio-s':>10s} {'median ms':>10s} {'bytes out':>10s} {'saved':>7s}")
+    for name, run in cases(args.sample_rate).items():
+        latencies = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = run(pcm)
+            latencies.append((time.perf_counter() - start) * 1000)
+        median_ms = statistics.median(latencies)
+        size = len(pcm) if isinstance(result, bool) else len(result)
+        print(f"{name:28s} {median_ms / audio_seconds:10.3f} {median_ms:10.2f} {size:10d} {1 - size / len(pcm):7.1%}")
+
+
+if __name__ == "__main__":
+    main()
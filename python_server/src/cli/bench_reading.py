@@ -0,0 +1,125 @@
+"""漢字→ひらがな変換のベンチマーク
+
+/voice の前処理(janome による読みの変換)について、1リクエストあたりのコストを次の方式で比較する。
+
+- per_request: リクエストごとに Tokenizer() を作る(以前の実装)
+- shared: プロセス内で共有した Tokenizer で毎回解析する
+- cached: src.reading.to_hiragana(文単位の LRU キャッシュあり)
+
+あわせて、変換中のイベントループの遅延(1ms タイマーの遅れ)を、ループ内で同期的に変換した場合と
+src.reading.to_hiragana_batch(専用スレッドで変換)の場合で比較する。
+
+    python -m src.cli.bench_reading --requests 200 --per-request-requests 20
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from collections.abc import Awaitable, Callable
+
+from src import lazy_imports as lazy
+from src import reading
+from src.templates import TEMPLATE_MESSAGES, TEMPLATE_QUESTIONS
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def bench(name: str, convert: Callable[[str], str], texts: list[str], requests: int) -> list[str]:
+    """texts を順に requests 回変換し、1回あたりの時間を表示する"""
+    latencies = []
+    outputs = []
+    for i in range(requests):
+        text = texts[i % len(texts)]
+        start = time.perf_counter()
+        outputs.append(convert(text))
+        latencies.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{name:12s} n={requests:5d}  mean={statistics.fmean(latencies):8.2f}ms"
+        f"  p50={_percentile(latencies, 50):8.2f}ms  p95={_percentile(latencies, 95):8.2f}ms"
+    )
+    return outputs[: len(texts)]
+
+
+def convert_per_request(text: str) -> str:
+    return reading.tokens_to_hiragana(lazy.Tokenizer().tokenize(text))
+
+
+def convert_shared(text: str) -> str:
+    return reading.tokens_to_hiragana(reading.get_tokenizer().tokenize(text))
+
+
+async def loop_lags(convert: Callable[[list[str]], Awaitable[None]], texts: list[str]) -> list[float]:
+    """convert(texts) の実行中に、1ms 間隔のタイマーがそれぞれどれだけ遅れたか(ms)"""
+    lags: list[float] = []
+    done = False
+
+    async def ticker() -> None:
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(max(0.0, (time.perf_counter() - start) * 1000 - 1))
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    lags.clear()
+    await convert(texts)
+    done = True
+    await task
+    return lags
+
+
+async def bench_event_loop(texts: list[str], rounds: int) -> None:
+    """キャッシュなしで変換しているあいだのイベントループの遅延を比較する"""
+
+    async def in_loop(batch: list[str]) -> None:
+        for text in batch:
+            convert_shared(text)
+            await asyncio.sleep(0)
+
+    async def in_executor(batch: list[str]) -> None:
+        await asyncio.gather(*(reading.to_hiragana_batch([text]) for text in batch))
+
+    # 回答文くらいの長さのテキストにまとめる
+    replies = ["".join(texts[i : i + 8]) for i in range(0, len(texts), 8)]
+    for name, convert in (("sync in loop", in_loop), ("to_hiragana_batch", in_executor)):
+        lags = []
+        for _ in range(rounds):
+            reading._reading_cache.clear()
+            lags += await loop_lags(convert, replies)
+        print(
+            f"event loop lag ({name:17s}) ticks={len(lags):4d}  p50={_percentile(lags, 50):6.2f}ms"
+            f"  p95={_percentile(lags, 95):6.2f}ms  max={max(lags):6.2f}ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="漢字→ひらがな変換の1リクエストあたりのコストを比較する")
+    parser.add_argument("--requests", type=int, default=200, help="shared / cached の変換回数")
+    parser.add_argument("--per-request-requests", type=int, default=20, help="per_request の変換回数(1回ごとに辞書を読み込むので少なめ)")
+    parser.add_argument("--rounds", type=int, default=10, help="イベントループの遅延を計測する回数")
+    args = parser.parse_args()
+
+    texts = [text for text in TEMPLATE_MESSAGES + TEMPLATE_QUESTIONS if text]
+    print(f"texts: {len(texts)} (mean {statistics.fmean(len(t) for t in texts):.0f} chars)")
+
+    start = time.perf_counter()
+    reading.get_tokenizer()
+    print(f"shared tokenizer load: {(time.perf_counter() - start) * 1000:.0f}ms (once per process)")
+
+    expected = bench("per_request", convert_per_request, texts, args.per_request_requests)
+    bench("shared", convert_shared, texts, args.requests)
+    reading._reading_cache.clear()
+    actual = bench("cached", reading.to_hiragana, texts, args.requests)
+
+    mismatches = sum(a != e for a, e in zip(actual, expected))
+    print(f"outputs differing from per_request: {mismatches}/{min(len(actual), len(expected))}")
+
+    asyncio.run(bench_event_loop(texts, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""テンプレートパックのビルド
+
+Text/template_messages.txt と Text/template_questions.txt の全行について、
+設定したボイス(エンドポイント)ごとの音声と、質問への回答(および回答の音声)を事前に生成し、
+バージョン付きのパックとして TEMPLATE_PACK_DIR に保存する。
+最後に CURRENT を新しいバージョンに切り替えるので、起動中のサーバーも数秒以内に新しいパックを使い始める。
+
+    python -m src.cli.build_template_pack --voices voice,voice/azure
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+
+from src.audio_format import default_audio_format
+from src.audio_postprocess import postprocess_for
+from src.config import settings
+from src.deadline import Deadline
+from src.gpt import generate_response
+from src.template_pack import AUDIO_DIR, CURRENT_FILE, MANIFEST_FILE, PACK_FORMAT, audio_filename
+from src.templates import TEMPLATE_MESSAGES, TEMPLATE_QUESTIONS
+from src.text_to_speech import TextToSpeech
+from src.tts_service import TTSService
+
+REPLY_BUILD_DEADLINE_SEC = 120.0
+
+# エンドポイントごとの音声合成(src.web.api の /voice* と揃える)
+VOICE_SYNTHESIZERS = {
+    "voice": lambda tts, text: tts.text_to_speech_stream(text),
+    "voice/v2": lambda tts, text: tts.text_to_speech_with_azure_tts(text),
+    "voice/azure": lambda tts, text: tts.azure_text_to_speech(text),
+    "voice/male": lambda tts, text: tts.azure_text_to_speech(text, voice_name="ja-JP-KeitaNeural"),
+}
+
+
+def parse_voices(value: str) -> list[str]:
+    voices = [voice.strip() for voice in value.split(",") if voice.strip()]
+    for voice in voices:
+        if voice not in VOICE_SYNTHESIZERS:
+            raise argparse.ArgumentTypeError(f"unknown voice: {voice} (choose from {', '.join(VOICE_SYNTHESIZERS)})")
+    return voices
+
+
+def source_hash(messages: list[str], questions: list[str], voices: list[str]) -> str:
+    """パックの入力(テンプレート・ボイス・モデル設定)のハッシュ"""
+    source = {
+        "messages": messages,
+        "questions": questions,
+        "voices": voices,
+        "models": [settings.GEMINI_PRO_MODEL, settings.GEMINI_FLASH_MODEL],
+        "audio_format": default_audio_format().name,
+    }
+    return hashlib.sha256(json.dumps(source, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+class PackBuilder:
+    """1バージョン分のパックを作る"""
+
+    def __init__(self, directory: pathlib.Path, voices: list[str], concurrency: int, tts: TTSService) -> None:
+        self.directory = directory
+        self.voices = voices
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # 後処理はボイス(エンドポイント)ごとに /voice* と揃える
+        self._text_to_speech = {voice: TextToSpeech(tts, postprocess=postprocess_for(voice)) for voice in voices}
+        (directory / AUDIO_DIR).mkdir(parents=True)
+
+    async def synthesize_all(self, text: str) -> dict[str, str]:
+        """全ボイスで text を合成し、{ボイス: ファイル名} を返す"""
+        filenames = await asyncio.gather(*(self._synthesize(voice, text) for voice in self.voices))
+        return dict(zip(self.voices, filenames))
+
+    async def _synthesize(self, voice: str, text: str) -> str:
+        filename = audio_filename(voice, text)
+        async with self._semaphore:
+            audio = await VOICE_SYNTHESIZERS[voice](self._text_to_speech[voice], text)
+        (self.directory / AUDIO_DIR / filename).write_bytes(audio)
+        print(f"  [{voice}] {text[:30]} -> {filename} ({len(audio)} bytes)")
+        return filename
+
+    async def message_entry(self, text: str) -> dict:
+        return {"text": text, "audio": await self.synthesize_all(text)}
+
+    async def question_entry(self, text: str, with_replies: bool) -> dict:
+        entry = {"text": text, "audio": await self.synthesize_all(text)}
+        if with_replies:
+            # ビルド時は時間をかけてよいので、縮退しない十分な期限を与える
+            deadline = Deadline(REPLY_BUILD_DEADLINE_SEC)
+            async with self._semaphore:
+                reply_text, image_filename = await generate_response(text, skip_logging=True, deadline=deadline)
+            if deadline.degradations:
+                # 縮退した回答はパックに入れない(実行時に通常どおり生成させる)
+                print(f"  [reply] {text[:30]} -> skipped (degraded: {','.join(deadline.degradations)})")
+                return entry
+            print(f"  [reply] {text[:30]} -> {reply_text[:30]}")
+            entry["reply"] = {
+                "text": reply_text,
+                "image_filename": image_filename,
+                "audio": await self.synthesize_all(reply_text),
+            }
+        return entry
+
+
+async def build(pack_dir: pathlib.Path, voices: list[str], *, with_replies: bool, concurrency: int) -> str:
+    """パックを一時ディレクトリに作ってから公開し、CURRENT を切り替える。バージョン名を返す"""
+    messages = [text for text in TEMPLATE_MESSAGES if text]
+    questions = [text for text in TEMPLATE_QUESTIONS if text]
+    digest = source_hash(messages, questions, voices)
+    created_at = datetime.datetime.now(tz=settings.LOCAL_TZ)
+    version = f"{created_at:%Y%m%d_%H%M%S}_{digest[:8]}"
+
+    pack_dir.mkdir(parents=True, exist_ok=True)
+    staging = pathlib.Path(tempfile.mkdtemp(prefix=".building_", dir=pack_dir))
+    tts = TTSService()
+    try:
+        builder = PackBuilder(staging, voices, concurrency, tts)
+        print(f"messages: {len(messages)}")
+        message_entries = await asyncio.gather(*(builder.message_entry(text) for text in messages))
+        print(f"questions: {len(questions)}")
+        question_entries = await asyncio.gather(*(builder.question_entry(text, with_replies) for text in questions))
+
+        manifest = {
+            "format": PACK_FORMAT,
+            "version": version,
+            "created_at": created_at.isoformat(),
+            "source_hash": digest,
+            "voices": voices,
+            # 音声は既定の出力形式で合成する(サーバーは同じ形式のリクエストにのみ使う)
+            "audio_format": default_audio_format().name,
+            "messages": message_entries,
+            "questions": question_entries,
+        }
+        (staging / MANIFEST_FILE).write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        staging.rename(pack_dir / version)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        await tts.aclose()
+
+    # CURRENT はリネームで置き換える(読み込み中のサーバーが書きかけのファイルを読まないように)
+    current_tmp = pack_dir / f".{CURRENT_FILE}.tmp"
+    current_tmp.write_text(version + "\n", encoding="utf-8")
+    os.replace(current_tmp, pack_dir / CURRENT_FILE)
+    return version
+
+
+def prune(pack_dir: pathlib.Path, keep: int) -> None:
+    """古いバージョンを削除する(CURRENT が指すバージョンは残す)"""
+    current = (pack_dir / CURRENT_FILE).read_text(encoding="utf-8").strip()
+    versions = sorted(p for p in pack_dir.iterdir() if p.is_dir() and not p.name.startswith("."))
+    for old in versions[:-keep] if keep > 0 else versions:
+        if old.name != current:
+            shutil.rmtree(old)
+            print(f"removed old pack: {old.name}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="テンプレートメッセージ・質問の音声と回答を事前生成する")
+    parser.add_argument("--voices", type=parse_voices, default=settings.TEMPLATE_PACK_VOICES, help=f"生成するボイス(カンマ区切り: {', '.join(VOICE_SYNTHESIZERS)})")
+    parser.add_argument("--output", type=pathlib.Path, default=settings.TEMPLATE_PACK_DIR, help="パックの保存先")
+    parser.add_argument("--no-replies", action="store_true", help="質問への回答を生成しない(音声のみ)")
+    parser.add_argument("--concurrency", type=int, default=4, help="外部プロバイダへの同時リクエスト数")
+    parser.add_argument("--keep", type=int, default=3, help="残しておく過去バージョンの数")
+    args = parser.parse_args()
+
+    version = asyncio.run(build(args.output, args.voices, with_replies=not args.no_replies, concurrency=args.concurrency))
+    prune(args.output, args.keep)
+    print(f"template pack {version} -> {args.output / version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""import 時間の予算チェック
+
+サーバー・CLI のモジュールを新しいプロセスで `python -X importtime` 付きで import し、
+累積 import 時間が予算内か、重い依存ライブラリ(src.lazy_imports 経由で初めて使うときに読み込むもの)を
+import 時に読み込んでいないかを確認する。どちらかに違反すると終了コード 1 を返す。
+
+    python -m src.cli.check_import_time
+    python -m src.cli.check_import_time --repeat 5 --top 10 src.web.api
+"""
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+from dataclasses import dataclass, field
+
+# モジュール -> 累積 import 時間の予算(ミリ秒)
+IMPORT_BUDGETS_MS = {
+    "src.web.api": 1500,
+    "src.gpt": 800,
+    "src.warmup": 800,
+    "src.cli.build_template_pack": 800,
+    "src.cli.load_test": 300,
+}
+
+# import 時に読み込んではいけないモジュール(配下のサブモジュールも含む)
+DEFERRED_MODULES = (
+    "langchain",
+    "langchain_community",
+    "langchain_core",
+    "langchain_google_genai",
+    "google.generativeai",
+    "google.api_core",
+    "elevenlabs",
+    "azure.cognitiveservices.speech",
+    "janome",
+    "pandas",
+    "faiss",
+)
+
+# import time:       self [us] |  cumulative | imported package
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+@dataclass
+class ImportProfile:
+    """1回分の import の計測結果"""
+
+    module: str
+    cumulative_us: int = 0
+    # 直接 import したモジュール -> 累積時間(us)
+    children_us: dict[str, int] = field(default_factory=dict)
+    imported: set[str] = field(default_factory=set)
+
+
+def profile_import(module: str) -> ImportProfile:
+    """新しいプロセスで module を import し、-X importtime の出力を集計する"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    profile = ImportProfile(module=module)
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match is None:
+            continue
+        cumulative, depth, name = int(match[2]), len(match[3]) // 2, match[4]
+        profile.imported.add(name)
+        if depth == 0 and name == module:
+            profile.cumulative_us = cumulative
+        elif depth == 1:
+            # 子の行は親の行より先に出力される(最後に出力された親が module であれば module の子)
+            profile.children_us[name] = cumulative
+        elif depth == 0:
+            profile.children_us.clear()
+    return profile
+
+
+def deferred_imports(imported: set[str]) -> list[str]:
+    """import 時に読み込まれた DEFERRED_MODULES"""
+    return sorted(name for name in imported if any(name == m or name.startswith(m + ".") for m in DEFERRED_MODULES))
+
+
+def check(module: str, budget_ms: float, *, repeat: int, top: int) -> bool:
+    """module の import 時間と遅延 import を検査して結果を表示する。違反がなければ True"""
+    profiles = [profile_import(module) for _ in range(repeat)]
+    median_ms = statistics.median(p.cumulative_us for p in profiles) / 1000
+    fastest = min(profiles, key=lambda p: p.cumulative_us)
+    leaked = deferred_imports(fastest.imported)
+
+    ok = median_ms <= budget_ms and not leaked
+    print(f"{'OK  ' if ok else 'FAIL'} {module}: {median_ms:.0f}ms (budget {budget_ms:.0f}ms, median of {repeat})")
+    for name, cumulative_us in sorted(fastest.children_us.items(), key=lambda item: -item[1])[:top]:
+        print(f"       {cumulative_us / 1000:8.1f}ms  {name}")
+    if leaked:
+        print(f"       eagerly imported: {', '.join(leaked[:top])}{' ...' if len(leaked) > top else ''}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="サーバー・CLI のモジュールの import 時間が予算内か確認する")
+    parser.add_argument("modules", nargs="*", help=f"検査するモジュール(省略時: {', '.join(IMPORT_BUDGETS_MS)})")
+    parser.add_argument("--budget-ms", type=float, help="予算(ミリ秒)。省略時は IMPORT_BUDGETS_MS の値")
+    parser.add_argument("--repeat", type=int, default=3, help="計測回数(中央値で判定する)")
+    parser.add_argument("--top", type=int, default=5, help="表示する遅い import の数")
+    args = parser.parse_args()
+
+    modules = args.modules or list(IMPORT_BUDGETS_MS)
+    results = []
+    for module in modules:
+        budget_ms = args.budget_ms if args.budget_ms is not None else IMPORT_BUDGETS_MS.get(module)
+        if budget_ms is None:
+            parser.error(f"no budget for {module} (pass --budget-ms)")
+        results.append(check(module, budget_ms, repeat=args.repeat, top=args.top))
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
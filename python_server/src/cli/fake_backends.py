@@ -0,0 +1,195 @@
+"""負荷試験用のローカル代替バックエンド
+
+Gemini / 埋め込み / ElevenLabs / Azure TTS を、レイテンシ分布とエラー率を指定できる偽物に差し替える。
+ネットワークにもAPIクォータにも触れずに FastAPI アプリ全体を動かすために使う。
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+FAKE_REPLY = "Nittoグループは粘着テープや光学フィルムなど、幅広い分野で独自の技術を活かした製品を提供しています。詳しくはスライドをご覧ください。"
+EMBEDDING_DIM = 768  # models/text-embedding-004 と同じ次元(faiss_knowledge / faiss_qa の index と合わせる)
+SAMPLE_RATE = 44100
+SECONDS_PER_CHAR = 0.12  # 日本語読み上げのおおよその長さ
+AUDIO_CHUNK_SIZE = 4096
+ELEVENLABS_REALTIME_FACTOR = 4.0  # 再生時間の何倍の速さで音声が届くか
+
+
+class FakeBackendError(RuntimeError):
+    """代替バックエンドが注入したエラー"""
+
+
+@dataclass
+class LatencyProfile:
+    """レイテンシ分布(対数正規分布)とエラー率"""
+
+    median_ms: float
+    p95_ms: float
+    error_rate: float = 0.0
+
+    def sample(self, rng: random.Random) -> float:
+        """レイテンシを1つサンプリングする(秒)"""
+        if self.median_ms <= 0:
+            return 0.0
+        sigma = math.log(max(self.p95_ms, self.median_ms) / self.median_ms) / 1.645
+        return rng.lognormvariate(math.log(self.median_ms), sigma) / 1000
+
+    def maybe_fail(self, rng: random.Random, backend: str) -> None:
+        """error_rate の確率でエラーを送出する"""
+        if rng.random() < self.error_rate:
+            raise FakeBackendError(f"injected {backend} error")
+
+
+@dataclass
+class FakeBackendConfig:
+    """代替バックエンド全体の設定"""
+
+    gemini: LatencyProfile
+    embedding: LatencyProfile
+    elevenlabs: LatencyProfile
+    azure: LatencyProfile
+    seed: int = 0
+
+
+_config = FakeBackendConfig(
+    gemini=LatencyProfile(median_ms=800, p95_ms=2500),
+    embedding=LatencyProfile(median_ms=80, p95_ms=200),
+    elevenlabs=LatencyProfile(median_ms=400, p95_ms=1200),
+    azure=LatencyProfile(median_ms=300, p95_ms=900),
+)
+_rng = random.Random(0)
+
+
+def _fake_pcm(text: str) -> bytes:
+    """テキスト長に比例した長さの 16bit mono PCM を作る"""
+    n_samples = int(max(len(text), 1) * SECONDS_PER_CHAR * SAMPLE_RATE)
+    t = np.arange(n_samples) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 220 * t) * 3000).astype("<i2").tobytes()
+
+
+class _FakeResponse:
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """google.generativeai.GenerativeModel の代替"""
+
+    def __init__(self, model_name: str = "gemini-1.5-pro", generation_config: dict | None = None, **kwargs) -> None:
+        self.model_name = model_name
+        self._json = bool(generation_config and generation_config.get("response_mime_type") == "application/json")
+
+    def generate_content(self, contents, **kwargs) -> _FakeResponse:
+        time.sleep(_config.gemini.sample(_rng))
+        _config.gemini.maybe_fail(_rng, "gemini")
+        return _FakeResponse(self._answer(contents))
+
+    async def generate_content_async(self, contents, **kwargs) -> _FakeResponse:
+        await asyncio.sleep(_config.gemini.sample(_rng))
+        _config.gemini.maybe_fail(_rng, "gemini")
+        return _FakeResponse(self._answer(contents))
+
+    def _answer(self, contents) -> str:
+        """プロンプトの種類に合わせたそれらしい応答を返す"""
+        prompt = contents if isinstance(contents, str) else str(contents)
+        if self._json:
+            if "question_index" in prompt:
+                return json.dumps({"question_index": [0]})
+            if '"results"' in prompt:
+                return json.dumps({"results": [1]})
+            return json.dumps({"response": FAKE_REPLY}, ensure_ascii=False)
+        if "スライド番号" in prompt:
+            return "1"
+        if "数字のみで回答" in prompt:
+            return "0"
+        return FAKE_REPLY
+
+
+class FakeEmbeddings(Embeddings):
+    """GoogleGenerativeAIEmbeddings の代替(テキストのハッシュから決定的なベクトルを作る)"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(_config.embedding.sample(_rng))
+        _config.embedding.maybe_fail(_rng, "embedding")
+        return self._vector(text)
+
+    @staticmethod
+    def _vector(text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIM)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class _FakeStreamEndpoint:
+    async def convert_as_stream(self, *args, text: str = "", audio: bytes | None = None, **kwargs):
+        await asyncio.sleep(_config.elevenlabs.sample(_rng))
+        _config.elevenlabs.maybe_fail(_rng, "elevenlabs")
+        if audio is not None:
+            # speech-to-speech は入力音声と同じ長さを返す
+            pcm = bytes(audio)[44:]
+        else:
+            pcm = _fake_pcm(text)
+        for i in range(0, len(pcm), AUDIO_CHUNK_SIZE):
+            yield pcm[i : i + AUDIO_CHUNK_SIZE]
+            # 実物と同様に、音声の長さに比例した時間をかけて少しずつ届ける
+            await asyncio.sleep(AUDIO_CHUNK_SIZE / 2 / SAMPLE_RATE / ELEVENLABS_REALTIME_FACTOR)
+
+
+class FakeAsyncElevenLabs:
+    """elevenlabs.client.AsyncElevenLabs の代替"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.text_to_speech = _FakeStreamEndpoint()
+        self.speech_to_speech = _FakeStreamEndpoint()
+
+
+class FakeAzureSpeechSynthesizer:
+    """AzureSpeechSynthesizer の代替(実物と同様に呼び出し元をブロックする)"""
+
+    def __init__(self, voice_name="ja-JP-KeitaNeural", pitch: str = "+10%", rate: str = "-5%", output_format: str | None = None) -> None:
+        self.voice_name = voice_name
+        self.pitch = pitch
+        self.rate = rate
+
+    def open_connection(self) -> None:
+        """接続を開く(偽物なので何もしない)"""
+
+    def speech_synthesis_to_audio_data_stream(self, text: str) -> bytes | None:
+        time.sleep(_config.azure.sample(_rng))
+        try:
+            _config.azure.maybe_fail(_rng, "azure")
+        except FakeBackendError as e:
+            from src.azure_speech_synthesizer import AzureSynthesisCanceledError
+
+            # 実物と同様に、サーバー側のエラーとして中止する
+            raise AzureSynthesisCanceledError("ServiceUnavailable", str(e)) from e
+        return _fake_pcm(text)
+
+
+def install(config: FakeBackendConfig) -> None:
+    """アプリが参照する外部バックエンドを代替実装に差し替える(src.web.api の import 前に呼ぶ)"""
+    global _config, _rng
+    _config = config
+    _rng = random.Random(config.seed)
+
+    import src.azure_synthesizer_pool
+    from src import lazy_imports as lazy
+
+    lazy.genai.GenerativeModel = FakeGenerativeModel
+    lazy.GoogleGenerativeAIEmbeddings = FakeEmbeddings
+    lazy.AsyncElevenLabs = FakeAsyncElevenLabs
+    src.azure_synthesizer_pool.AzureSpeechSynthesizer = FakeAzureSpeechSynthesizer
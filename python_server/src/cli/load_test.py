@@ -0,0 +1,306 @@
+"""オフライン負荷試験
+
+代替バックエンド(src.cli.fake_backends)に差し替えた状態で FastAPI アプリを起動し、
+/reply, /voice*, /hallucination に指定したレートでリクエストを送って
+スループット・レイテンシ(p50/p95/p99)・最初のバイトまでの時間・イベントループの遅延を計測する。
+
+    python -m src.cli.load_test --rate 20 --duration 30 --mix reply=1,voice=1,voice/azure=1
+
+--no-hedge を付けると外部プロバイダ呼び出しのヘッジを無効にする(ヘッジ有無でテールレイテンシを比較する)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+PYTHON_SERVER_ROOT = pathlib.Path(__file__).resolve().parent.parent.parent
+
+ENDPOINTS = [
+    "reply",
+    "voice",
+    "voice/v2",
+    "voice/azure",
+    "voice/male",
+    "voice/stream",
+    "voice/v2/stream",
+    "voice/azure/stream",
+    "voice/male/stream",
+    "hallucination",
+]
+
+
+@dataclass
+class EndpointStats:
+    """エンドポイントごとの計測結果"""
+
+    latencies: list[float] = field(default_factory=list)
+    # 本文の最初のバイトが届くまでの時間
+    ttfbs: list[float] = field(default_factory=list)
+    errors: int = 0
+
+
+def percentile(values: list[float], q: float) -> float:
+    """最近傍法でパーセンタイルを求める"""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """"reply=2,voice=1" 形式のリクエスト比率をパースする"""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint: {name} (choose from {', '.join(ENDPOINTS)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def parse_latency(value: str):
+    """"median_ms:p95_ms[:error_rate]" 形式のレイテンシ分布をパースする"""
+    from src.cli.fake_backends import LatencyProfile
+
+    parts = [float(v) for v in value.split(":")]
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(f"expected median_ms:p95_ms[:error_rate], got {value}")
+    return LatencyProfile(*parts)
+
+
+async def _monitor_loop_lag(samples: list[float], interval: float) -> None:
+    """sleep の遅れからイベントループの遅延を計測する"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+def _serve(server, lag_samples: list[float], lag_interval: float) -> None:
+    """サーバー用スレッド。アプリと同じイベントループ上で遅延を計測する"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    monitor = loop.create_task(_monitor_loop_lag(lag_samples, lag_interval))
+    try:
+        loop.run_until_complete(server.serve())
+    finally:
+        monitor.cancel()
+        loop.run_until_complete(asyncio.gather(monitor, return_exceptions=True))
+        loop.close()
+
+
+def _wait_until_ready(base_url: str, timeout: float) -> None:
+    """/ready が 200 を返すまで待つ(待ちきれない場合は警告を出してそのまま始める)"""
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = httpx.get(f"{base_url}/ready")
+        if response.status_code == 200:
+            print(f"warm-up: {response.json()['step_seconds']}")
+            return
+        time.sleep(0.2)
+    print(f"warning: the app did not become ready within {timeout}s ({response.json()['error']}); starting anyway")
+
+
+async def _send(client, endpoint: str, text: str, stats: dict[str, EndpointStats]) -> None:
+    if endpoint == "reply":
+        request = client.build_request("POST", "/reply", data={"inputtext": text})
+    elif endpoint == "hallucination":
+        request = client.build_request("POST", "/hallucination", json={"text": text})
+    else:
+        request = client.build_request("POST", f"/{endpoint}", params={"text": text})
+
+    start = time.perf_counter()
+    first_byte_at = None
+    try:
+        response = await client.send(request, stream=True)
+        try:
+            async for _ in response.aiter_raw():
+                if first_byte_at is None:
+                    first_byte_at = time.perf_counter()
+        finally:
+            await response.aclose()
+        ok = response.status_code == 200
+    except Exception:
+        ok = False
+    if ok:
+        end = time.perf_counter()
+        stats[endpoint].latencies.append(end - start)
+        stats[endpoint].ttfbs.append((first_byte_at or end) - start)
+    else:
+        stats[endpoint].errors += 1
+
+
+async def drive(base_url: str, *, rate: float, duration: float, mix: dict[str, float], texts: list[str], unique: bool, seed: int) -> tuple[dict[str, EndpointStats], float]:
+    """ポアソン到着で指定レートのリクエストを送り続ける(オープンループ)"""
+    import httpx
+
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    stats: dict[str, EndpointStats] = defaultdict(EndpointStats)
+    tasks = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        next_at = start
+        counter = 0
+        while next_at - start < duration:
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            endpoint = rng.choices(names, weights)[0]
+            text = rng.choice(texts)
+            if unique:
+                text = f"{text}({counter})"
+            counter += 1
+            tasks.append(asyncio.create_task(_send(client, endpoint, text, stats)))
+            next_at += rng.expovariate(rate)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return stats, elapsed
+
+
+def report(stats: dict[str, EndpointStats], elapsed: float, lag_samples: list[float]) -> dict:
+    """計測結果を集計する"""
+    result = {"elapsed_sec": round(elapsed, 3), "endpoints": {}}
+    all_latencies = []
+    all_ttfbs = []
+    total_errors = 0
+    for endpoint, s in sorted(stats.items()):
+        all_latencies.extend(s.latencies)
+        all_ttfbs.extend(s.ttfbs)
+        total_errors += s.errors
+        result["endpoints"][endpoint] = _summary(s.latencies, s.ttfbs, s.errors, elapsed)
+    result["total"] = _summary(all_latencies, all_ttfbs, total_errors, elapsed)
+    result["loop_lag_ms"] = {
+        "p50": round(percentile(lag_samples, 50) * 1000, 1),
+        "p99": round(percentile(lag_samples, 99) * 1000, 1),
+        "max": round(max(lag_samples, default=0.0) * 1000, 1),
+    }
+    return result
+
+
+def provider_summary() -> dict:
+    """外部プロバイダ呼び出しの結果・ヘッジの件数を /metrics のカウンタから集計する"""
+    from src.metrics import PROVIDER_CALLS, PROVIDER_HEDGES
+
+    summary: dict[str, dict[str, int]] = defaultdict(dict)
+    for metric in (PROVIDER_CALLS, PROVIDER_HEDGES):
+        for sample in metric.collect()[0].samples:
+            if sample.name.endswith("_total"):
+                key = sample.labels.get("outcome") or f"hedge_{sample.labels['result']}"
+                summary[sample.labels["provider"]][key] = int(sample.value)
+    return dict(sorted(summary.items()))
+
+
+def _summary(latencies: list[float], ttfbs: list[float], errors: int, elapsed: float) -> dict:
+    return {
+        "ok": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "ttfb_p50_ms": round(percentile(ttfbs, 50) * 1000, 1),
+        "ttfb_p95_ms": round(percentile(ttfbs, 95) * 1000, 1),
+    }
+
+
+def _print_report(result: dict) -> None:
+    print(f"\nelapsed: {result['elapsed_sec']}s")
+    print(f"{'endpoint':<18}{'ok':>7}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttfb p50':>10}{'ttfb p95':>10}")
+    rows = list(result["endpoints"].items()) + [("TOTAL", result["total"])]
+    for name, s in rows:
+        print(
+            f"{name:<18}{s['ok']:>7}{s['errors']:>6}{s['throughput_rps']:>9}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}"
+            f"{s['ttfb_p50_ms']:>10}{s['ttfb_p95_ms']:>10}"
+        )
+    lag = result["loop_lag_ms"]
+    print(f"event loop lag: p50={lag['p50']}ms p99={lag['p99']}ms max={lag['max']}ms")
+    for provider, counts in result.get("providers", {}).items():
+        print(f"provider {provider}: " + " ".join(f"{key}={value}" for key, value in sorted(counts.items())))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="代替バックエンドを使った FastAPI アプリの負荷試験")
+    parser.add_argument("--rate", type=float, default=10.0, help="目標リクエストレート(req/s)")
+    parser.add_argument("--duration", type=float, default=20.0, help="リクエストを送り続ける秒数")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("reply=1,voice=1"), help="エンドポイントの比率 (例: reply=2,voice=1,hallucination=1)")
+    parser.add_argument("--unique", action="store_true", help="質問文を毎回ユニークにする(coalescing/キャッシュを効かせない)")
+    parser.add_argument("--gemini", type=parse_latency, default="800:2500", help="Gemini のレイテンシ median_ms:p95_ms[:error_rate]")
+    parser.add_argument("--embedding", type=parse_latency, default="80:200", help="埋め込みのレイテンシ")
+    parser.add_argument("--elevenlabs", type=parse_latency, default="400:1200", help="ElevenLabs の最初のチャンクまでのレイテンシ")
+    parser.add_argument("--azure", type=parse_latency, default="300:900", help="Azure TTS のレイテンシ")
+    parser.add_argument("--no-hedge", action="store_true", help="外部プロバイダ呼び出しのヘッジを無効にする")
+    parser.add_argument("--ready-timeout", type=float, default=60.0, help="ウォームアップ完了(/ready)を待つ最大秒数")
+    parser.add_argument("--port", type=int, default=7299)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=pathlib.Path, default=None, help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    # 実サービスの API キーは不要
+    for key in ("ELEVENLABS_API_KEY", "AZURE_SPEECH_KEY", "GOOGLE_API_KEY"):
+        os.environ.setdefault(key, "fake")
+    if args.no_hedge:
+        os.environ["PROVIDER_HEDGING_ENABLED"] = "false"
+
+    # 対話ログは一時ディレクトリに書き出す
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="aituber_load_test_"))
+    (workdir / "log").mkdir()
+    os.chdir(workdir)
+    os.environ.setdefault("TRACE_EXPORTER", "file")
+    os.environ.setdefault("TRACE_FILE_PATH", str(workdir / "log" / "traces.jsonl"))
+    os.environ.setdefault("TTS_CACHE_DIR", str(workdir / "tts_cache"))
+    sys.path.insert(0, str(PYTHON_SERVER_ROOT))
+
+    from src.cli import fake_backends
+
+    fake_backends.install(
+        fake_backends.FakeBackendConfig(gemini=args.gemini, embedding=args.embedding, elevenlabs=args.elevenlabs, azure=args.azure, seed=args.seed)
+    )
+
+    import uvicorn
+
+    from src.templates import TEMPLATE_QUESTIONS
+    from src.web import api
+
+    api.log_filename_json = workdir / "log" / "load_test.json"
+    api.log_filename_csv = workdir / "log" / "load_test.csv"
+
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    lag_samples: list[float] = []
+    thread = threading.Thread(target=_serve, args=(server, lag_samples, 0.01), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    _wait_until_ready(f"http://127.0.0.1:{args.port}", args.ready_timeout)
+
+    print(f"load test: rate={args.rate}req/s duration={args.duration}s mix={args.mix} workdir={workdir}")
+    stats, elapsed = asyncio.run(
+        drive(f"http://127.0.0.1:{args.port}", rate=args.rate, duration=args.duration, mix=args.mix, texts=TEMPLATE_QUESTIONS, unique=args.unique, seed=args.seed)
+    )
+
+    server.should_exit = True
+    thread.join(timeout=10)
+
+    result = report(stats, elapsed, lag_samples)
+    result["providers"] = provider_summary()
+    _print_report(result)
+    if args.json:
+        args.json.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
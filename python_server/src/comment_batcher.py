@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+
+from src.metrics import record_cache, record_fallback
+from src.single_flight import normalize_text
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_stream_comment(comment: str) -> bool:
+    """「#」「＃」から始まるコメントは配信そのものに関するコメントとして返答対象外とする(仕様)"""
+    return not comment or comment[0] in ("#", "＃")
+
+
+class CommentBatcher:
+    """チャットコメントを短い時間窓でまとめて分類するマイクロバッチャー
+
+    window 秒経過するか max_batch_size 件たまったら、まとめて classify_batch を1回呼び出し、
+    コメントごとの Future に結果を返す。判定結果は正規化したコメント文でキャッシュする。
+    キューなどはモジュールの読み込み時ではなく、最初の分類のときに動いているイベントループで作る。
+    """
+
+    def __init__(
+        self,
+        classify_batch: Callable[[list[str]], Awaitable[list[bool]]],
+        *,
+        window: float = 0.3,
+        max_batch_size: int = 32,
+        max_inflight_batches: int = 4,
+        cache_size: int = 4096,
+    ) -> None:
+        self._classify_batch = classify_batch
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._max_inflight_batches = max_inflight_batches
+        self._cache_size = cache_size
+        self._cache: OrderedDict[str, bool] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._queue: asyncio.Queue[tuple[str, str]] | None = None
+        self._inflight: asyncio.Semaphore | None = None
+        self._worker: asyncio.Task | None = None
+        self._flushes: set[asyncio.Task] = set()
+        self.cache_hit_count = 0
+        self.batch_count = 0
+
+    async def classify(self, comment: str) -> bool:
+        """コメントが返答対象(質問・要望・応援)かどうかを返す"""
+        if is_stream_comment(comment):
+            return False
+
+        key = normalize_text(comment)
+        hit = key in self._cache
+        record_cache("comment_verdict", hit)
+        if hit:
+            self._cache.move_to_end(key)
+            self.cache_hit_count += 1
+            return self._cache[key]
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            self._ensure_worker()
+            self._queue.put_nowait((key, comment))
+        return await asyncio.shield(future)
+
+    async def filter(self, comments: list[str]) -> list[str]:
+        """返答対象のコメントのみを返す"""
+        verdicts = await asyncio.gather(*(self.classify(comment) for comment in comments))
+        return [comment for comment, verdict in zip(comments, verdicts) if verdict]
+
+    async def close(self) -> None:
+        """バッチ処理のワーカーと分類中のバッチを停止する(分類を待っている呼び出しはキャンセルされる)"""
+        tasks = [task for task in (self._worker, *self._flushes) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._worker = self._queue = self._inflight = None
+
+    def _ensure_worker(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._inflight = asyncio.Semaphore(self._max_inflight_batches)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        """キューからコメントを取り出してバッチにまとめる"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            batch_deadline = loop.time() + self._window
+            while len(batch) < self._max_batch_size:
+                timeout = batch_deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._inflight.acquire()
+            # 参照を持っておかないと、分類中のタスクがガベージコレクションされることがある
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task) -> None:
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error("コメント分類のバッチ処理に失敗", exc_info=task.exception())
+
+    async def _flush(self, batch: list[tuple[str, str]]) -> None:
+        """1バッチ分を分類して各 Future に結果を返す"""
+        try:
+            self.batch_count += 1
+            try:
+                verdicts = await self._classify_batch([comment for _, comment in batch])
+                if len(verdicts) != len(batch):
+                    raise ValueError(f"verdict count mismatch: {len(verdicts)} != {len(batch)}")
+                cacheable = True
+            except Exception as e:
+                # エラー時はすべてのコメントを通す(フォールバック)
+                LOGGER.warning(f"コメント分類エラー: {e}, returning all comments")
+                verdicts = [True] * len(batch)
+                cacheable = False
+                record_fallback("comment_filter", "pass_all")
+
+            for (key, _), verdict in zip(batch, verdicts):
+                if cacheable:
+                    self._remember(key, verdict)
+                future = self._pending.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(verdict)
+        finally:
+            self._inflight.release()
+
+    def _remember(self, key: str, verdict: bool) -> None:
+        self._cache[key] = verdict
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
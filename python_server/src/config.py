@@ -8,6 +8,9 @@ from pydantic_settings import BaseSettings
 
 load_dotenv(override=True)
 
+# PCM(WAV)で出力できるサンプルレート(ElevenLabs・Azure TTS のどちらも直接出力できる)
+PCM_SAMPLE_RATES = (16000, 22050, 24000, 44100)
+
 
 class Settings(BaseSettings):
     """Settings for python_server"""
@@ -25,6 +28,119 @@ class Settings(BaseSettings):
 
     GOOGLE_API_KEY: str  # Gemini用
 
+    # Gemini モデルルーティング
+    GEMINI_PRO_MODEL: str = "gemini-1.5-pro"
+    GEMINI_FLASH_MODEL: str = "gemini-1.5-flash"
+    MODEL_ROUTER_PRO_TIMEOUT_SEC: float = 6.0  # pro の応答期限(超えたら flash にフォールバック)
+    MODEL_ROUTER_REQUEST_BUDGET_SEC: float = 10.0  # 1回の呼び出し全体のレイテンシ予算
+    MODEL_ROUTER_SHORT_QUERY_CHARS: int = 12  # この文字数以下の質問は flash で回答する
+
+    # /reply の期限とステージごとのサブ予算(秒)
+    REPLY_DEADLINE_SEC: float = 15.0
+    REPLY_STAGE_BUDGETS: dict[str, float] = {
+        "retrieval": 3.0,
+        "selection": 3.0,
+        "qa": 2.0,
+        "generation": 7.0,
+        "hallucination": 3.0,
+    }
+    REPLY_STAGE_THREADS: int = 8  # 検索などの同期ステージを実行するスレッド数(期限切れで待つのをやめた処理も終わるまでスレッドを使う)
+
+    # プロンプトに詰める検索結果のトークン予算(ローカルでの概算値)
+    PROMPT_KNOWLEDGE_TOKEN_BUDGET: int = 1200
+    PROMPT_QA_TOKEN_BUDGET: int = 600
+    PROMPT_CANDIDATE_TOKEN_BUDGET: int = 2400  # 選択用プロンプトの候補一覧全体
+    PROMPT_CANDIDATE_DOC_TOKENS: int = 200  # 選択用プロンプトの候補1件あたり
+
+    # コメント分類のマイクロバッチ
+    COMMENT_BATCH_WINDOW_SEC: float = 0.3
+    COMMENT_BATCH_MAX_SIZE: int = 32
+
+    # 外部プロバイダ(Gemini / ElevenLabs / Azure TTS)呼び出しのヘッジ・リトライ・サーキットブレーカー
+    PROVIDER_HEDGING_ENABLED: bool = True
+    PROVIDER_HEDGE_PERCENTILE: float = 95.0  # このパーセンタイルを過ぎても応答がなければヘッジを送る
+    PROVIDER_HEDGE_MIN_SAMPLES: int = 20  # レイテンシのサンプルがこれ未満の間はヘッジしない
+    PROVIDER_HEDGE_BUDGET_RATIO: float = 0.1  # ヘッジは呼び出し数のこの割合まで
+    PROVIDER_MAX_ATTEMPTS: int = 3
+    PROVIDER_RETRY_BASE_DELAY_SEC: float = 0.2
+    PROVIDER_RETRY_MAX_DELAY_SEC: float = 2.0
+    PROVIDER_CIRCUIT_FAILURE_THRESHOLD: int = 5  # この回数連続で失敗したら呼び出しを止める
+    PROVIDER_CIRCUIT_RESET_SEC: float = 30.0  # 止めてから試行を再開するまでの秒数
+
+    # Azure TTS の synthesizer プール(合成パラメータごとの同時合成数と、SDK を呼び出すスレッド数)
+    AZURE_TTS_POOL_SIZE: int = 4
+    AZURE_TTS_POOL_THREADS: int = 8
+    AZURE_TTS_MAX_CONCURRENCY: int = 8  # 合成パラメータによらない全体の同時合成数
+
+    # ElevenLabs への接続(アプリ全体で1つの接続プールを共有する)
+    ELEVENLABS_HTTP2: bool = True  # h2 がインストールされていなければ HTTP/1.1 で接続する
+    ELEVENLABS_MAX_CONNECTIONS: int = 10
+    ELEVENLABS_KEEPALIVE_EXPIRY_SEC: float = 120.0  # 使っていない接続を閉じるまでの秒数
+    ELEVENLABS_MAX_CONCURRENCY: int = 10  # 同時リクエスト数(ストリーミングは読み終えるまで数える。契約プランの上限に合わせる)
+    ELEVENLABS_TIMEOUT_SEC: float = 60.0
+
+    # 起動時のウォームアップ(完了するまで /ready は 503 を返す)
+    WARMUP_ENABLED: bool = True
+    WARMUP_QUERY: str = "Nittoの事業内容を教えてください"  # ウォームアップで流す合成クエリ
+    WARMUP_TTS_TEXT: str = "こんにちは"  # 空文字の場合は音声合成のウォームアップを省略する
+    WARMUP_RETRY_INTERVAL_SEC: float = 10.0  # ウォームアップが失敗した場合の再試行間隔
+    WARMUP_TTS_MAX_ATTEMPTS: int = 3  # 音声合成プロバイダごとのウォームアップの最大試行回数(超えたらそのプロバイダは failed のまま ready にする)
+
+    # テンプレートメッセージ・質問の事前生成パック(python -m src.cli.build_template_pack で作る)
+    TEMPLATE_PACK_DIR: pathlib.Path = PYTHON_SERVER_ROOT / "template_pack"
+    TEMPLATE_PACK_VOICES: list[str] = ["voice", "voice/azure"]
+
+    # /voice* の音声出力(format クエリ・Accept ヘッダーで指定がなければこのサンプルレートの WAV。16000 / 22050 / 24000 / 44100)
+    TTS_SAMPLE_RATE: int = 44100
+    # プロバイダが直接出力できない圧縮形式への変換に使う ffmpeg(なければその形式は 406 を返す)
+    TTS_FFMPEG_PATH: str = "ffmpeg"
+
+    # /voice* の PCM の後処理(エンドポイントごとに "trim": 前後の無音の除去, "peak" / "loudness": 音量の正規化)
+    # ストリーミングでは先頭の無音のみ落とす。プロバイダが直接出力した圧縮形式には行わない
+    TTS_POSTPROCESS: dict[str, list[str]] = {
+        "voice": ["trim"],
+        "voice/v2": ["trim"],
+        "voice/azure": ["trim"],
+        "voice/male": ["trim"],
+    }
+    TTS_SILENCE_THRESHOLD_DBFS: float = -50.0  # 10ms ごとの RMS がこれ未満なら無音
+    TTS_SILENCE_PADDING_MS: int = 100  # 無音を落とした後も声の前後に残す長さ
+    TTS_PEAK_DBFS: float = -1.0  # "peak" で揃える最大振幅(どちらの正規化でもこれを超えないようにする)
+    TTS_LOUDNESS_DBFS: float = -20.0  # "loudness" で揃える声の部分の RMS
+
+    # 音声合成結果のディスクキャッシュ(テキストと合成パラメータのハッシュで引く。容量を超えたら古いものから消す)
+    TTS_CACHE_ENABLED: bool = True
+    TTS_CACHE_DIR: pathlib.Path = PYTHON_SERVER_ROOT / "tts_cache"
+    TTS_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+
+    # /reply の回答キャッシュに置いておく秒数(ナレッジ・QA の CSV や索引を更新したら、この時間内に古い回答が消える)
+    REPLY_CACHE_TTL_SEC: float = 600.0
+
+    # /reply の voice で先行して合成した音声(GET /voice/handle/{audio_id} で取得する)を置いておく件数・合計サイズ・合成後に保持する秒数
+    AUDIO_HANDLE_MAX_ENTRIES: int = 64
+    AUDIO_HANDLE_MAX_BYTES: int = 64 * 1024 * 1024
+    AUDIO_HANDLE_TTL_SEC: float = 300.0
+
+    # WebSocket /session の接続ごとの上限(同時に処理する質問の数・送信待ちの合計サイズ)と、1メッセージの送信を待つ秒数(超えたら切断する)
+    SESSION_MAX_INFLIGHT: int = 2
+    SESSION_SEND_BUFFER_BYTES: int = 1024 * 1024
+    SESSION_SEND_TIMEOUT_SEC: float = 30.0
+    SESSION_CONTROL_BUFFER_BYTES: int = 64 * 1024  # エラー・テンプレート・取り消しの応答は送信バッファが一杯でも待たずにここまで溜める(超えたら切断する)
+
+    # /voice*/stream の文単位のパイプライン合成(複数の文を並行して合成し、文の順に返す)と、バックエンドごとの同時合成数
+    TTS_PIPELINE_ENABLED: bool = True
+    TTS_PIPELINE_CONCURRENCY: dict[str, int] = {
+        "elevenlabs": 3,
+        "azure": 4,
+    }
+
+    # リクエストトレースの出力先("file": OTLP/JSON Lines ファイル, "otlp": OTLP/HTTP コレクタ, "none": 出力しない)
+    # "file" はローテーションしないので、調査のときだけ有効にする
+    TRACE_EXPORTER: str = "none"
+    TRACE_FILE_PATH: pathlib.Path = PYTHON_SERVER_ROOT / "log" / "traces.jsonl"
+    TRACE_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"
+    TRACE_SERVICE_NAME: str = "aituber-python-server"
+
     # Database configuration
     DATABASE_TYPE: str = "postgresql"  # "postgresql" or "sqlite"
     PG_HOST: str = "localhost"
@@ -43,5 +159,12 @@ class Settings(BaseSettings):
 
     LOCAL_TZ: ZoneInfo = ZoneInfo("Asia/Tokyo")
 
+    @field_validator("TTS_SAMPLE_RATE")
+    @classmethod
+    def check_tts_sample_rate(cls, value: int) -> int:
+        if value not in PCM_SAMPLE_RATES:
+            raise ValueError(f"TTS_SAMPLE_RATE must be one of {', '.join(map(str, PCM_SAMPLE_RATES))}")
+        return value
+
 
 settings = Settings()
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypeVar
+
+from src.config import settings
+from src.metrics import record_fallback
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 残り予算がこれ未満のステージは実行せずに縮退させる
+MIN_STAGE_BUDGET_SEC = 0.3
+
+# run_sync で同期関数を実行するスレッド
+# スレッドで動き始めた処理は期限切れで待つのをやめても止められず最後まで走るので、専用のプールで同時に走る数を抑える
+# (空きを待つ間に期限が切れたものは実行せずに縮退させる)
+_executor = ThreadPoolExecutor(max_workers=settings.REPLY_STAGE_THREADS, thread_name_prefix="deadline")
+
+
+class DeadlineExceeded(TimeoutError):
+    """ステージの予算内に処理が終わらなかった"""
+
+
+class Deadline:
+    """1リクエスト全体の期限
+
+    各ステージには stage_budgets のサブ予算(ただし全体の残り時間が上限)を割り当てる。
+    予算切れ・エラーで縮退したステージは degradations に記録し、対話ログに残す。
+    """
+
+    def __init__(self, budget: float, stage_budgets: dict[str, float] | None = None) -> None:
+        self.budget = budget
+        self.stage_budgets = dict(stage_budgets or {})
+        self.degradations: list[str] = []
+        self._expires_at = time.monotonic() + budget
+
+    @classmethod
+    def for_reply(cls) -> "Deadline":
+        """/reply 用の期限を設定値から作る"""
+        return cls(settings.REPLY_DEADLINE_SEC, settings.REPLY_STAGE_BUDGETS)
+
+    def remaining(self) -> float:
+        """全体の残り時間(秒)"""
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """全体の期限を過ぎているかどうか"""
+        return self.remaining() <= 0
+
+    def stage_budget(self, stage: str) -> float:
+        """ステージに使える時間(秒)"""
+        remaining = self.remaining()
+        return min(self.stage_budgets.get(stage, remaining), remaining)
+
+    async def run(self, stage: str, awaitable: Awaitable[T]) -> T:
+        """ステージの予算内で awaitable を実行する(超えたら DeadlineExceeded)"""
+        budget = self.stage_budget(stage)
+        if budget < MIN_STAGE_BUDGET_SEC:
+            # 実行しない coroutine の警告を避ける
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise DeadlineExceeded(f"{stage}: no budget left ({budget:.2f}s)")
+        try:
+            return await asyncio.wait_for(awaitable, timeout=budget)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"{stage}: exceeded {budget:.2f}s") from None
+
+    async def run_sync(self, stage: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """同期関数をスレッドで実行し、ステージの予算内で結果を待つ
+
+        期限切れで DeadlineExceeded を送出した後も、動き始めていた func はスレッドで最後まで実行される(結果は捨てる)
+        """
+
+        async def in_thread() -> T:
+            # asyncio.to_thread と同じく、トレースの Span などのコンテキストをスレッドに引き継ぐ
+            call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(_executor, call)
+
+        # 予算が残っていなければスレッドに渡さない
+        return await self.run(stage, in_thread())
+
+    def degrade(self, stage: str, fallback: str) -> None:
+        """縮退を記録する"""
+        LOGGER.warning(f"縮退: stage={stage} -> {fallback} (remaining={self.remaining():.2f}s)")
+        self.degradations.append(f"{stage}:{fallback}")
+        record_fallback(stage, fallback)
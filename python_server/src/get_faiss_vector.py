@@ -1,33 +1,25 @@
 import functools
 import json
 import logging
-import os
 import re
 
-import google.generativeai as genai
 # import MeCab  # 簡素化のためコメントアウト
-import pandas as pd
-from langchain.retrievers.ensemble import EnsembleRetriever
-from langchain.schema.document import Document
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.retrievers import BM25Retriever
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-
+from src import lazy_imports as lazy
 from src.config import settings
+from src.metrics import STAGE_BM25, STAGE_FAISS, STAGE_FAISS_LOAD, record_fallback, stage_timer
+from src.model_router import CALL_SITE_SELECTION, model_router
+from src.prompt_assembler import pack_context
+from src.tracing import current_span, traced
 
 LOGGER = logging.getLogger(__name__)
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-os.environ["GOOGLE_API_KEY"] = settings.GOOGLE_API_KEY
-
 
 @functools.lru_cache(maxsize=1)
 def _create_bm25_knowledge_db():
     knowledge_file_path = settings.PYTHON_SERVER_ROOT / "faiss_knowledge" / "2025_all_knowledge.csv"
 
     docs = []
-    manifests = pd.read_csv(knowledge_file_path, encoding='utf-8-sig')
+    manifests = lazy.pd.read_csv(knowledge_file_path, encoding='utf-8-sig')
     for i, row in enumerate(manifests.to_dict(orient="records")):
         title = row.pop("title")
         text = row.pop("text")
@@ -36,15 +28,15 @@ def _create_bm25_knowledge_db():
         metadata["row"] = i
         metadata["image"] = filename
         page_content = f"Title: {title}\n {text}"
-        docs.append(Document(page_content=page_content, metadata=metadata))
+        docs.append(lazy.Document(page_content=page_content, metadata=metadata))
 
-    text_splitter = CharacterTextSplitter(
+    text_splitter = lazy.CharacterTextSplitter(
         separator="\n",  # セパレータ
         chunk_size=300,  # チャンクの文字数
         chunk_overlap=0,  # チャンクオーバーラップの文字数
     )
     documents = text_splitter.split_documents(docs)
-    bm25_search = BM25Retriever.from_documents(documents, preprocess_func=preprocess)
+    bm25_search = lazy.BM25Retriever.from_documents(documents, preprocess_func=preprocess)
     return bm25_search
 
 
@@ -85,43 +77,81 @@ def preprocess(text):
     return " ".join(token_list)
 
 
+def preload_indices():
+    """BM25 / FAISS の index を読み込んでおく(起動時のウォームアップ用)"""
+    _create_bm25_knowledge_db()
+    _load_faiss(settings.FAISS_KNOWLEDGE_DB_DIR)
+    _load_faiss(settings.FAISS_QA_DB_DIR)
+
+
+def _bm25_retriever(top_k):
+    """共有の BM25Retriever から k だけ差し替えた浅いコピーを返す
+
+    lru_cache で共有しているインスタンスの k を書き換えると、並行する検索同士で
+    top_k が入れ替わってしまうため、呼び出しごとにコピーを作る(索引本体は共有のまま)。
+    """
+    return _create_bm25_knowledge_db().copy(update={"k": top_k})
+
+
 def get_bm25_knowledge(query, top_k=5):
     """bm25での検索"""
-    bm25_retriever = _create_bm25_knowledge_db()
-    bm25_retriever.k = top_k
+    bm25_retriever = _bm25_retriever(top_k)
     context_docs = bm25_retriever.invoke(query)
     print(f"len={len(context_docs)}")
     top_docs = context_docs[:top_k]
     return [(doc.page_content, doc.metadata) for doc in top_docs]
 
 
+@functools.lru_cache(maxsize=None)
+def _load_faiss(db_dir):
+    """FAISS の index を読み込む(プロセス内で1回だけ読み込み、以降は共有する)"""
+    from src.retrieval_stages import TimedEmbeddings
+
+    embeddings = TimedEmbeddings(lazy.GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=settings.GOOGLE_API_KEY))
+    with stage_timer(STAGE_FAISS_LOAD):
+        return lazy.FAISS.load_local(
+            db_dir,
+            embeddings,
+            allow_dangerous_deserialization=True,
+        )
+
+
+def _search_faiss(vector, query, k=4):
+    """FAISS 検索を計測しながら検索する(クエリの埋め込みは TimedEmbeddings が embedding ステージとして別にも記録する)"""
+    with stage_timer(STAGE_FAISS):
+        return vector.similarity_search(query, k=k)
+
+
+@traced("get_hybrid_knowledge")
 def get_hybrid_knowledge(query, top_k=5):
     """ハイブリッド検索（業績・財務重視）"""
-    bm25_retriever = _create_bm25_knowledge_db()
-    bm25_retriever.k = top_k
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
+    current_span().set_attributes(top_k=top_k, query_chars=len(query))
+    bm25_retriever = _bm25_retriever(top_k)
+    vector = _load_faiss(settings.FAISS_KNOWLEDGE_DB_DIR)
     faiss_retriever = vector.as_retriever(search_kwargs={"k": top_k})
     
     # 事業内容関連キーワードで事業説明スライドを優先
     business_keywords = ["事業", "事業内容", "ビジネス", "何をしている", "会社概要", "概要"]
     if any(keyword in query for keyword in business_keywords):
         # 事業内容関連はBM25（キーワード検索）を重視し、slide_1を優先
-        ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.8, 0.2])
+        ensemble_retriever = lazy.EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.8, 0.2])
     # 業績・財務関連キーワードで重み調整
     elif any(keyword in query for keyword in ["売上", "業績", "収益", "営業利益", "セグメント", "2024年度", "決算"]):
         # 業績関連はBM25（キーワード検索）を重視
-        ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.7, 0.3])
+        ensemble_retriever = lazy.EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.7, 0.3])
     else:
         # 通常はバランス型
-        ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.5, 0.5])
+        ensemble_retriever = lazy.EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.5, 0.5])
     
-    context_docs = ensemble_retriever.invoke(query)
+    # BM25 / FAISS / 融合の時間はコールバックでステージごとに記録する
+    from src.retrieval_stages import EnsembleStageRecorder
+
+    recorder = EnsembleStageRecorder([STAGE_BM25, STAGE_FAISS])
+    context_docs = ensemble_retriever.invoke(query, config={"callbacks": [recorder]})
     print(f"len={len(context_docs)}")
+    current_span().set_attributes(
+        bm25_count=recorder.counts.get(STAGE_BM25, 0), faiss_count=recorder.counts.get(STAGE_FAISS, 0), candidate_count=len(context_docs)
+    )
     
     # 事業内容関連クエリの場合はslide_1を最優先
     if any(keyword in query for keyword in business_keywords):
@@ -183,18 +213,12 @@ def get_qa(query):
     return result[0]
 
 
+@traced("get_multiple_qa")
 def get_multiple_qa(*, query, top_k=5):
     """回答例を取得する"""
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_QA_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
-
-    retriever = vector.as_retriever()
+    vector = _load_faiss(settings.FAISS_QA_DB_DIR)
 
-    context_docs = retriever.invoke(query)
+    context_docs = _search_faiss(vector, query)
     print(f"len={len(context_docs)}")
 
     top_docs = context_docs[:top_k]
@@ -209,16 +233,9 @@ def get_knowledge(query):
 
 def get_multiple_knowledge(*, query, top_k=10):
     """RAGナレッジを取得する"""
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
-
-    retriever = vector.as_retriever(search_kwargs={"k": top_k})
+    vector = _load_faiss(settings.FAISS_KNOWLEDGE_DB_DIR)
 
-    context_docs = retriever.invoke(query)
+    context_docs = _search_faiss(vector, query, k=top_k)
     print(f"len={len(context_docs)}")
 
     top_docs = context_docs[:top_k]
@@ -230,16 +247,35 @@ def get_multiple_knowledge(*, query, top_k=10):
 DEFAULT_FALLBACK_KNOWLEDGE_METADATA = {"row": 0, "image": "nitto_PDF/slide_1.png"}
 
 
+@traced("get_best_knowledge_with_gemini_selection")
 async def get_best_knowledge_with_gemini_selection(query, top_k=15):
     """Geminiを使った高精度スライド選択"""
     # 広範囲での検索
     top_docs = get_hybrid_knowledge(query=query, top_k=top_k)
+    current_span().set_attributes(top_k=top_k, candidate_count=len(top_docs))
+    try:
+        return await select_knowledge_with_gemini(query, top_docs)
+    except TimeoutError as e:
+        LOGGER.warning(f"Geminiスライド選択タイムアウト: {e}")
+        record_fallback("selection", "top_hybrid_hit")
+        return top_docs[0]
+
+
+@traced("select_knowledge_with_gemini")
+async def select_knowledge_with_gemini(query, top_docs, *, budget=None):
+    """ハイブリッド検索の候補から Gemini で最適なスライドを1つ選ぶ
+
+    予算内に選択できなかった場合は TimeoutError を送出する(呼び出し元で先頭候補に縮退させる)
+    """
     if not top_docs:
         return "該当する知識は存在しません。", DEFAULT_FALLBACK_KNOWLEDGE_METADATA
-    
+    top_docs, packed_texts = _pack_candidates(top_docs)
+    top_k = len(top_docs)
+    current_span().set_attribute("candidate_count", top_k)
+
     docs = ""
-    for idx, (doc, metadata) in enumerate(top_docs, 1):
-        docs += f"[スライド {idx}] ファイル: {metadata.get('image', 'unknown')}\n内容: {doc[:200]}...\n\n"
+    for idx, ((doc, metadata), text) in enumerate(zip(top_docs, packed_texts), 1):
+        docs += f"[スライド {idx}] ファイル: {metadata.get('image', 'unknown')}\n内容: {text}...\n\n"
 
     system_prompt = f"""以下の質問に最も適切に回答できるスライドを1つ選択してください。
 
@@ -259,9 +295,7 @@ async def get_best_knowledge_with_gemini_selection(query, top_k=15):
 最も適切なスライド番号(1-{top_k})のみを回答してください。該当なしの場合は0を回答。"""
 
     try:
-        model = genai.GenerativeModel("gemini-1.5-pro")
-        response = model.generate_content(system_prompt)
-        result = response.text.strip()
+        result = (await model_router.generate(CALL_SITE_SELECTION, system_prompt, query=query, budget=budget)).strip()
         
         import re
         number_match = re.search(r'\d+', result)
@@ -269,6 +303,7 @@ async def get_best_knowledge_with_gemini_selection(query, top_k=15):
             selected_num = int(number_match.group())
             if 1 <= selected_num <= len(top_docs):
                 selected_doc = top_docs[selected_num - 1]
+                current_span().set_attributes(selected_index=selected_num, selected_image=selected_doc[1].get("image", "unknown"))
                 LOGGER.info(f"Gemini選択: スライド{selected_num} - {selected_doc[1].get('image', 'unknown')}")
                 return selected_doc
             else:
@@ -276,20 +311,38 @@ async def get_best_knowledge_with_gemini_selection(query, top_k=15):
         else:
             LOGGER.warning(f"Gemini応答解析失敗: {result}")
             
+    except TimeoutError:
+        raise
     except Exception as e:
         LOGGER.warning(f"Geminiスライド選択エラー: {e}")
     
     # フォールバック: 最初の候補を返す
+    record_fallback("selection", "top_hybrid_hit")
     return top_docs[0]
 
+
+def _pack_candidates(top_docs):
+    """選択用プロンプトに載せる候補を重複除去し、トークン予算内に切り詰める
+
+    戻り値は (残った候補, プロンプトに載せるテキスト)
+    """
+    packed = pack_context(
+        [doc for doc, _ in top_docs],
+        settings.PROMPT_CANDIDATE_TOKEN_BUDGET,
+        per_chunk_budget=settings.PROMPT_CANDIDATE_DOC_TOKENS,
+    )
+    return [top_docs[i] for i, _ in packed], [text for _, text in packed]
+
 async def get_best_knowledge(query, top_k=15):
     """RAGナレッジを取得した上でLLMで評価する"""
     top_docs = get_multiple_knowledge(query=query, top_k=top_k)
+    top_docs, packed_texts = _pack_candidates(top_docs)
+    top_k = len(top_docs)
     docs = ""
-    for idx, (doc, metadata) in enumerate(top_docs, 1):
+    for idx, ((doc, metadata), text) in enumerate(zip(top_docs, packed_texts), 1):
         print(f"metadata={metadata}")
         print(doc)
-        docs += f"[ドキュメント id={idx}]\n{doc}\n\n"
+        docs += f"[ドキュメント id={idx}]\n{text}\n\n"
 
     system_prompt = f"""
 以下のドキュメントの中から最も入力に関連のある1から{top_k}までのドキュメントのidを答えてください。
@@ -306,9 +359,7 @@ async def get_best_knowledge(query, top_k=15):
 
 """
     LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = model.generate_content(system_prompt)
-    reply = response.text
+    reply = await model_router.generate(CALL_SITE_SELECTION, system_prompt, query=query, generation_config={"response_mime_type": "application/json"})
 
     LOGGER.warning("AI response: %s", reply)
     LOGGER.warning("文書数: %s", len(top_docs))
@@ -340,12 +391,7 @@ async def get_best_knowledge(query, top_k=15):
 async def get_best_knowledge_with_score(query):
     """RAGナレッジを一つ、類似度とともに取得する"""
     LOGGER.debug("Get the best knowledge with score. Query=%s", query)
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
+    vector = _load_faiss(settings.FAISS_KNOWLEDGE_DB_DIR)
 
     docs_and_scores = await vector.asimilarity_search_with_relevance_scores(query=query, k=1)
     doc, score = docs_and_scores[0]
@@ -356,11 +402,13 @@ async def get_best_knowledge_with_score(query):
 async def get_n_best_knowledge(query, top_k=5, top_n=5):
     """RAGナレッジを取得した上でLLMで評価し、最大top_n個を返す"""
     top_docs = get_hybrid_knowledge(query=query, top_k=top_k)
+    top_docs, packed_texts = _pack_candidates(top_docs)
+    top_k = len(top_docs)
     docs = ""
-    for idx, (doc, metadata) in enumerate(top_docs, 1):
+    for idx, ((doc, metadata), text) in enumerate(zip(top_docs, packed_texts), 1):
         print(f"metadata={metadata}")
         print(doc)
-        docs += f"[ドキュメント id={idx}]\n{doc}\n\n"
+        docs += f"[ドキュメント id={idx}]\n{text}\n\n"
 
     system_prompt = f"""
 質問と、その質問に対して関連性が高いと判定された{top_k}件のドキュメントを与えるので、その中から関連度の高い{top_n}件のドキュメントのidをjsonで出力して下さい。
@@ -385,9 +433,7 @@ async def get_n_best_knowledge(query, top_k=5, top_n=5):
 
 """
     LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = model.generate_content(system_prompt)
-    reply = response.text
+    reply = await model_router.generate(CALL_SITE_SELECTION, system_prompt, query=query, generation_config={"response_mime_type": "application/json"})
 
     try:
         obj = json.loads(reply)
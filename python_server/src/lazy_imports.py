@@ -0,0 +1,85 @@
+"""重い依存ライブラリの遅延 import
+
+langchain / google.generativeai / ElevenLabs / Azure Speech SDK / janome / pandas は import だけで数秒かかるため、
+モジュールの属性として初めて参照したときに import する(サーバー・リロード・CLI の起動を速くする)。
+
+    from src import lazy_imports as lazy
+
+    store = lazy.FAISS.load_local(...)
+"""
+
+import importlib
+import threading
+from typing import TYPE_CHECKING, Any
+
+from src.config import settings
+
+if TYPE_CHECKING:
+    import azure.cognitiveservices.speech as speechsdk
+    import google.generativeai as genai
+    import numpy as np
+    import pandas as pd
+    from elevenlabs import VoiceSettings
+    from elevenlabs.client import AsyncElevenLabs
+    from google.api_core import exceptions as google_exceptions
+    from janome.tokenizer import Tokenizer
+    from langchain.retrievers.ensemble import EnsembleRetriever
+    from langchain.schema.document import Document
+    from langchain.text_splitter import CharacterTextSplitter
+    from langchain_community.retrievers import BM25Retriever
+    from langchain_community.vectorstores import FAISS
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+# 属性名 -> (モジュール, モジュール内の名前。None ならモジュールそのもの)
+_LAZY_ATTRIBUTES: dict[str, tuple[str, str | None]] = {
+    "genai": ("google.generativeai", None),
+    "google_exceptions": ("google.api_core.exceptions", None),
+    "pd": ("pandas", None),
+    "np": ("numpy", None),
+    "Document": ("langchain.schema.document", "Document"),
+    "CharacterTextSplitter": ("langchain.text_splitter", "CharacterTextSplitter"),
+    "EnsembleRetriever": ("langchain.retrievers.ensemble", "EnsembleRetriever"),
+    "BM25Retriever": ("langchain_community.retrievers", "BM25Retriever"),
+    "FAISS": ("langchain_community.vectorstores", "FAISS"),
+    "GoogleGenerativeAIEmbeddings": ("langchain_google_genai", "GoogleGenerativeAIEmbeddings"),
+    "VoiceSettings": ("elevenlabs", "VoiceSettings"),
+    "AsyncElevenLabs": ("elevenlabs.client", "AsyncElevenLabs"),
+    "speechsdk": ("azure.cognitiveservices.speech", None),
+    "Tokenizer": ("janome.tokenizer", "Tokenizer"),
+}
+
+_lock = threading.Lock()
+
+
+def _configure_genai(module: Any) -> None:
+    module.configure(api_key=settings.GOOGLE_API_KEY)
+
+
+# import 直後に1回だけ行う初期化
+_ON_IMPORT = {
+    "genai": _configure_genai,
+}
+
+
+def __getattr__(name: str) -> Any:
+    try:
+        module_name, attribute = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+
+    with _lock:
+        # 待っている間に別スレッドが import を済ませていればそれを返す
+        if name in globals():
+            return globals()[name]
+        value = importlib.import_module(module_name)
+        if attribute is not None:
+            value = getattr(value, attribute)
+        if name in _ON_IMPORT:
+            _ON_IMPORT[name](value)
+        # 2回目以降は通常の属性参照になる(差し替えたい場合も setattr すればよい)
+        globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
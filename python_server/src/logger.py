@@ -26,6 +26,8 @@ class JsonFormatter(logging.Formatter):
             "question": record.question,
             "response": record.response,
             "latency": record.latency,
+            # degradation を付けずに出力された対話ログにも対応する
+            "degradation": getattr(record, "degradation", ""),
         }
         return json.dumps(log_entry, ensure_ascii=False)
 
@@ -47,6 +49,7 @@ class CsvFormatter(logging.Formatter):
             record.question,
             record.response,
             record.latency,
+            getattr(record, "degradation", ""),
         ]
 
         csv_writer.writerow(log_entry)
@@ -64,6 +67,7 @@ class GPTLogRecord(logging.LogRecord):
     question: str
     response: str
     latency: float
+    degradation: str
 
 
 class BaseGPTLogRecordTimedRotatingFileHandler(TimedRotatingFileHandler):
@@ -134,6 +138,7 @@ class GPTLogRecordCSVTimedRotatingFileHandler(BaseGPTLogRecordTimedRotatingFileH
         "question",
         "response",
         "latency",
+        "degradation",
     ]
 
     def custom_rotator(self, source: str, dest: str) -> None:
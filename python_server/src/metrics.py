@@ -0,0 +1,200 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from src.tracing import span
+
+# ステージ名(/metrics の stage ラベル)
+# Gemini の呼び出し(selection / generation / hallucination / comment_filter)は model_router の呼び出し箇所名をステージ名にする
+STAGE_NG_CHECK = "ng_check"
+STAGE_EMBEDDING = "embedding"
+STAGE_BM25 = "bm25"
+STAGE_FAISS_LOAD = "faiss_load"
+STAGE_FAISS = "faiss"  # クエリの埋め込み(embedding)を含む
+STAGE_FUSION = "fusion"
+STAGE_LOGGING = "logging"
+STAGE_AZURE_POOL_WAIT = "azure_pool_wait"
+STAGE_AZURE_SYNTHESIS = "azure_synthesis"
+STAGE_ELEVENLABS_SLOT_WAIT = "elevenlabs_slot_wait"
+STAGE_ELEVENLABS_STREAM = "elevenlabs_stream"
+STAGE_TTS_FIRST_CHUNK = "tts_first_chunk"
+STAGE_READING = "reading"
+STAGE_WAV_ASSEMBLY = "wav_assembly"
+STAGE_TRANSCODE = "transcode"
+STAGE_POSTPROCESS = "postprocess"
+STAGE_REPLY = "reply"
+
+# NG判定・WAV組み立てのような µs〜ms の処理から、Gemini 呼び出しのような秒単位の処理までを1つのバケットで扱う
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0)
+
+STAGE_LATENCY = Histogram(
+    "aituber_stage_latency_seconds",
+    "Latency of each stage of the reply / voice pipelines",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "aituber_stage_errors_total",
+    "Number of stage executions that raised an exception",
+    ["stage"],
+)
+CACHE_REQUESTS = Counter(
+    "aituber_cache_requests_total",
+    "Cache lookups by cache and result (hit / miss)",
+    ["cache", "result"],
+)
+FALLBACKS = Counter(
+    "aituber_fallbacks_total",
+    "Number of times a stage degraded to a fallback",
+    ["stage", "fallback"],
+)
+COALESCED_REQUESTS = Counter(
+    "aituber_single_flight_requests_total",
+    "Requests handled by single-flight, by whether they executed or joined an in-flight call",
+    ["flight", "result"],
+)
+PROVIDER_CALLS = Counter(
+    "aituber_provider_calls_total",
+    "External provider calls by outcome (ok / retry / error / circuit_open)",
+    ["provider", "outcome"],
+)
+PROVIDER_HEDGES = Counter(
+    "aituber_provider_hedges_total",
+    "Hedged duplicate provider calls sent, and how many of them answered first",
+    ["provider", "result"],
+)
+PROVIDER_CIRCUIT_STATE = Gauge(
+    "aituber_provider_circuit_state",
+    "Circuit breaker state per provider (0=closed, 1=open, 2=half_open)",
+    ["provider"],
+)
+_CIRCUIT_STATE_VALUES = {"closed": 0, "open": 1, "half_open": 2}
+
+AUDIO_CACHE_BYTES = Gauge(
+    "aituber_audio_cache_bytes",
+    "Total size of the synthesized audio stored in the on-disk cache",
+)
+AUDIO_CACHE_EVICTIONS = Counter(
+    "aituber_audio_cache_evictions_total",
+    "Number of audio files evicted from the on-disk cache to stay under the byte budget",
+)
+AUDIO_HANDLES = Gauge(
+    "aituber_audio_handles",
+    "Reply audio synthesized ahead of /voice/handle requests by state (pending / done)",
+    ["state"],
+)
+AUDIO_HANDLE_EVICTIONS = Counter(
+    "aituber_audio_handle_evictions_total",
+    "Number of pre-synthesized reply audio handles dropped by reason (expired / capacity)",
+    ["reason"],
+)
+SESSIONS = Gauge(
+    "aituber_sessions",
+    "Open WebSocket /session connections",
+)
+SESSION_SLOW_DISCONNECTS = Counter(
+    "aituber_session_slow_disconnects_total",
+    "WebSocket /session connections closed because the client did not read within the send timeout",
+)
+AZURE_SYNTHESIZERS = Gauge(
+    "aituber_azure_synthesizers",
+    "Pooled Azure speech synthesizers per (voice, pitch, rate) by state (idle / in_use)",
+    ["pool", "state"],
+)
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """with ブロックの処理時間をステージのヒストグラムに記録する(例外時はエラーも数える)
+
+    リクエストのトレース中であれば、同じ名前の Span としても記録する
+    """
+    start = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+def record_stage(stage: str, seconds: float, *, error: bool = False) -> None:
+    """計測済みの処理時間をステージのヒストグラムに記録する(with ブロックで囲めない async generator などで使う)"""
+    if error:
+        STAGE_ERRORS.labels(stage).inc()
+    STAGE_LATENCY.labels(stage).observe(seconds)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """キャッシュのヒット/ミスを数える"""
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_single_flight(flight: str, coalesced: bool) -> None:
+    """single-flight で実行したか相乗りしたかを数える"""
+    COALESCED_REQUESTS.labels(flight, "coalesced" if coalesced else "executed").inc()
+
+
+def record_fallback(stage: str, fallback: str) -> None:
+    """縮退・フォールバックを数える"""
+    FALLBACKS.labels(stage, fallback).inc()
+
+
+def record_provider_call(provider: str, outcome: str) -> None:
+    """外部プロバイダ呼び出しの結果を数える"""
+    PROVIDER_CALLS.labels(provider, outcome).inc()
+
+
+def record_hedge(provider: str, result: str) -> None:
+    """ヘッジの送信・勝ちを数える"""
+    PROVIDER_HEDGES.labels(provider, result).inc()
+
+
+def record_circuit_state(provider: str, state: str) -> None:
+    """サーキットブレーカーの状態を記録する"""
+    PROVIDER_CIRCUIT_STATE.labels(provider).set(_CIRCUIT_STATE_VALUES[state])
+
+
+def record_audio_cache(total_bytes: int, evicted: int = 0) -> None:
+    """音声キャッシュの使用量と追い出した件数を記録する"""
+    AUDIO_CACHE_BYTES.set(total_bytes)
+    if evicted:
+        AUDIO_CACHE_EVICTIONS.inc(evicted)
+
+
+def record_audio_handles(*, pending: int, done: int, expired: int = 0, evicted: int = 0) -> None:
+    """先行合成した音声の件数と、期限切れ・容量超過で追い出した件数を記録する"""
+    AUDIO_HANDLES.labels("pending").set(pending)
+    AUDIO_HANDLES.labels("done").set(done)
+    if expired:
+        AUDIO_HANDLE_EVICTIONS.labels("expired").inc(expired)
+    if evicted:
+        AUDIO_HANDLE_EVICTIONS.labels("capacity").inc(evicted)
+
+
+def record_session(opened: bool) -> None:
+    """WebSocket /session の接続・切断を記録する"""
+    if opened:
+        SESSIONS.inc()
+    else:
+        SESSIONS.dec()
+
+
+def record_session_slow_disconnect() -> None:
+    """送信が詰まった WebSocket /session を切断したことを数える"""
+    SESSION_SLOW_DISCONNECTS.inc()
+
+
+def record_azure_pool(pool: str, *, idle: int, in_use: int) -> None:
+    """Azure synthesizer プールの空き・使用中の数を記録する"""
+    AZURE_SYNTHESIZERS.labels(pool, "idle").set(idle)
+    AZURE_SYNTHESIZERS.labels(pool, "in_use").set(in_use)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Prometheus のテキスト形式で (本文, Content-Type) を返す"""
+    return generate_latest(), CONTENT_TYPE_LATEST
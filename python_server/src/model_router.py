@@ -0,0 +1,207 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import structlog
+
+from src import lazy_imports as lazy
+from src.config import settings
+from src.metrics import record_fallback, stage_timer
+from src.prompt_assembler import count_tokens
+from src.provider_call import CircuitOpenError, ProviderCall
+from src.tracing import span
+
+slogger = structlog.get_logger(__name__)
+
+# 呼び出し箇所
+CALL_SITE_GENERATION = "generation"
+CALL_SITE_SELECTION = "selection"
+CALL_SITE_HALLUCINATION = "hallucination"
+CALL_SITE_COMMENT_FILTER = "comment_filter"
+
+# 質問の分類に使うキーワード(get_hybrid_knowledge / generate_response のルールと揃える)
+QUERY_CLASS_KEYWORDS = {
+    "greeting": ["こんにちは", "はじめまして", "初めて", "挨拶", "よろしく", "知らない", "分からない", "わからない", "不明", "答えられない"],
+    "finance": ["売上", "業績", "収益", "営業利益", "セグメント", "2024年度", "決算"],
+    "business": ["事業", "事業内容", "ビジネス", "何をしている", "会社概要", "概要"],
+    "data_science": ["データサイエンス", "AI", "機械学習", "分析"],
+}
+
+
+class ModelTimeoutError(TimeoutError):
+    """レイテンシ予算内に Gemini の応答が得られなかった"""
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """モデルルーティングの結果"""
+
+    call_site: str
+    model_name: str
+    query_class: str
+    reason: str
+
+
+def is_retryable_gemini_error(e: Exception) -> bool:
+    """レート制限・サーバー側のエラーのみ再試行する(リクエスト内容の誤りは再試行しない)"""
+    if isinstance(e, lazy.google_exceptions.TooManyRequests):
+        return True
+    return not isinstance(e, (lazy.google_exceptions.ClientError, ValueError))
+
+
+def classify_query(query: str) -> str:
+    """キーワードルールで質問を分類する"""
+    for query_class, keywords in QUERY_CLASS_KEYWORDS.items():
+        if any(keyword in query for keyword in keywords):
+            return query_class
+    return "general"
+
+
+class ModelRouter:
+    """呼び出し箇所と質問の種類に応じて gemini-1.5-flash / gemini-1.5-pro を使い分ける
+
+    pro が期限内に応答しない場合は残りの予算で flash にフォールバックし、
+    それも間に合わなければ ModelTimeoutError を送出する(呼び出し元で抽出した回答等に切り替える)。
+    モデルごとの呼び出しは ProviderCall でヘッジ・リトライし、pro のサーキットブレーカーが開いている間は最初から flash を使う。
+    回答キャッシュにヒットした質問はモデルを呼ばずにキャッシュから返すので、ここに来るのはキャッシュミスの質問のみ。
+    """
+
+    def __init__(
+        self,
+        *,
+        pro_model: str = settings.GEMINI_PRO_MODEL,
+        flash_model: str = settings.GEMINI_FLASH_MODEL,
+        pro_timeout: float = settings.MODEL_ROUTER_PRO_TIMEOUT_SEC,
+        request_budget: float = settings.MODEL_ROUTER_REQUEST_BUDGET_SEC,
+        short_query_chars: int = settings.MODEL_ROUTER_SHORT_QUERY_CHARS,
+    ) -> None:
+        self.pro_model = pro_model
+        self.flash_model = flash_model
+        self.pro_timeout = pro_timeout
+        self.request_budget = request_budget
+        self.short_query_chars = short_query_chars
+        self._provider_calls: dict[str, ProviderCall] = {}
+
+    def provider_call(self, model_name: str) -> ProviderCall:
+        """モデルごとの ProviderCall(レイテンシ分布とサーキットブレーカーはモデル単位で持つ)"""
+        if model_name not in self._provider_calls:
+            self._provider_calls[model_name] = ProviderCall(f"gemini/{model_name}", is_retryable=is_retryable_gemini_error)
+        return self._provider_calls[model_name]
+
+    def route(self, call_site: str, query: str = "") -> RouteDecision:
+        """呼び出し箇所と質問の種類から使用するモデルを決める"""
+        query_class = classify_query(query)
+
+        if call_site == CALL_SITE_COMMENT_FILTER:
+            # 複数の視聴者のコメントをまとめて分類するので質問の種類がなく、index の JSON を返すだけなので flash に固定する
+            return RouteDecision(call_site, self.flash_model, query_class, "comment_batch")
+
+        if call_site in (CALL_SITE_SELECTION, CALL_SITE_HALLUCINATION):
+            # 数値データの質問はスライドの取り違え・数値の矛盾の見落としが起きやすいので pro で選択・判定する
+            if query_class == "finance":
+                return RouteDecision(call_site, self.pro_model, query_class, "finance")
+            return RouteDecision(call_site, self.flash_model, query_class, call_site)
+
+        # 回答生成
+        if query_class == "greeting":
+            return RouteDecision(call_site, self.flash_model, query_class, "greeting")
+        if len(query) <= self.short_query_chars:
+            return RouteDecision(call_site, self.flash_model, query_class, "short_query")
+        return RouteDecision(call_site, self.pro_model, query_class, "default")
+
+    async def generate(
+        self,
+        call_site: str,
+        contents: Any,
+        *,
+        query: str = "",
+        generation_config: dict | None = None,
+        budget: float | None = None,
+    ) -> str:
+        """ルーティングしたモデルで generate_content を実行し、応答テキストを返す"""
+        with stage_timer(call_site):
+            return await self._generate_with_fallback(call_site, contents, query, generation_config, budget)
+
+    async def _generate_with_fallback(
+        self,
+        call_site: str,
+        contents: Any,
+        query: str,
+        generation_config: dict | None,
+        budget: float | None,
+    ) -> str:
+        decision = self.route(call_site, query)
+        budget = self.request_budget if budget is None else budget
+        start = time.monotonic()
+
+        if decision.model_name == self.pro_model and self.provider_call(self.pro_model).breaker.is_open():
+            # pro が障害中の間は待たずに flash で回答する
+            record_fallback(call_site, "circuit_open")
+            decision = RouteDecision(call_site, self.flash_model, decision.query_class, "pro_circuit_open")
+
+        if decision.model_name == self.pro_model:
+            try:
+                return await self._generate(decision, decision.model_name, contents, generation_config, min(self.pro_timeout, budget))
+            except asyncio.TimeoutError:
+                # pro が期限切れの場合は残りの予算で flash を試す
+                record_fallback(call_site, "flash")
+                remaining = budget - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise ModelTimeoutError(f"{call_site}: {decision.model_name} exceeded the budget ({budget:.1f}s)") from None
+                try:
+                    return await self._generate(decision, self.flash_model, contents, generation_config, remaining, fallback=True)
+                except asyncio.TimeoutError:
+                    raise ModelTimeoutError(f"{call_site}: flash fallback exceeded the budget ({budget:.1f}s)") from None
+
+        try:
+            return await self._generate(decision, decision.model_name, contents, generation_config, budget)
+        except asyncio.TimeoutError:
+            raise ModelTimeoutError(f"{call_site}: {decision.model_name} exceeded the budget ({budget:.1f}s)") from None
+
+    async def _generate(
+        self,
+        decision: RouteDecision,
+        model_name: str,
+        contents: Any,
+        generation_config: dict | None,
+        timeout: float,
+        *,
+        fallback: bool = False,
+    ) -> str:
+        """1モデル分の呼び出し。ルーティング結果・入力トークン数・レイテンシをログに残す"""
+        model = lazy.genai.GenerativeModel(model_name, generation_config=generation_config)
+        input_tokens = count_tokens(contents) if isinstance(contents, str) else None
+        start = time.monotonic()
+        outcome = "ok"
+        with span("gemini.generate_content", call_site=decision.call_site, model=model_name, reason=decision.reason, fallback=fallback, input_tokens=input_tokens) as s:
+            try:
+                response = await asyncio.wait_for(self.provider_call(model_name).call(lambda: model.generate_content_async(contents)), timeout=timeout)
+                s.set_attribute("output_chars", len(response.text))
+                return response.text
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+                raise
+            except CircuitOpenError:
+                outcome = "circuit_open"
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                s.set_attribute("outcome", outcome)
+                slogger.info(
+                    "model routing",
+                    call_site=decision.call_site,
+                    model=model_name,
+                    query_class=decision.query_class,
+                    reason=decision.reason,
+                    fallback=fallback,
+                    outcome=outcome,
+                    input_tokens=input_tokens,
+                    timeout=round(timeout, 3),
+                    latency=round(time.monotonic() - start, 3),
+                )
+
+
+model_router = ModelRouter()
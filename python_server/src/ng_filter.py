@@ -0,0 +1,189 @@
+import csv
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+_NO_MATCH = sys.maxsize
+
+
+class _NGAutomaton:
+    """NGワードを case-fold 済みで保持する Aho-Corasick オートマトン
+
+    各パターンには優先度(小さいほど優先)を持たせ、1回の走査で最優先のマッチを返す
+    """
+
+    __slots__ = ("_goto", "_fail", "_out", "_floor")
+
+    def __init__(self, patterns: list[tuple[str, int]]) -> None:
+        goto: list[dict[str, int]] = [{}]
+        out: list[int] = [_NO_MATCH]
+        for word, priority in patterns:
+            word = word.casefold()
+            if not word:
+                continue
+            node = 0
+            for ch in word:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(_NO_MATCH)
+                node = nxt
+            out[node] = min(out[node], priority)
+
+        # 幅優先で失敗遷移を構築し、失敗先の優先度を引き継ぐ
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = min(out[nxt], out[fail[nxt]])
+                queue.append(nxt)
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._floor = min((p for _, p in patterns), default=_NO_MATCH)
+
+    def search(self, text: str) -> int:
+        """最優先でマッチしたパターンの優先度を返す(マッチなしは _NO_MATCH)"""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        floor = self._floor
+        node = 0
+        best = _NO_MATCH
+        for ch in text.casefold():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] < best:
+                best = out[node]
+                if best == floor:
+                    break
+        return best
+
+
+class _CompiledNG:
+    """NG.csv 1 世代分のコンパイル結果"""
+
+    __slots__ = ("automaton", "verdicts", "mtime_ns")
+
+    def __init__(self, automaton: _NGAutomaton, verdicts: list[tuple[bool, str]], mtime_ns: int) -> None:
+        self.automaton = automaton
+        self.verdicts = verdicts
+        self.mtime_ns = mtime_ns
+
+
+class NGFilter:
+    """NG.csv をオートマトンにコンパイルして判定するフィルタ
+
+    判定の優先順は allow_words -> extra_ng_words -> NG.csv の行順。
+    NG.csv の mtime を一定間隔で確認し、変更があれば再コンパイルして差し替える。
+    """
+
+    def __init__(
+        self,
+        ng_path: pathlib.Path,
+        *,
+        default_reply: str,
+        allow_words: list[str] | None = None,
+        extra_ng_words: list[str] | None = None,
+        check_interval: float = 1.0,
+    ) -> None:
+        self._ng_path = ng_path
+        self._default_reply = default_reply
+        self._allow_words = list(allow_words or [])
+        self._extra_ng_words = list(extra_ng_words or [])
+        self._check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        self._next_check = time.monotonic() + check_interval
+        self._compiled = self._compile(self._stat_mtime_ns())
+
+    def check(self, text: str) -> tuple[bool, str]:
+        """NG 判定を行い (NGかどうか, 返答文) を返す"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._reload_if_changed(now)
+
+        compiled = self._compiled
+        priority = compiled.automaton.search(text)
+        if priority == _NO_MATCH:
+            return False, ""
+        return compiled.verdicts[priority]
+
+    def reload(self) -> None:
+        """NG.csv を強制的に再コンパイルする"""
+        with self._reload_lock:
+            self._compiled = self._compile(self._stat_mtime_ns())
+
+    def _reload_if_changed(self, now: float) -> None:
+        """mtime が変わっていれば再コンパイルする(他スレッドが実行中ならスキップ)"""
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self._check_interval
+            mtime_ns = self._stat_mtime_ns()
+            if mtime_ns == self._compiled.mtime_ns:
+                return
+            try:
+                compiled = self._compile(mtime_ns)
+            except Exception as e:
+                LOGGER.warning(f"NG.csv の再読み込みに失敗したため旧データを使用します: {e}")
+                return
+            # 参照の差し替えのみで切り替える(判定中のリクエストは旧世代を使い切る)
+            self._compiled = compiled
+            LOGGER.info(f"NG.csv を再読み込みしました: {self._ng_path}")
+        finally:
+            self._reload_lock.release()
+
+    def _stat_mtime_ns(self) -> int:
+        try:
+            return os.stat(self._ng_path).st_mtime_ns
+        except FileNotFoundError:
+            return -1
+
+    def _compile(self, mtime_ns: int) -> _CompiledNG:
+        """許可ワード・追加NGワード・NG.csv をまとめてコンパイルする"""
+        patterns: list[tuple[str, int]] = []
+        verdicts: list[tuple[bool, str]] = []
+
+        for word in self._allow_words:
+            patterns.append((word, len(verdicts)))
+            verdicts.append((False, ""))
+
+        for word in self._extra_ng_words:
+            patterns.append((word, len(verdicts)))
+            verdicts.append((True, self._default_reply))
+
+        for ng, reply in self._read_ng_rows():
+            patterns.append((ng, len(verdicts)))
+            verdicts.append((True, reply or self._default_reply))
+
+        return _CompiledNG(_NGAutomaton(patterns), verdicts, mtime_ns)
+
+    def _read_ng_rows(self) -> list[tuple[str, str]]:
+        """NG.csv を (ng, reply) のリストとして読み込む"""
+        if not self._ng_path.exists():
+            LOGGER.warning(f"NG.csv が見つかりません: {self._ng_path}")
+            return []
+
+        rows = []
+        with open(self._ng_path, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                ng = (row.get("ng") or "").strip()
+                if not ng:
+                    continue
+                rows.append((ng, (row.get("reply") or "").strip()))
+        return rows
@@ -0,0 +1,72 @@
+import math
+import re
+
+# 日本語(かな・漢字・全角)は1文字1トークン、英数字の連続は4文字1トークン、記号は1文字1トークンとして数える
+_TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uff00-\uffef]|[A-Za-z0-9]+|[^\sA-Za-z0-9]")
+_SHINGLE_SIZE = 4
+
+
+def count_tokens(text: str) -> int:
+    """プロンプトのトークン数をローカルで概算する"""
+    tokens = 0
+    for match in _TOKEN_RE.finditer(text):
+        length = match.end() - match.start()
+        tokens += 1 if length == 1 else math.ceil(length / 4)
+    return tokens
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """トークン予算に収まるように末尾を切り詰める(なるべく文の区切りで切る)"""
+    if budget <= 0:
+        return ""
+    tokens = 0
+    for match in _TOKEN_RE.finditer(text):
+        length = match.end() - match.start()
+        tokens += 1 if length == 1 else math.ceil(length / 4)
+        if tokens > budget:
+            truncated = text[: match.start()]
+            break
+    else:
+        return text
+
+    last_period = max(truncated.rfind("。"), truncated.rfind("\n"))
+    if last_period > len(truncated) // 2:
+        truncated = truncated[: last_period + 1]
+    return truncated.rstrip()
+
+
+def _shingles(text: str) -> set[str]:
+    text = re.sub(r"\s+", "", text)
+    if len(text) <= _SHINGLE_SIZE:
+        return {text}
+    return {text[i : i + _SHINGLE_SIZE] for i in range(len(text) - _SHINGLE_SIZE + 1)}
+
+
+def pack_context(chunks: list[str], budget: int, *, per_chunk_budget: int | None = None, overlap_threshold: float = 0.8) -> list[tuple[int, str]]:
+    """関連度順に並んだチャンクをトークン予算まで詰める
+
+    他のチャンクと大部分が重複するチャンクは除外する。
+    戻り値は (元のインデックス, 詰めたテキスト) のリスト
+    """
+    packed: list[tuple[int, str]] = []
+    seen: list[set[str]] = []
+    remaining = budget
+    for idx, chunk in enumerate(chunks):
+        if remaining <= 0:
+            break
+        shingles = _shingles(chunk)
+        if any(len(shingles & other) >= overlap_threshold * min(len(shingles), len(other)) for other in seen):
+            continue
+        text = chunk if per_chunk_budget is None else truncate_to_tokens(chunk, per_chunk_budget)
+        text = truncate_to_tokens(text, remaining)
+        if not text:
+            break
+        packed.append((idx, text))
+        seen.append(shingles)
+        remaining -= count_tokens(text)
+    return packed
+
+
+def pack_text(chunks: list[str], budget: int, *, separator: str = "\n") -> str:
+    """pack_context の結果を1つの文字列に連結する"""
+    return separator.join(text for _, text in pack_context(chunks, budget))
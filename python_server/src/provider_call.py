@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from src.config import settings
+from src.metrics import record_circuit_state, record_hedge, record_provider_call
+from src.tracing import current_span
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# サーキットブレーカーの状態
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いているため外部プロバイダを呼び出さなかった"""
+
+
+class LatencyWindow:
+    """直近の成功した呼び出しのレイテンシを保持する"""
+
+    def __init__(self, size: int = 200) -> None:
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def percentile(self, q: float) -> float:
+        """最近傍法でパーセンタイルを求める"""
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """連続して失敗したプロバイダへの呼び出しを一定時間止める
+
+    failure_threshold 回連続で失敗すると open になり、reset_timeout 秒後に1件だけ試行(half_open)する。
+    試行が成功すれば closed に戻り、失敗すれば再び open になる。
+    """
+
+    def __init__(self, name: str, *, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_inflight = False
+
+    def allow(self) -> bool:
+        """呼び出してよいかどうか"""
+        if self.state == CIRCUIT_CLOSED:
+            return True
+        if self.state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(CIRCUIT_HALF_OPEN)
+        if self.state == CIRCUIT_HALF_OPEN and not self._trial_inflight:
+            self._trial_inflight = True
+            return True
+        return False
+
+    def is_open(self) -> bool:
+        """呼び出しを止めている最中かどうか(状態は変えない)"""
+        if self.state == CIRCUIT_OPEN:
+            return time.monotonic() - self._opened_at < self.reset_timeout
+        return self.state == CIRCUIT_HALF_OPEN and self._trial_inflight
+
+    def record_success(self) -> None:
+        self._consecutive_failures = 0
+        self._trial_inflight = False
+        if self.state != CIRCUIT_CLOSED:
+            self._set_state(CIRCUIT_CLOSED)
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        self._trial_inflight = False
+        if self.state == CIRCUIT_HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self.state != CIRCUIT_OPEN:
+                LOGGER.warning(f"[{self.name}] サーキットブレーカー open (連続失敗 {self._consecutive_failures} 回)")
+                self._set_state(CIRCUIT_OPEN)
+
+    def release(self) -> None:
+        """成否が決まらないまま終わった試行(キャンセル等)の枠を返す"""
+        self._trial_inflight = False
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        record_circuit_state(self.name, state)
+
+
+class ProviderCall:
+    """外部プロバイダ(Gemini / ElevenLabs / Azure TTS)の呼び出しラッパー
+
+    - ヘッジ: 観測した p95 を過ぎても応答がなければ同じ呼び出しをもう1本送り、先に返った方を使う
+      (送りすぎないよう、ヘッジの本数は呼び出し数の hedge_budget_ratio までに抑える)
+    - リトライ: 再試行可能なエラー(is_retryable が True を返すもの。既定では再試行しない)は指数バックオフ + full jitter で max_attempts 回まで試す
+    - サーキットブレーカー: 連続して失敗したら CircuitOpenError ですぐに呼び出し元のフォールバックに切り替えさせる
+
+    全体のタイムアウトは呼び出し元(Deadline / asyncio.wait_for)が決める。キャンセルされた場合は実行中の呼び出しもすべてキャンセルする。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        is_retryable: Callable[[Exception], bool] = lambda e: False,
+        hedging: bool = settings.PROVIDER_HEDGING_ENABLED,
+        hedge_percentile: float = settings.PROVIDER_HEDGE_PERCENTILE,
+        hedge_min_samples: int = settings.PROVIDER_HEDGE_MIN_SAMPLES,
+        hedge_budget_ratio: float = settings.PROVIDER_HEDGE_BUDGET_RATIO,
+        max_attempts: int = settings.PROVIDER_MAX_ATTEMPTS,
+        retry_base_delay: float = settings.PROVIDER_RETRY_BASE_DELAY_SEC,
+        retry_max_delay: float = settings.PROVIDER_RETRY_MAX_DELAY_SEC,
+        failure_threshold: int = settings.PROVIDER_CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = settings.PROVIDER_CIRCUIT_RESET_SEC,
+    ) -> None:
+        self.name = name
+        self.is_retryable = is_retryable
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget_ratio = hedge_budget_ratio
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.breaker = CircuitBreaker(name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.latencies = LatencyWindow()
+        self.call_count = 0
+        self.hedge_count = 0
+
+    def hedge_delay(self) -> float | None:
+        """ヘッジを送るまでの待ち時間(サンプル不足・ヘッジ予算切れの場合は None)"""
+        if not self.hedging or len(self.latencies) < self.hedge_min_samples:
+            return None
+        if self.hedge_count >= self.hedge_budget_ratio * self.call_count:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    async def call(self, func: Callable[[], Awaitable[T]], *, discard: Callable[[T], Awaitable[None]] | None = None) -> T:
+        """func を呼び出す(func は呼び出すたびに新しい awaitable を返すこと)
+
+        discard があれば、ヘッジで返さなかった成功結果(開いたストリームなど)をそれで後片付けする
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                record_provider_call(self.name, "circuit_open")
+                raise CircuitOpenError(f"{self.name}: circuit breaker is open")
+            try:
+                result = await self._hedged(func, discard)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # リクエスト内容の問題はプロバイダの障害として数えない
+                    self.breaker.release()
+                    record_provider_call(self.name, "error")
+                    raise
+                self.breaker.record_failure()
+                if attempt == self.max_attempts:
+                    record_provider_call(self.name, "error")
+                    raise
+                delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1)))  # noqa: S311
+                LOGGER.warning(f"[{self.name}] 呼び出し失敗のためリトライ ({attempt}/{self.max_attempts}, {delay:.2f}s後): {e}")
+                record_provider_call(self.name, "retry")
+                current_span().set_attribute(f"{self.name}.retries", attempt)
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                record_provider_call(self.name, "ok")
+                return result
+        raise AssertionError("unreachable")
+
+    async def _hedged(self, func: Callable[[], Awaitable[T]], discard: Callable[[T], Awaitable[None]] | None) -> T:
+        """1回分の試行。p95 を過ぎたらヘッジを送り、先に成功した方の結果を返す(もう一方の成功結果は discard で後片付けする)"""
+        self.call_count += 1
+        delay = self.hedge_delay()
+        tasks = [asyncio.ensure_future(self._timed(func))]
+        winner = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.hedge_count += 1
+                    record_hedge(self.name, "sent")
+                    current_span().set_attribute(f"{self.name}.hedged", True)
+                    tasks.append(asyncio.ensure_future(self._timed(func)))
+
+            pending = set(tasks)
+            error: Exception | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1 and task is tasks[1]:
+                            record_hedge(self.name, "won")
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled() and task.exception() is None and discard is not None:
+                    # 同時に成功した(または呼び出し元がキャンセルされた)場合、返さない結果を開いたままにしない
+                    await self._discard(discard, task.result())
+
+    async def _discard(self, discard: Callable[[T], Awaitable[None]], result: T) -> None:
+        try:
+            await discard(result)
+        except Exception as e:
+            LOGGER.warning(f"[{self.name}] 使わなかった結果の後片付けに失敗: {e}")
+
+    async def _timed(self, func: Callable[[], Awaitable[T]]) -> T:
+        start = time.monotonic()
+        result = await func()
+        self.latencies.add(time.monotonic() - start)
+        return result
@@ -0,0 +1,125 @@
+import asyncio
+import functools
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import jaconv
+
+from src import lazy_imports as lazy
+from src.metrics import STAGE_READING, record_cache, stage_timer
+
+# 変換済みの読みのキャッシュ(文単位。テンプレートや定型文の繰り返しは形態素解析を省く)
+READING_CACHE_SIZE = 4096
+_reading_cache: OrderedDict[str, str] = OrderedDict()
+_reading_cache_lock = threading.Lock()
+
+# 文の区切り(区切り文字は直前の文に含める)
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?\n]*|[。！？!?\n]+")
+
+# 形態素解析は CPU 処理で GIL を離さないため、専用の1スレッドで順に実行してイベントループを塞がないようにする
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reading")
+
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer() -> "lazy.Tokenizer":
+    """janome の Tokenizer(辞書の読み込みに時間がかかるのでプロセス内で共有する)"""
+    return lazy.Tokenizer()
+
+
+def split_sentences(text: str) -> list[str]:
+    """テキストを文に分割する(連結すると元のテキストに戻る)"""
+    return _SENTENCE_RE.findall(text)
+
+
+def tokens_to_hiragana(tokens) -> str:
+    """形態素解析の結果をひらがなに変換する(かな・記号・数字などはそのまま残す)"""
+    result = ""
+    for token in tokens:
+        surface = token.surface
+        reading = token.reading
+        if reading == "*":
+            # 記号や数字等の読みが取得できない場合はsurfaceをそのまま使う
+            result += surface
+        elif reading == jaconv.kata2hira(surface):
+            result += surface
+        elif reading == jaconv.hira2kata(surface):
+            result += surface
+        else:
+            result += jaconv.kata2hira(reading)
+    return result
+
+
+def _cached_reading(sentence: str) -> str | None:
+    with _reading_cache_lock:
+        reading = _reading_cache.get(sentence)
+        if reading is not None:
+            _reading_cache.move_to_end(sentence)
+        return reading
+
+
+def _remember_reading(sentence: str, reading: str) -> None:
+    """変換した読みをキャッシュする(古いものから捨てる)"""
+    with _reading_cache_lock:
+        _reading_cache[sentence] = reading
+        _reading_cache.move_to_end(sentence)
+        while len(_reading_cache) > READING_CACHE_SIZE:
+            _reading_cache.popitem(last=False)
+
+
+def _convert_sentences(sentences: list[str]) -> dict[str, str]:
+    """キャッシュにない文を形態素解析して読みを求める"""
+    tokenizer = get_tokenizer()
+    readings = {}
+    for sentence in sentences:
+        readings[sentence] = tokens_to_hiragana(tokenizer.tokenize(sentence))
+        _remember_reading(sentence, readings[sentence])
+        # 文ごとに GIL を手放して、待っているイベントループのスレッドを先に進ませる
+        time.sleep(0)
+    return readings
+
+
+def _lookup(texts: list[str]) -> tuple[list[list[str]], dict[str, str], list[str]]:
+    """テキストを文に分割し、キャッシュ済みの読みと未変換の文に分ける"""
+    split_texts = [split_sentences(text) for text in texts]
+    readings: dict[str, str] = {}
+    missing: dict[str, None] = {}
+    for sentence in (s for sentences in split_texts for s in sentences):
+        if sentence in readings or sentence in missing:
+            continue
+        reading = _cached_reading(sentence)
+        record_cache("reading", reading is not None)
+        if reading is None:
+            missing[sentence] = None
+        else:
+            readings[sentence] = reading
+    return split_texts, readings, list(missing)
+
+
+def to_hiragana(text: str) -> str:
+    """テキストをひらがなに変換する(呼び出したスレッドで形態素解析する)"""
+    with stage_timer(STAGE_READING):
+        (sentences,), readings, missing = _lookup([text])
+        if missing:
+            readings.update(_convert_sentences(missing))
+        return "".join(readings[s] for s in sentences)
+
+
+async def to_hiragana_batch(texts: list[str]) -> list[str]:
+    """複数のテキストをまとめてひらがなに変換する
+
+    キャッシュにない文だけを専用スレッドでまとめて形態素解析する(すべてキャッシュ済みならスレッドに渡さない)
+    """
+    with stage_timer(STAGE_READING):
+        split_texts, readings, missing = _lookup(texts)
+        if missing:
+            loop = asyncio.get_running_loop()
+            readings.update(await loop.run_in_executor(_executor, _convert_sentences, missing))
+        return ["".join(readings[s] for s in sentences) for sentences in split_texts]
+
+
+async def to_hiragana_async(text: str) -> str:
+    """テキストをひらがなに変換する(形態素解析はイベントループの外で行う)"""
+    return (await to_hiragana_batch([text]))[0]
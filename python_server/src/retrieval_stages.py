@@ -0,0 +1,70 @@
+import time
+import uuid
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+from src.metrics import STAGE_EMBEDDING, STAGE_FUSION, record_stage, stage_timer
+from src.tracing import span_recorder
+
+
+class TimedEmbeddings(Embeddings):
+    """クエリの埋め込みを embedding ステージとして計測する Embeddings(FAISS に渡す)"""
+
+    def __init__(self, embeddings: Embeddings) -> None:
+        self._embeddings = embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        with stage_timer(STAGE_EMBEDDING):
+            return self._embeddings.embed_query(text)
+
+
+class EnsembleStageRecorder(BaseCallbackHandler):
+    """EnsembleRetriever.invoke のコールバックから、retriever ごとの検索と融合の時間をステージとして記録する
+
+    EnsembleRetriever は retrievers の順に retriever_1, retriever_2, ... のタグを付けて子の retriever を実行するので、
+    そのタグで stages(retrievers と同じ順のステージ名)を引く。最後の retriever が終わってから全体が終わるまでを融合とする。
+    """
+
+    def __init__(self, stages: list[str]) -> None:
+        self.stages = stages
+        # ステージ -> 検索結果の件数
+        self.counts: dict[str, int] = {}
+        self._starts: dict[uuid.UUID, tuple[str | None, float, int]] = {}
+        self._last_retriever_end: float | None = None
+        self._record_span = span_recorder()
+
+    def on_retriever_start(self, serialized: dict[str, Any], query: str, *, run_id: uuid.UUID, tags: list[str] | None = None, **kwargs: Any) -> None:
+        self._starts[run_id] = (self._stage_for(tags), time.perf_counter(), time.time_ns())
+
+    def on_retriever_end(self, documents: list, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self._finish(run_id, count=len(documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: uuid.UUID, **kwargs: Any) -> None:
+        self._finish(run_id, error=error)
+
+    def _stage_for(self, tags: list[str] | None) -> str | None:
+        for i, stage in enumerate(self.stages, 1):
+            if f"retriever_{i}" in (tags or []):
+                return stage
+        return None
+
+    def _finish(self, run_id: uuid.UUID, *, count: int = 0, error: BaseException | None = None) -> None:
+        if run_id not in self._starts:
+            return
+        stage, start, start_ns = self._starts.pop(run_id)
+        end = time.perf_counter()
+        if stage is None:
+            # EnsembleRetriever 自体
+            if self._last_retriever_end is None:
+                return
+            stage, start, start_ns = STAGE_FUSION, self._last_retriever_end, start_ns + int((self._last_retriever_end - start) * 1e9)
+        else:
+            self._last_retriever_end = end
+            self.counts[stage] = count
+        record_stage(stage, end - start, error=error is not None)
+        self._record_span(stage, start_ns, error=error)
@@ -0,0 +1,93 @@
+from typing import Annotated, Literal
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+# クライアント -> サーバー(いずれも JSON のテキストフレーム)
+
+
+class QuestionMessage(BaseModel):
+    """質問を送る(id はクライアントが決め、この質問へのメッセージすべてに付く)
+
+    voice を指定すると、回答をそのエンドポイント(voice, voice/v2 など)の音声でも返す(format は /voice*/stream と同じく WAV のみ)
+    """
+
+    type: Literal["question"]
+    id: str
+    text: str
+    voice: str | None = None
+    format: str | None = None
+
+
+class CancelMessage(BaseModel):
+    """処理中の質問を取り消す"""
+
+    type: Literal["cancel"]
+    id: str
+
+
+class TemplateRequestMessage(BaseModel):
+    """テンプレートメッセージ・テンプレート質問を1つ取得する(GET /template_message, /template_question と同じ)"""
+
+    type: Literal["template"]
+    id: str
+    kind: Literal["message", "question"]
+
+
+ClientMessage = Annotated[QuestionMessage | CancelMessage | TemplateRequestMessage, Field(discriminator="type")]
+client_message_adapter: TypeAdapter[ClientMessage] = TypeAdapter(ClientMessage)
+
+
+# サーバー -> クライアント(audio の直後にだけバイナリフレームが続き、それ以外は JSON のテキストフレーム)
+
+
+class ReplyTextMessage(BaseModel):
+    """回答のテキスト(文ごとに index の順に送る)"""
+
+    type: Literal["reply_text"] = "reply_text"
+    id: str
+    index: int
+    text: str
+
+
+class SlideMessage(BaseModel):
+    """回答と一緒に表示するスライド"""
+
+    type: Literal["slide"] = "slide"
+    id: str
+    image_filename: str
+
+
+class AudioMessage(BaseModel):
+    """回答の音声の断片(直後のバイナリフレーム size バイトが本体。/voice*/stream の本文と同じ WAV ヘッダー + PCM を seq の順に送る)"""
+
+    type: Literal["audio"] = "audio"
+    id: str
+    seq: int
+    size: int
+    media_type: str
+
+
+class DoneMessage(BaseModel):
+    """質問への送信がすべて終わった(取り消した場合は cancelled)"""
+
+    type: Literal["done"] = "done"
+    id: str
+    cancelled: bool = False
+
+
+class TemplateMessage(BaseModel):
+    """テンプレートメッセージ・テンプレート質問"""
+
+    type: Literal["template"] = "template"
+    id: str
+    kind: Literal["message", "question"]
+    text: str
+
+
+class ErrorMessage(BaseModel):
+    """エラー(status は HTTP のステータスコードに合わせる。メッセージ自体が読めなかった場合は id が None)"""
+
+    type: Literal["error"] = "error"
+    id: str | None
+    status: int
+    detail: str
@@ -0,0 +1,64 @@
+import asyncio
+from collections import deque
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SendQueueClosedError(RuntimeError):
+    """閉じた SendQueue に put した"""
+
+
+class SendQueueFullError(RuntimeError):
+    """待たずに put したが、SendQueue に空きがなかった"""
+
+
+class SendQueue(Generic[T]):
+    """合計サイズで上限を決める送信待ちのキュー(1接続の送信を1つのタスクにまとめ、遅い相手への送信で生成側を待たせる)
+
+    合計が max_bytes を超える put は、送信側の get で空くまで待つ(空のキューには大きさによらず入れられる)。
+    wait=False の put(エラーなどの小さな制御メッセージ用)は待たずに、max_bytes + headroom_bytes まで入れる。
+    """
+
+    def __init__(self, max_bytes: int, *, headroom_bytes: int = 0) -> None:
+        self.max_bytes = max_bytes
+        self.headroom_bytes = headroom_bytes
+        self._items: deque[tuple[T, int]] = deque()
+        self._bytes = 0
+        self._closed = False
+        self._changed = asyncio.Condition()
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._bytes
+
+    async def put(self, item: T, size: int, *, wait: bool = True) -> None:
+        """item を入れる(wait=False なら空きを待たず、headroom_bytes を使っても入らなければ SendQueueFullError)"""
+        async with self._changed:
+            if wait:
+                await self._changed.wait_for(lambda: self._closed or not self._items or self._bytes + size <= self.max_bytes)
+            if self._closed:
+                raise SendQueueClosedError("send queue is closed")
+            if not wait and self._items and self._bytes + size > self.max_bytes + self.headroom_bytes:
+                raise SendQueueFullError(f"send queue is full ({self._bytes} bytes pending)")
+            self._items.append((item, size))
+            self._bytes += size
+            self._changed.notify_all()
+
+    async def get(self) -> T:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._closed or self._items)
+            if not self._items:
+                raise SendQueueClosedError("send queue is closed")
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._changed.notify_all()
+            return item
+
+    async def close(self) -> None:
+        """待っている put / get を SendQueueClosedError で起こす(残っているものは送らない)"""
+        async with self._changed:
+            self._closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._changed.notify_all()
@@ -0,0 +1,130 @@
+import asyncio
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable
+
+from src.azure_speech_synthesizer import wav_header
+from src.config import settings
+from src.metrics import STAGE_TTS_FIRST_CHUNK, stage_timer
+from src.reading import split_sentences
+
+# add_wav_header / wav_header が付ける WAV ヘッダーの長さ
+WAV_HEADER_SIZE = 44
+
+# 句読点・空白だけの断片(単独では合成しない)
+_PUNCTUATION_ONLY = set("。、！？!?…・ 　\n")
+
+# バックエンドごとの同時合成数(文単位の合成がプロバイダへの同時リクエストを増やしすぎないようにする)
+_backend_slots: dict[str, asyncio.Semaphore] = {}
+
+
+def split_for_synthesis(text: str) -> list[str]:
+    """テキストを合成単位の文に分割する(句読点・空白だけの断片は直前の文に含める)"""
+    sentences: list[str] = []
+    for sentence in split_sentences(text):
+        if sentences and set(sentence) <= _PUNCTUATION_ONLY:
+            sentences[-1] += sentence
+        else:
+            sentences.append(sentence)
+    return [sentence for sentence in sentences if not set(sentence) <= _PUNCTUATION_ONLY]
+
+
+def backend_slot(backend: str) -> asyncio.Semaphore:
+    """バックエンドの同時合成数の枠(TTS_PIPELINE_CONCURRENCY)"""
+    if backend not in _backend_slots:
+        _backend_slots[backend] = asyncio.Semaphore(settings.TTS_PIPELINE_CONCURRENCY[backend])
+    return _backend_slots[backend]
+
+
+async def open_sentence_pipeline(
+    sentences: list[str],
+    synthesize: Callable[[str], Awaitable[bytes]],
+    *,
+    backend: str | None,
+    open_stream: Callable[[str], Awaitable[AsyncIterator[bytes]]] | None = None,
+    sample_rate: int | None = None,
+) -> AsyncIterator[bytes]:
+    """文ごとに並行して合成し、WAV ヘッダー(長さ未定)と各文の PCM を文の順に返すイテレータを返す
+
+    synthesize(文) は WAV を返す。open_stream(文) があれば、最初の文はそのストリーム(WAV ヘッダー + PCM)を届いた順に流す。
+    バックエンドごとの同時合成数は TTS_PIPELINE_CONCURRENCY まで。synthesize はプロバイダを呼ぶ処理の中で backend_slot の枠を取ること
+    (single-flight で相乗りする場合は、まとめた処理の中で取る)。この関数は open_stream で流す最初の文の枠だけを backend で取る。
+    複数のバックエンドを順に使う合成では backend を None にし、open_stream の中でも段階ごとに枠を取る。
+    最初の文の音声が届いた時点で返すので、それまでに失敗した場合は呼び出し元に例外が伝わる。
+    枠の確保と合成タスクの起動はイテレータ(開始済みの async generator)の中で行うので、返したイテレータが読まれないまま捨てられても
+    asyncio が aclose して枠を返し、残りの文の合成タスクをキャンセルする
+    """
+    # 最初の文の音声が届くまで進める(先頭は WAV ヘッダー)
+    return await prime(_relay_sentences(sentences, synthesize, backend_slot(backend) if backend is not None else None, open_stream, sample_rate))
+
+
+async def prime(chunks: AsyncGenerator[bytes, None]) -> AsyncIterator[bytes]:
+    """chunks を最初のチャンクまで進め、そのチャンクから順に返すイテレータを返す(最初のチャンクまでの失敗は呼び出し元に伝わる)
+
+    枠などの後片付けが必要な資源は chunks の中で取ること。開始済みの async generator は、読まれずに捨てられても asyncio が aclose する
+    """
+    head = await anext(chunks)
+    return _prepend(head, chunks)
+
+
+async def _relay_sentences(
+    sentences: list[str],
+    synthesize: Callable[[str], Awaitable[bytes]],
+    slots: asyncio.Semaphore | None,
+    open_stream: Callable[[str], Awaitable[AsyncIterator[bytes]]] | None,
+    sample_rate: int | None,
+) -> AsyncIterator[bytes]:
+    first = None
+    tasks: list[asyncio.Task] = []
+    released = True
+    try:
+        if open_stream is not None:
+            # 最初の文の枠を先に取ってから残りの文を始める
+            if slots is not None:
+                await slots.acquire()
+                released = False
+            rest = sentences[1:]
+        else:
+            rest = sentences
+        tasks = [asyncio.create_task(synthesize(sentence)) for sentence in rest]
+        with stage_timer(STAGE_TTS_FIRST_CHUNK):
+            if open_stream is not None:
+                first = await open_stream(sentences[0])
+                # 先頭の WAV ヘッダーは読み捨てる
+                await anext(first)
+            else:
+                await tasks[0]
+        yield wav_header(sample_rate=sample_rate)
+        if first is not None:
+            # 流し終えたら最初の文の枠を返す
+            async for chunk in first:
+                yield chunk
+            if not released:
+                released = True
+                slots.release()
+        for task in tasks:
+            wav = await task
+            yield wav[WAV_HEADER_SIZE:]
+    finally:
+        if not released:
+            slots.release()
+        if first is not None:
+            await first.aclose()
+        # 途中で失敗した・クライアントが切断した場合は、残りの文の合成をやめる
+        _cancel(tasks)
+
+
+async def _prepend(head: bytes, chunks: AsyncGenerator[bytes, None]) -> AsyncIterator[bytes]:
+    try:
+        yield head
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+def _cancel(tasks: list[asyncio.Task]) -> None:
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            # 取り出されなかった例外の警告を出さない
+            task.exception()
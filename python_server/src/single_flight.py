@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import re
+import unicodedata
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass
+from typing import TypeVar
+
+from src.metrics import record_single_flight
+from src.tracing import Span, current_span, span
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュのキー用にテキストを正規化する(NFKC・空白の圧縮・case-fold)
+
+    読み上げや回答が変わりうるもの(音声合成・回答生成の coalescing など)のキーには使わない
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip().casefold()
+
+
+@dataclass
+class _Flight:
+    """実行中の処理"""
+
+    task: asyncio.Task
+    # 処理を起動したリクエストの Span(トレース外では何も記録しない Span)
+    leader: Span
+    # 結果を待っているリクエストの数
+    waiters: int = 0
+
+
+class SingleFlight:
+    """同一キーの処理を1回の実行にまとめる(single-flight)
+
+    実行中の同じキーへのリクエストは新たに処理を起動せず、実行中のタスクの結果を共有する。
+    結果を待っているリクエストがすべてキャンセルされたら処理もキャンセルする。
+    処理自体の Span は起動したリクエストのトレースに記録され、相乗りしたリクエストの Span からはその Span にリンクする。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # key -> 実行中の処理
+        self._inflight: dict[Hashable, _Flight] = {}
+        # 実際に処理を起動した回数 / 実行中の処理に相乗りした回数
+        self.executed_count = 0
+        self.coalesced_count = 0
+
+    @property
+    def inflight_count(self) -> int:
+        """実行中のキーの数"""
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """key が実行中ならその結果を待ち、なければ func を実行する
+
+        呼び出し元がキャンセルされても、ほかに待っているリクエストがあれば処理は続ける。待っているリクエストがいなくなったら処理もキャンセルする
+        """
+        flight = self._inflight.get(key)
+        if flight is None:
+            with span(f"single_flight.{self.name}", **{"single_flight.coalesced": False}) as leader:
+                # タスクはこの Span のコンテキストを引き継ぐので、処理中の Span はこの Span の子になる
+                flight = _Flight(asyncio.ensure_future(func()), leader)
+                self._inflight[key] = flight
+                flight.task.add_done_callback(lambda t: self._forget(key, t))
+                self.executed_count += 1
+                record_single_flight(self.name, coalesced=False)
+                return await self._wait(key, flight)
+
+        self.coalesced_count += 1
+        record_single_flight(self.name, coalesced=True)
+        current_span().set_attribute("single_flight.coalesced", True)
+        LOGGER.info(f"[{self.name}] 実行中のリクエストに相乗り: key={key} (coalesced={self.coalesced_count})")
+        with span(f"single_flight.{self.name}", **{"single_flight.coalesced": True}) as waiting:
+            waiting.add_link(flight.leader)
+            return await self._wait(key, flight)
+
+    def stats(self) -> dict[str, int]:
+        """カウンタを返す"""
+        return {
+            "executed": self.executed_count,
+            "coalesced": self.coalesced_count,
+            "inflight": self.inflight_count,
+        }
+
+    async def _wait(self, key: Hashable, flight: _Flight) -> T:
+        flight.waiters += 1
+        try:
+            # 1人の呼び出し元がキャンセルされても、共有しているタスク自体はキャンセルしない
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # 誰も待っていない処理は続けない(キャンセル中のタスクに新しいリクエストを相乗りさせない)
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                flight.task.cancel()
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        flight = self._inflight.get(key)
+        if flight is not None and flight.task is task:
+            del self._inflight[key]
+        # 全員がキャンセルされた場合に "exception was never retrieved" を出さない
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import pathlib
+import threading
+import time
+from dataclasses import dataclass, field
+
+from src.config import settings
+
+LOGGER = logging.getLogger(__name__)
+
+# パックのディレクトリ構成
+#   <pack_dir>/CURRENT              : 配信中のバージョン名
+#   <pack_dir>/<version>/manifest.json
+#   <pack_dir>/<version>/audio/<key>.wav
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+AUDIO_DIR = "audio"
+PACK_FORMAT = 1
+
+
+def audio_filename(voice: str, text: str) -> str:
+    """音声ファイル名(エンドポイントとテキストから決める)"""
+    digest = hashlib.sha256(f"{voice}\0{text}".encode()).hexdigest()
+    return f"{digest[:24]}.wav"
+
+
+@dataclass
+class _LoadedPack:
+    version: str
+    directory: pathlib.Path
+    # 音声の出力形式(AudioFormat の名前。記録のない古いパックは None で、音声は使わない)
+    audio_format: str | None = None
+    # (voice, テキスト) -> 音声ファイル(読みが変わりうるのでテキストは正規化しない)
+    audio: dict[tuple[str, str], pathlib.Path] = field(default_factory=dict)
+    # 質問 -> (回答, スライド画像)(generate_response のキーワード判定は大文字・小文字などを区別するので、質問は正規化しない)
+    replies: dict[str, tuple[str, str]] = field(default_factory=dict)
+
+
+class TemplatePack:
+    """テンプレートメッセージ・質問の事前生成パック(src.cli.build_template_pack で作る)
+
+    CURRENT が指すバージョンの manifest を読み込み、音声ファイルと回答を引けるようにする。
+    パックが差し替えられた場合は、check_interval 秒に1回の更新チェックで読み込み直す。
+    """
+
+    def __init__(self, pack_dir: pathlib.Path, *, check_interval: float = 5.0) -> None:
+        self.pack_dir = pack_dir
+        self.check_interval = check_interval
+        self._loaded: _LoadedPack | None = None
+        self._current_mtime: float | None = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> str | None:
+        """配信中のバージョン(パックがない場合は None)"""
+        self._maybe_reload()
+        return self._loaded.version if self._loaded else None
+
+    def audio_path(self, voice: str, text: str, audio_format: str) -> pathlib.Path | None:
+        """audio_format(AudioFormat の名前)で事前合成済みの音声ファイル(なければ None)"""
+        self._maybe_reload()
+        loaded = self._loaded
+        if loaded is None or loaded.audio_format != audio_format:
+            return None
+        return loaded.audio.get((voice, text))
+
+    def reply(self, text: str) -> tuple[str, str] | None:
+        """事前生成済みの (回答, スライド画像)(なければ None)"""
+        self._maybe_reload()
+        loaded = self._loaded
+        if loaded is None:
+            return None
+        return loaded.replies.get(text)
+
+    def reload(self) -> None:
+        """CURRENT が指すバージョンを読み込み直す"""
+        current_file = self.pack_dir / CURRENT_FILE
+        try:
+            mtime = current_file.stat().st_mtime
+            version = current_file.read_text(encoding="utf-8").strip()
+            loaded = self._load(version)
+        except FileNotFoundError:
+            self._loaded, self._current_mtime = None, None
+            return
+        except Exception as e:
+            # 壊れたパックは無視して、読み込み済みのパック(またはプロバイダ呼び出し)で応答を続ける
+            LOGGER.warning(f"テンプレートパックの読み込みに失敗: {e}")
+            return
+        self._loaded, self._current_mtime = loaded, mtime
+        LOGGER.info(f"テンプレートパック {version} を読み込みました (音声 {len(loaded.audio)} 件, 回答 {len(loaded.replies)} 件)")
+
+    def _load(self, version: str) -> _LoadedPack:
+        directory = self.pack_dir / version
+        manifest = json.loads((directory / MANIFEST_FILE).read_text(encoding="utf-8"))
+        if manifest.get("format") != PACK_FORMAT:
+            raise ValueError(f"unsupported pack format: {manifest.get('format')}")
+
+        loaded = _LoadedPack(version=version, directory=directory, audio_format=manifest.get("audio_format"))
+        for entry in manifest["messages"] + manifest["questions"]:
+            for voice, filename in entry.get("audio", {}).items():
+                loaded.audio[(voice, entry["text"])] = directory / AUDIO_DIR / filename
+            if "reply" in entry:
+                reply = entry["reply"]
+                loaded.replies[entry["text"]] = (reply["text"], reply["image_filename"])
+                for voice, filename in reply.get("audio", {}).items():
+                    loaded.audio[(voice, reply["text"])] = directory / AUDIO_DIR / filename
+        return loaded
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                mtime = (self.pack_dir / CURRENT_FILE).stat().st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._current_mtime or (mtime is not None and self._loaded is None):
+                self.reload()
+
+
+template_pack = TemplatePack(settings.TEMPLATE_PACK_DIR)
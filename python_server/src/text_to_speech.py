@@ -1,113 +1,315 @@
+import dataclasses
+import inspect
 import json
-from collections.abc import AsyncIterator
+import logging
+import time
+from collections.abc import AsyncIterator, Callable
 
-import jaconv
-from elevenlabs import VoiceSettings
-from elevenlabs.client import AsyncElevenLabs
-from janome.tokenizer import Tokenizer
+from src import azure_speech_synthesizer
+from src import lazy_imports as lazy
+from src.audio_format import AZURE_OUTPUT_FORMATS, ELEVENLABS_OUTPUT_FORMATS, AudioFormat, default_audio_format, transcode
+from src.audio_postprocess import LeadingSilenceTrimmer, PostProcess, SilentAudioError, postprocess_pcm
+from src.azure_speech_synthesizer import AzureSynthesisCanceledError, add_wav_header, join_wav, wav_header, wav_parts
+from src.metrics import STAGE_ELEVENLABS_STREAM, STAGE_POSTPROCESS, STAGE_TRANSCODE, STAGE_TTS_FIRST_CHUNK, STAGE_WAV_ASSEMBLY, record_fallback, record_stage, stage_timer
+from src.provider_call import ProviderCall
+from src.reading import to_hiragana_async
+from src.tracing import current_span, span_recorder, traced
+from src.tts_service import TTSService
 
-from src.azure_speech_synthesizer import AzureSpeechSynthesizer, add_wav_header
-from src.config import settings
+LOGGER = logging.getLogger(__name__)
 
-client = AsyncElevenLabs(
-    api_key=settings.ELEVENLABS_API_KEY,
-)
+# ElevenLabs の合成設定
+ELEVENLABS_TTS_MODEL = "eleven_multilingual_v2"
+ELEVENLABS_STS_MODEL = "eleven_multilingual_sts_v2"
+ELEVENLABS_TTS_VOICE_SETTINGS = {
+    "stability": 0.7,
+    "similarity_boost": 1.0,
+    "style": 0.0,
+    "use_speaker_boost": True,
+}
+ELEVENLABS_STS_VOICE_SETTINGS = {
+    "stability": 0.9,
+    "similarity_boost": 1.0,
+    "style": 0.0,
+    "use_speaker_boost": True,
+}
+
+# 再試行する Azure TTS のエラー(CancellationErrorCode の名前)
+AZURE_RETRYABLE_ERROR_CODES = {"ConnectionFailure", "ServiceTimeout", "ServiceError", "ServiceUnavailable", "TooManyRequests"}
+
+# Azure TTS のみで合成する場合の既定値
+AZURE_TTS_VOICE_NAME = "ja-JP-NanamiNeural"
+AZURE_TTS_RATE = "+10%"
+
+
+class AzureSynthesisError(RuntimeError):
+    """Azure TTS が音声を返さなかった"""
+
+
+def is_retryable_elevenlabs_error(e: Exception) -> bool:
+    """レート制限・サーバー側のエラーのみ再試行する"""
+    status_code = getattr(e, "status_code", None)
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def is_retryable_azure_error(e: Exception) -> bool:
+    """接続の失敗・レート制限・サーバー側のエラーのみ再試行する(認証・クォータ・リクエスト内容のエラーは再試行しない)"""
+    if isinstance(e, AzureSynthesisCanceledError):
+        return e.error_code in AZURE_RETRYABLE_ERROR_CODES
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+# プロバイダごとの呼び出し(ヘッジ・リトライ・サーキットブレーカー)
+elevenlabs_call = ProviderCall("elevenlabs", is_retryable=is_retryable_elevenlabs_error)
+# Azure の合成はスレッドで SDK を呼ぶためキャンセルできず、ヘッジすると負けた側も最後まで合成(課金)されるのでヘッジしない
+azure_tts_call = ProviderCall("azure_tts", is_retryable=is_retryable_azure_error, hedging=False)
 
 
 class TextToSpeech:
     """TextToSpeech を行うクラス
 
-    いくつか手法があるが、このクラスにまとめておく
+    いくつか手法があるが、このクラスにまとめておく。プロバイダの接続は service(アプリ全体で共有)のものを使う
     """
 
-    def __init__(self):
-        self._client = AsyncElevenLabs(
-            api_key=settings.ELEVENLABS_API_KEY,
-        )
-
-        self._sample_rate = 44100
+    def __init__(self, service: TTSService, audio_format: AudioFormat | None = None, postprocess: PostProcess | None = None):
+        self._service = service
+        # 出力形式(省略時は TTS_SAMPLE_RATE の WAV)
+        self.audio_format = audio_format or default_audio_format()
+        self._sample_rate = self.audio_format.sample_rate
+        # PCM の後処理(省略時は行わない)
+        self.postprocess = postprocess or PostProcess()
         # 学習済みモデルのID(あんのボイス)
         self._elevenlabs_voice_id = "tyMlTSDYc5JhCakLJuAX"
 
     @property
     def output_format(self) -> str:
-        """音声出力フォーマット
+        """ElevenLabs に指定する出力形式
 
-        pcm_44100: 44100HzのPCMデータをデフォで使用する
+        audio_format を直接出力できない場合は、同じサンプルレートの PCM を受け取ってから変換する
         """
-        return f"pcm_{self._sample_rate}"
+        return ELEVENLABS_OUTPUT_FORMATS.get(self.audio_format.name, f"pcm_{self._sample_rate}")
 
+    def cache_params(self, method: str, **kwargs) -> dict:
+        """音声キャッシュのキーに含める合成パラメータ(method は合成に使うメソッド名、kwargs はその引数)
+
+        引数の既定値・モデル・ボイス設定・出力形式も含めるので、合成結果が変わる変更をすると別のキーになる
+        """
+        arguments = inspect.signature(getattr(self, method)).bind("", **kwargs)
+        arguments.apply_defaults()
+        del arguments.arguments["text"]
+        return {
+            "method": method,
+            "arguments": dict(arguments.arguments),
+            "elevenlabs": {
+                "voice_id": self._elevenlabs_voice_id,
+                "tts_model": ELEVENLABS_TTS_MODEL,
+                "sts_model": ELEVENLABS_STS_MODEL,
+                "tts_voice_settings": ELEVENLABS_TTS_VOICE_SETTINGS,
+                "sts_voice_settings": ELEVENLABS_STS_VOICE_SETTINGS,
+            },
+            "azure": {
+                "voice_name": azure_speech_synthesizer.DEFAULT_VOICE_NAME,
+                "pitch": azure_speech_synthesizer.DEFAULT_PITCH,
+                "rate": azure_speech_synthesizer.DEFAULT_RATE,
+            },
+            "audio_format": self.audio_format.name,
+            "postprocess": dataclasses.asdict(self.postprocess) if self.postprocess.enabled else None,
+        }
+
+    @traced("TextToSpeech.text_to_speech_stream")
     async def text_to_speech_stream(self, text: str) -> bytes:
         """入力テキストを音声(WAV)に変換する"""
-        text = self._convert_kanji_to_hiragana(text)
-        stream = client.text_to_speech.convert_as_stream(
-            voice_id=self._elevenlabs_voice_id,
-            output_format=self.output_format,
-            text=text,
-            model_id="eleven_multilingual_v2",
-            voice_settings=VoiceSettings(
-                stability=0.7,
-                similarity_boost=1.0,
-                style=0.0,
-                use_speaker_boost=True,
-            ),
-        )
+        current_span().set_attributes(text_chars=len(text), voice_id=self._elevenlabs_voice_id, output_format=self.output_format)
+        text = await self._convert_kanji_to_hiragana(text)
+
+        chunks = await elevenlabs_call.call(lambda: self._collect(self._elevenlabs_tts_stream(text)))
+        return await self._encode(chunks, native=self.audio_format.name in ELEVENLABS_OUTPUT_FORMATS)
 
-        return await self._stream_to_bytes(stream)
+    @traced("TextToSpeech.open_text_to_speech_stream")
+    async def open_text_to_speech_stream(self, text: str) -> AsyncIterator[bytes]:
+        """text_to_speech_stream のストリーミング版(最初の音声が届いた時点で、WAV を先頭から返すイテレータを返す)"""
+        current_span().set_attributes(text_chars=len(text), voice_id=self._elevenlabs_voice_id, output_format=self.output_format)
+        text = await self._convert_kanji_to_hiragana(text)
+        return await self._open_wav_stream(lambda: self._elevenlabs_tts_stream(text))
 
+    @traced("TextToSpeech.text_to_speech_with_azure_tts")
     async def text_to_speech_with_azure_tts(self, text: str) -> bytes:
         """入力テキストを Azure TTS -> AsyncElevenLabs STSで音声(WAV)に変換する"""
-        speech_synthesizer = AzureSpeechSynthesizer()
-        tts_data = speech_synthesizer.speech_synthesis_to_audio_data_stream(text)
-        tts_data = add_wav_header(tts_data)
+        current_span().set_attributes(text_chars=len(text), voice_id=self._elevenlabs_voice_id, output_format=self.output_format)
+        wav = await self.azure_tts_for_sts(text)
+        return await self.speech_to_speech(wav)
+
+    @traced("TextToSpeech.open_text_to_speech_with_azure_tts_stream")
+    async def open_text_to_speech_with_azure_tts_stream(self, text: str) -> AsyncIterator[bytes]:
+        """text_to_speech_with_azure_tts のストリーミング版(STS の最初の音声が届いた時点で、WAV を先頭から返すイテレータを返す)"""
+        current_span().set_attributes(text_chars=len(text), voice_id=self._elevenlabs_voice_id, output_format=self.output_format)
+        wav = await self.azure_tts_for_sts(text)
+        return await self.open_speech_to_speech_stream(wav)
+
+    @traced("TextToSpeech.azure_tts_for_sts")
+    async def azure_tts_for_sts(self, text: str) -> bytes:
+        """text_to_speech_with_azure_tts の前半: STS に渡す音声(WAV)を Azure TTS で合成する"""
+        tts_data = await self._azure_synthesize(text)
+        with stage_timer(STAGE_WAV_ASSEMBLY):
+            return add_wav_header(tts_data)
+
+    @traced("TextToSpeech.speech_to_speech")
+    async def speech_to_speech(self, wav: bytes) -> bytes:
+        """text_to_speech_with_azure_tts の後半: azure_tts_for_sts の音声を ElevenLabs STS で音声(audio_format)に変換する"""
+        current_span().set_attributes(input_bytes=len(wav), voice_id=self._elevenlabs_voice_id, output_format=self.output_format)
+        chunks = await elevenlabs_call.call(lambda: self._collect(self._elevenlabs_sts_stream(wav)))
+        return await self._encode(chunks, native=self.audio_format.name in ELEVENLABS_OUTPUT_FORMATS)
 
-        stream = client.speech_to_speech.convert_as_stream(
+    @traced("TextToSpeech.open_speech_to_speech_stream")
+    async def open_speech_to_speech_stream(self, wav: bytes) -> AsyncIterator[bytes]:
+        """speech_to_speech のストリーミング版(STS の最初の音声が届いた時点で、WAV を先頭から返すイテレータを返す)"""
+        current_span().set_attributes(input_bytes=len(wav), voice_id=self._elevenlabs_voice_id, output_format=self.output_format)
+        return await self._open_wav_stream(lambda: self._elevenlabs_sts_stream(wav))
+
+    @traced("TextToSpeech.azure_text_to_speech")
+    async def azure_text_to_speech(self, text: str, voice_name=AZURE_TTS_VOICE_NAME, rate=AZURE_TTS_RATE) -> bytes:
+        """入力テキストを Azure TTSで音声(audio_format)に変換する"""
+        current_span().set_attributes(text_chars=len(text), voice_name=voice_name, rate=rate)
+        native = AZURE_OUTPUT_FORMATS.get(self.audio_format.name)
+        tts_data = await self._azure_synthesize(
+            text, voice_name=voice_name, rate=rate, output_format=native or AZURE_OUTPUT_FORMATS[f"wav_{self._sample_rate}"]
+        )
+        return await self._encode([tts_data], native=native is not None)
+
+    async def _azure_synthesize(self, text: str, **synthesizer_kwargs) -> bytes:
+        """Azure TTS で合成した PCM を返す(合成パラメータごとのプールの synthesizer を使う)"""
+
+        async def synthesize() -> bytes:
+            tts_data = await self._service.azure_pool.synthesize(text, **synthesizer_kwargs)
+            if tts_data is None:
+                raise AzureSynthesisError("Azure TTS returned no audio")
+            return tts_data
+
+        return await azure_tts_call.call(synthesize)
+
+    def _elevenlabs_tts_stream(self, text: str) -> AsyncIterator[bytes]:
+        """ElevenLabs TTS のストリームを開く"""
+        return self._service.elevenlabs.text_to_speech.convert_as_stream(
             voice_id=self._elevenlabs_voice_id,
-            audio=tts_data,
             output_format=self.output_format,
-            model_id="eleven_multilingual_sts_v2",
-            voice_settings=json.dumps(
-                {
-                    "stability": 0.9,
-                    "similarity_boost": 1.0,
-                    "style": 0.0,
-                    "use_speaker_boost": True,
-                }
-            ),
+            text=text,
+            model_id=ELEVENLABS_TTS_MODEL,
+            voice_settings=lazy.VoiceSettings(**ELEVENLABS_TTS_VOICE_SETTINGS),
+        )
+
+    def _elevenlabs_sts_stream(self, wav: bytes) -> AsyncIterator[bytes]:
+        """ElevenLabs STS のストリームを開く"""
+        return self._service.elevenlabs.speech_to_speech.convert_as_stream(
+            voice_id=self._elevenlabs_voice_id,
+            audio=wav,
+            output_format=self.output_format,
+            model_id=ELEVENLABS_STS_MODEL,
+            voice_settings=json.dumps(ELEVENLABS_STS_VOICE_SETTINGS),
         )
 
-        return await self._stream_to_bytes(stream)
+    async def _open_wav_stream(self, open_stream: Callable[[], AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+        """ElevenLabs のストリームを開いて最初のチャンクを待ち、WAV ヘッダー(長さ未定)と PCM を届いた順に返すイテレータを返す
 
-    async def azure_text_to_speech(self, text: str, voice_name="ja-JP-NanamiNeural", rate="+10%") -> bytes:
-        """入力テキストを Azure TTSで音声(WAV)に変換する"""
-        speech_synthesizer = AzureSpeechSynthesizer(voice_name=voice_name, rate=rate)
-        tts_data = speech_synthesizer.speech_synthesis_to_audio_data_stream(text)
-        tts_data = add_wav_header(tts_data)
-        return tts_data
+        最初のチャンクが届くまではリトライ・ヘッジの対象にする(届いた後に失敗した場合は再試行できないので、音声が途中で切れる)
+        """
 
-    async def _stream_to_bytes(self, stream: AsyncIterator[bytes]) -> bytes:
-        """ストリームをバイト列(WAV)に変換する"""
+        async def first_chunk() -> tuple[bytes, AsyncIterator[bytes]]:
+            stream = open_stream()
+            return await anext(stream, b""), stream
+
+        with stage_timer(STAGE_TTS_FIRST_CHUNK):
+            # ヘッジで使わなかった方のストリームは閉じて接続を返す
+            first, stream = await elevenlabs_call.call(first_chunk, discard=lambda opened: opened[1].aclose())
+        return self._relay_wav(first, stream, span_recorder())
+
+    async def _relay_wav(self, first: bytes, stream: AsyncIterator[bytes], record_span: Callable[..., None]) -> AsyncIterator[bytes]:
+        # レスポンスの送信中は別のタスクで実行されるので、stage_timer ではなく終了時にまとめて記録する
+        start, start_ns = time.perf_counter(), time.time_ns()
+        chunks, size = 1, len(first)
+        error = None
+        # 先頭の無音は送らない(声が始まるまでのチャンクは空になる)
+        trimmer = LeadingSilenceTrimmer(self._sample_rate, self.postprocess) if self.postprocess.trim else None
+        try:
+            yield wav_header(sample_rate=self._sample_rate)
+            if trimmer is None:
+                yield first
+            elif audio := trimmer.feed(first):
+                yield audio
+            async for chunk in stream:
+                chunks += 1
+                size += len(chunk)
+                if trimmer is None:
+                    yield chunk
+                elif audio := trimmer.feed(chunk):
+                    yield audio
+            if trimmer is not None and (audio := trimmer.flush()):
+                # 無音だけの音声は、ストリーミングしない合成(_postprocess)と同じく落とさずに返す
+                LOGGER.warning("無音の音声のため先頭の無音を落とさずに返します")
+                record_fallback("postprocess", "untrimmed")
+                yield audio
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+            record_stage(STAGE_ELEVENLABS_STREAM, time.perf_counter() - start, error=error is not None)
+            record_span(STAGE_ELEVENLABS_STREAM, start_ns, error=error, chunks=chunks, bytes=size)
+
+    async def _collect(self, stream: AsyncIterator[bytes]) -> list[bytes]:
+        """ストリームのチャンクをすべて受け取る"""
         audio_data = []
-        async for chunk in stream:
-            audio_data.append(chunk)
+        with stage_timer(STAGE_ELEVENLABS_STREAM):
+            async for chunk in stream:
+                audio_data.append(chunk)
+        current_span().set_attribute("chunks", len(audio_data))
+        return audio_data
+
+    async def _encode(self, chunks: list[bytes], *, native: bool) -> bytes:
+        """受け取った音声を audio_format のバイト列にする
+
+        PCM なら WAV ヘッダーを付け、圧縮形式はプロバイダが直接出力したもの(native)はそのまま、そうでなければ PCM から変換する
+        """
+        if self.audio_format.is_pcm:
+            chunks = self._postprocess(chunks)
+            with stage_timer(STAGE_WAV_ASSEMBLY):
+                # チャンクを連結してからヘッダーを付けると2回コピーするので、ヘッダーとチャンクをまとめて連結する
+                audio = join_wav(chunks, sample_rate=self._sample_rate)
+        elif native:
+            audio = b"".join(chunks)
+        else:
+            pcm = b"".join(self._postprocess(chunks))
+            with stage_timer(STAGE_TRANSCODE):
+                audio = await transcode(pcm, self.audio_format)
+        current_span().set_attribute("bytes", len(audio))
+        return audio
 
-        return add_wav_header(b"".join(audio_data))
+    def stored_wav_parts(self, pcm_chunks: list[bytes], *, fallback: bool = False) -> list[bytes]:
+        """ストリーミングで送った PCM から、音声キャッシュに保存する(音声ファイル全体として返す) WAV の断片を作る
+
+        ストリーミングでは先頭の無音しか落とせないので、ストリーミングしない合成と同じ後処理をする
+        (無音だけなら、fallback なら後処理せずに作り、そうでなければ SilentAudioError)
+        """
+        return wav_parts(self._postprocess(pcm_chunks, fallback=fallback), sample_rate=self._sample_rate)
+
+    def _postprocess(self, chunks: list[bytes], *, fallback: bool = True) -> list[bytes]:
+        """PCM のチャンクに postprocess の後処理をする
+
+        無音だけの音声(句読点だけのテキストなど)は、fallback なら後処理せずにそのまま返し、そうでなければ SilentAudioError を送出する
+        """
+        if not self.postprocess.enabled:
+            return chunks
+        with stage_timer(STAGE_POSTPROCESS):
+            pcm = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+            try:
+                return [postprocess_pcm(pcm, self._sample_rate, self.postprocess)]
+            except SilentAudioError as e:
+                if not fallback:
+                    raise
+                LOGGER.warning(f"無音の音声のため後処理をせずに返します: {e}")
+                record_fallback("postprocess", "untrimmed")
+                return chunks
 
-    def _convert_kanji_to_hiragana(self, text):
+    async def _convert_kanji_to_hiragana(self, text: str) -> str:
         """テキストをひらがなに変換する"""
-        t = Tokenizer()
-        tokens = t.tokenize(text)
-        result = ""
-        for token in tokens:
-            surface = token.surface
-            reading = token.reading
-            if reading == "*":
-                # 記号や数字等の読みが取得できない場合はsurfaceをそのまま使う
-                result += surface
-            elif reading == jaconv.kata2hira(surface):
-                result += surface
-            elif reading == jaconv.hira2kata(surface):
-                result += surface
-            else:
-                result += jaconv.kata2hira(reading)
-        return result
+        return await to_hiragana_async(text)
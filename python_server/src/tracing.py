@@ -0,0 +1,325 @@
+import atexit
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+from src.config import settings
+
+LOGGER = logging.getLogger(__name__)
+
+# OTLP の SpanKind / StatusCode
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+
+@dataclass
+class Span:
+    """1つの処理区間"""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: str
+    kind: int = SPAN_KIND_INTERNAL
+    attributes: dict[str, Any] = field(default_factory=dict)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int = 0
+    status_code: int = STATUS_CODE_OK
+    status_message: str = ""
+    # 別のトレースの Span へのリンク((trace_id, span_id, 属性) のリスト)
+    links: list[tuple[str, str, dict[str, Any]]] = field(default_factory=list)
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """属性を追加する(None は記録しない)"""
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, **attributes: Any) -> None:
+        """複数の属性をまとめて追加する"""
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_link(self, other: "Span | _NoopSpan", **attributes: Any) -> None:
+        """other へのリンクを追加する(トレース外の Span へのリンクは記録しない)"""
+        if other.trace_id and other.span_id:
+            self.links.append((other.trace_id, other.span_id, attributes))
+
+
+class _NoopSpan:
+    """トレース外で呼ばれた場合に返す何も記録しない Span"""
+
+    trace_id = ""
+    span_id = ""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, **attributes: Any) -> None:
+        pass
+
+    def add_link(self, other: "Span | _NoopSpan", **attributes: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@dataclass
+class _Trace:
+    """1リクエスト分の Span の集まり"""
+
+    trace_id: str
+    spans: list[Span] = field(default_factory=list)
+    root: Span | None = None
+
+
+_current_trace: ContextVar[_Trace | None] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+def _new_id(n_bytes: int) -> str:
+    return os.urandom(n_bytes).hex()
+
+
+def current_trace_id() -> str:
+    """実行中のトレースID(トレース外では空文字)"""
+    trace = _current_trace.get()
+    return trace.trace_id if trace else ""
+
+
+def current_span() -> Span | _NoopSpan:
+    """実行中の Span(トレース外では何も記録しない Span)"""
+    if _current_trace.get() is None:
+        return _NOOP_SPAN
+    return _current_span.get() or _NOOP_SPAN
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Span]:
+    """トレースを開始する。ルート Span の終了時にトレース全体をエクスポートする"""
+    trace = _Trace(trace_id=_new_id(16))
+    trace_token = _current_trace.set(trace)
+    try:
+        with span(name, kind=SPAN_KIND_SERVER, **attributes) as root:
+            trace.root = root
+            yield root
+    finally:
+        _current_trace.reset(trace_token)
+        exporter.export(trace.spans)
+
+
+@contextmanager
+def span(name: str, *, kind: int = SPAN_KIND_INTERNAL, **attributes: Any) -> Iterator[Span | _NoopSpan]:
+    """現在の Span の子 Span を作る(トレース外では何も記録しない)
+
+    contextvars で親子関係を引き継ぐので、asyncio のタスクや asyncio.to_thread の中でも入れ子になる
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    current = Span(
+        name=name,
+        trace_id=trace.trace_id,
+        span_id=_new_id(8),
+        parent_span_id=parent.span_id if parent else "",
+        kind=kind,
+    )
+    current.set_attributes(**attributes)
+    span_token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status_code = STATUS_CODE_ERROR
+        current.status_message = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(span_token)
+        trace.spans.append(current)
+
+
+def span_recorder() -> Callable[..., None]:
+    """現在の Span の子として、完了した Span を後から記録する関数を返す
+
+    async generator のように、処理の途中で実行されるタスク(コンテキスト)が変わり span() が使えない場合に使う。
+    返した関数は record(name, start_ns, *, error=None, **attributes) の形で呼ぶ(トレース外では何もしない)。
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    if trace is None:
+        return lambda *args, **kwargs: None
+
+    def record(name: str, start_ns: int, *, error: BaseException | None = None, **attributes: Any) -> None:
+        recorded = Span(
+            name=name,
+            trace_id=trace.trace_id,
+            span_id=_new_id(8),
+            parent_span_id=parent.span_id if parent else "",
+            start_ns=start_ns,
+        )
+        recorded.set_attributes(**attributes)
+        if error is not None:
+            recorded.status_code = STATUS_CODE_ERROR
+            recorded.status_message = f"{type(error).__name__}: {error}"
+        recorded.end_ns = time.time_ns()
+        trace.spans.append(recorded)
+
+    return record
+
+
+def traced(name: str | None = None) -> Callable[[Callable], Callable]:
+    """関数の呼び出しを Span として記録するデコレータ(同期・非同期どちらにも使える)"""
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _encode_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _encode_span(s: Span) -> dict:
+    encoded = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [{"key": key, "value": _encode_value(value)} for key, value in s.attributes.items()],
+        "status": {"code": s.status_code},
+    }
+    if s.parent_span_id:
+        encoded["parentSpanId"] = s.parent_span_id
+    if s.status_message:
+        encoded["status"]["message"] = s.status_message
+    if s.links:
+        encoded["links"] = [
+            {
+                "traceId": trace_id,
+                "spanId": span_id,
+                "attributes": [{"key": key, "value": _encode_value(value)} for key, value in attributes.items()],
+            }
+            for trace_id, span_id, attributes in s.links
+        ]
+    return encoded
+
+
+def encode_otlp_json(spans: list[Span], service_name: str) -> dict:
+    """OTLP/JSON の ExportTraceServiceRequest に変換する"""
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": [_encode_span(s) for s in spans]}],
+            }
+        ]
+    }
+
+
+class TraceExporter:
+    """完了したトレースをバックグラウンドスレッドでエクスポートする
+
+    exporter="file": OTLP/JSON を1トレース1行で追記する(OpenTelemetry Collector の otlpjsonfile receiver で読める形式)
+    exporter="otlp": OTLP/HTTP(JSON) のコレクタに POST する
+    exporter="none": 何もしない
+    """
+
+    def __init__(self, exporter: str, *, file_path, endpoint: str, service_name: str) -> None:
+        if exporter not in ("file", "otlp", "none"):
+            raise ValueError(f"unknown trace exporter: {exporter}")
+        self.exporter = exporter
+        self.file_path = file_path
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self._queue: queue.SimpleQueue[list[Span] | None] = queue.SimpleQueue()
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[Span]) -> None:
+        """トレースをキューに積む(リクエスト処理はブロックしない)"""
+        if self.exporter == "none" or not spans:
+            return
+        self._ensure_worker()
+        self._queue.put(spans)
+
+    def shutdown(self) -> None:
+        """キューに残ったトレースを書き出してワーカーを止める"""
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join(timeout=5)
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        client = None
+        if self.exporter == "otlp":
+            import httpx
+
+            client = httpx.Client(timeout=5)
+        try:
+            while (spans := self._queue.get()) is not None:
+                try:
+                    payload = encode_otlp_json(spans, self.service_name)
+                    if client is not None:
+                        client.post(self.endpoint, json=payload).raise_for_status()
+                    else:
+                        with open(self.file_path, "a", encoding="utf-8") as f:
+                            f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+                except Exception as e:
+                    LOGGER.warning(f"トレースのエクスポートに失敗: {e}")
+        finally:
+            if client is not None:
+                client.close()
+
+
+exporter = TraceExporter(
+    settings.TRACE_EXPORTER,
+    file_path=settings.TRACE_FILE_PATH,
+    endpoint=settings.TRACE_OTLP_ENDPOINT,
+    service_name=settings.TRACE_SERVICE_NAME,
+)
+atexit.register(exporter.shutdown)
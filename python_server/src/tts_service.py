@@ -0,0 +1,109 @@
+import asyncio
+import functools
+import importlib.util
+import logging
+from collections.abc import AsyncIterator, Callable
+
+import httpx
+
+from src import lazy_imports as lazy
+from src.azure_synthesizer_pool import AzureSynthesizerPool
+from src.config import settings
+from src.metrics import STAGE_ELEVENLABS_SLOT_WAIT, stage_timer
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """レスポンスの本文を閉じたときに release を1回だけ呼ぶ"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]) -> None:
+        self._stream = stream
+        self._release: Callable[[], None] | None = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release, release = None, self._release
+                release()
+
+
+class _ConcurrencyLimitedTransport(httpx.AsyncBaseTransport):
+    """同時に送るリクエスト数を制限するトランスポート(枠はレスポンスの本文を閉じるまで取ったままにする)"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, *, concurrency: int, wait_stage: str) -> None:
+        self._transport = transport
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wait_stage = wait_stage
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        with stage_timer(self._wait_stage):
+            await self._slots.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._slots.release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, self._slots.release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _elevenlabs_http_client() -> httpx.AsyncClient:
+    http2 = settings.ELEVENLABS_HTTP2 and importlib.util.find_spec("h2") is not None
+    if settings.ELEVENLABS_HTTP2 and not http2:
+        LOGGER.warning("h2 がインストールされていないため、ElevenLabs には HTTP/1.1 で接続します")
+    transport = httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=settings.ELEVENLABS_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.ELEVENLABS_MAX_CONNECTIONS,
+            keepalive_expiry=settings.ELEVENLABS_KEEPALIVE_EXPIRY_SEC,
+        ),
+    )
+    return httpx.AsyncClient(
+        transport=_ConcurrencyLimitedTransport(
+            transport, concurrency=settings.ELEVENLABS_MAX_CONCURRENCY, wait_stage=STAGE_ELEVENLABS_SLOT_WAIT
+        ),
+        timeout=settings.ELEVENLABS_TIMEOUT_SEC,
+    )
+
+
+class TTSService:
+    """アプリ全体で共有する TTS プロバイダの接続と同時実行数の枠
+
+    FastAPI の lifespan で1つ作って app.state.tts に置き、/voice* のハンドラーには依存関係(src.web.api.get_tts_service)で渡す。
+    - ElevenLabs: keep-alive(HTTP/2)の接続プールを共有し、同時リクエスト数を ELEVENLABS_MAX_CONCURRENCY までにする
+    - Azure TTS: 接続を開いたままの synthesizer のプールを共有し、全体の同時合成数を AZURE_TTS_MAX_CONCURRENCY までにする
+    """
+
+    def __init__(self) -> None:
+        self.elevenlabs_http = _elevenlabs_http_client()
+        self.azure_pool = AzureSynthesizerPool(
+            size=settings.AZURE_TTS_POOL_SIZE, threads=settings.AZURE_TTS_POOL_THREADS, concurrency=settings.AZURE_TTS_MAX_CONCURRENCY
+        )
+
+    @functools.cached_property
+    def elevenlabs(self) -> "lazy.AsyncElevenLabs":
+        """ElevenLabs のクライアント(SDK の import が重いので、初めて使うときに作る)"""
+        return lazy.AsyncElevenLabs(
+            api_key=settings.ELEVENLABS_API_KEY,
+            timeout=settings.ELEVENLABS_TIMEOUT_SEC,
+            httpx_client=self.elevenlabs_http,
+        )
+
+    async def aclose(self) -> None:
+        await self.elevenlabs_http.aclose()
+        self.azure_pool.close()
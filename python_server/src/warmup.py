@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from src.audio_cache import audio_cache
+from src.config import settings
+from src.get_faiss_vector import get_hybrid_knowledge, preload_indices
+from src.gpt import check_ng, generate_response
+from src.model_router import CALL_SITE_GENERATION, model_router
+from src.reading import to_hiragana_batch
+from src.text_to_speech import AZURE_TTS_RATE, AZURE_TTS_VOICE_NAME, TextToSpeech
+from src.tts_service import TTSService
+
+LOGGER = logging.getLogger(__name__)
+
+
+# 音声合成プロバイダのウォームアップの状態
+PROVIDER_PENDING = "pending"
+PROVIDER_OK = "ok"
+PROVIDER_FAILED = "failed"
+
+
+@dataclass
+class WarmupState:
+    """ウォームアップの進捗(/ready で返す)
+
+    音声合成プロバイダのウォームアップは WARMUP_TTS_MAX_ATTEMPTS 回で打ち切り、失敗したプロバイダは providers に failed として残す(ready は妨げない)
+    """
+
+    ready: bool = False
+    attempts: int = 0
+    step_seconds: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+    # プロバイダ -> PROVIDER_PENDING / PROVIDER_OK / PROVIDER_FAILED
+    providers: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def degraded(self) -> list[str]:
+        """ウォームアップに失敗したプロバイダ"""
+        return [name for name, status in self.providers.items() if status == PROVIDER_FAILED]
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "attempts": self.attempts,
+            "step_seconds": self.step_seconds,
+            "error": self.error,
+            "providers": self.providers,
+            "degraded": self.degraded,
+        }
+
+
+async def _warm_up_indices() -> None:
+    await asyncio.to_thread(preload_indices)
+    if settings.TTS_CACHE_ENABLED:
+        # 音声キャッシュの索引(ディレクトリの走査)も先に作っておく
+        await asyncio.to_thread(len, audio_cache)
+
+
+async def _warm_up_analyzers() -> None:
+    check_ng(settings.WARMUP_QUERY)
+    # 辞書の読み込みと初回の解析を、読みの変換用スレッドでまとめて済ませる
+    await to_hiragana_batch([settings.WARMUP_QUERY])
+
+
+async def _warm_up_gemini() -> None:
+    # 短い質問は flash、長い質問は pro にルーティングされるので、両方の接続を開いておく
+    for query in ("ウォームアップ", settings.WARMUP_QUERY):
+        await model_router.generate(CALL_SITE_GENERATION, "「OK」とだけ返答してください。", query=query)
+
+
+async def _warm_up_reply() -> None:
+    # 埋め込みの接続を開く(失敗したらウォームアップ失敗とする)
+    await asyncio.to_thread(get_hybrid_knowledge, query=settings.WARMUP_QUERY, top_k=15)
+    await generate_response(settings.WARMUP_QUERY, skip_logging=True)
+
+
+async def _warm_up_azure_tts(tts: TTSService) -> None:
+    # 接続を開いた synthesizer をプールの上限まで用意しておく(/voice/v2 と /voice/azure の既定の設定)
+    await tts.azure_pool.prefill()
+    await tts.azure_pool.prefill(voice_name=AZURE_TTS_VOICE_NAME, rate=AZURE_TTS_RATE)
+    await TextToSpeech(tts).azure_text_to_speech(settings.WARMUP_TTS_TEXT)
+
+
+async def _warm_up_elevenlabs(tts: TTSService) -> None:
+    # 合成して接続プールに接続を開いておく
+    await TextToSpeech(tts).text_to_speech_stream(settings.WARMUP_TTS_TEXT)
+
+
+def warmup_steps() -> list[tuple[str, Callable[[], Awaitable[None]]]]:
+    """ready にするのに必要なウォームアップの手順(実行順に並べる)"""
+    return [
+        ("indices", _warm_up_indices),
+        ("analyzers", _warm_up_analyzers),
+        ("gemini", _warm_up_gemini),
+        ("reply", _warm_up_reply),
+    ]
+
+
+def provider_warmup_steps(tts: TTSService) -> list[tuple[str, Callable[[], Awaitable[None]]]]:
+    """音声合成プロバイダごとのウォームアップの手順(WARMUP_TTS_TEXT が空なら行わない)"""
+    if not settings.WARMUP_TTS_TEXT:
+        return []
+    return [
+        ("azure_tts", lambda: _warm_up_azure_tts(tts)),
+        ("elevenlabs", lambda: _warm_up_elevenlabs(tts)),
+    ]
+
+
+async def _run_step(state: WarmupState, name: str, step: Callable[[], Awaitable[None]]) -> None:
+    start = time.monotonic()
+    await step()
+    state.step_seconds[name] = round(time.monotonic() - start, 3)
+    LOGGER.info(f"ウォームアップ: {name} ({state.step_seconds[name]:.2f}s)")
+
+
+async def warm_up(state: WarmupState) -> None:
+    """index・解析器の読み込み、Gemini への接続、合成クエリの実行を順に行う(前回までに済んだ手順は飛ばす)"""
+    state.attempts += 1
+    for name, step in warmup_steps():
+        if name not in state.step_seconds:
+            await _run_step(state, name, step)
+
+
+async def warm_up_provider(state: WarmupState, name: str, step: Callable[[], Awaitable[None]]) -> None:
+    """音声合成プロバイダのウォームアップ。課金される合成を繰り返さないよう WARMUP_TTS_MAX_ATTEMPTS 回で打ち切る"""
+    state.providers[name] = PROVIDER_PENDING
+    for attempt in range(1, settings.WARMUP_TTS_MAX_ATTEMPTS + 1):
+        try:
+            await _run_step(state, name, step)
+        except Exception:
+            if attempt == settings.WARMUP_TTS_MAX_ATTEMPTS:
+                LOGGER.exception(f"ウォームアップ失敗: {name} ({attempt}回目)。このプロバイダはウォームアップせずに ready にします")
+                state.providers[name] = PROVIDER_FAILED
+                return
+            LOGGER.exception(f"ウォームアップ失敗: {name} ({attempt}回目)。{settings.WARMUP_RETRY_INTERVAL_SEC}秒後に再試行します")
+            await asyncio.sleep(settings.WARMUP_RETRY_INTERVAL_SEC)
+        else:
+            state.providers[name] = PROVIDER_OK
+            return
+
+
+async def warm_up_until_ready(state: WarmupState, tts: TTSService) -> None:
+    """ウォームアップが成功するまで繰り返し、音声合成プロバイダのウォームアップを(失敗しても)終えたら ready にする"""
+    if not settings.WARMUP_ENABLED:
+        state.ready = True
+        return
+    while True:
+        try:
+            await warm_up(state)
+        except Exception as e:
+            state.error = f"{type(e).__name__}: {e}"
+            LOGGER.exception(f"ウォームアップ失敗 ({state.attempts}回目)。{settings.WARMUP_RETRY_INTERVAL_SEC}秒後に再試行します")
+            await asyncio.sleep(settings.WARMUP_RETRY_INTERVAL_SEC)
+        else:
+            state.error = None
+            break
+    # プロバイダごとに独立して試すので、1つが落ちていても他のプロバイダの待ち時間は延びない
+    await asyncio.gather(*(warm_up_provider(state, name, step) for name, step in provider_warmup_steps(tts)))
+    state.ready = True
+    if state.degraded:
+        LOGGER.warning(f"ウォームアップ完了(失敗したプロバイダ: {state.degraded}): {state.step_seconds}")
+    else:
+        LOGGER.info(f"ウォームアップ完了: {state.step_seconds}")
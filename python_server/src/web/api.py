@@ -1,34 +1,86 @@
+import asyncio
 import datetime
+import functools
+import logging
 import pathlib
 import random
-from collections.abc import Iterator
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request
-from fastapi.responses import ORJSONResponse, Response
+from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request, WebSocket
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from sqlalchemy.orm import Session
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from src.audio_cache import audio_cache, audio_cache_key
+from src.audio_format import AZURE_OUTPUT_FORMATS, ELEVENLABS_OUTPUT_FORMATS, AudioFormat, negotiate_audio_format, transcoder_available
+from src.audio_handles import AudioHandle, AudioHandleError, AudioHandleStore
+from src.audio_postprocess import SilentAudioError, postprocess_for
 from src.config import settings
 from src.databases.engine import session_scope
+from src.deadline import Deadline
 from src.get_faiss_vector import get_multiple_qa
-from src.gpt import DocumentRetrievalType, generate_hallucination_response, generate_response
+from src.gpt import DocumentRetrievalType, comment_batcher, generate_hallucination_response, generate_response
 from src.logger import setup_logger
+from src.metrics import STAGE_REPLY, record_cache, record_session, record_session_slow_disconnect, render_metrics, stage_timer
 # YouTube関連リポジトリは削除済み
 from src.schema.hallucination import HallucinationRequest, HallucinationResponse
+from src.schema.session import (
+    AudioMessage,
+    CancelMessage,
+    DoneMessage,
+    ErrorMessage,
+    QuestionMessage,
+    ReplyTextMessage,
+    SlideMessage,
+    TemplateMessage,
+    client_message_adapter,
+)
+from src.send_queue import SendQueue, SendQueueClosedError, SendQueueFullError
+from src.sentence_pipeline import WAV_HEADER_SIZE, backend_slot, open_sentence_pipeline, prime, split_for_synthesis
+from src.single_flight import SingleFlight
+from src.template_pack import template_pack
 from src.templates import TEMPLATE_MESSAGES, TEMPLATE_QUESTIONS
 from src.text_to_speech import TextToSpeech
+from src.tracing import current_trace_id, start_trace
+from src.tts_service import TTSService
+from src.warmup import WarmupState, warm_up_until_ready
 # YouTube関連はすべて削除済み
 
 setup_logger()
 
+LOGGER = logging.getLogger(__name__)
+
 
 # フィルタリング機能削除済み
 
 
+warmup_state = WarmupState()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時に TTS の接続(app.state.tts)と先行合成の置き場(app.state.audio_handles)を用意してウォームアップをバックグラウンドで開始し、終了時に後片付けする"""
+    app.state.tts = TTSService()
+    app.state.audio_handles = AudioHandleStore(
+        max_entries=settings.AUDIO_HANDLE_MAX_ENTRIES, max_bytes=settings.AUDIO_HANDLE_MAX_BYTES, ttl_sec=settings.AUDIO_HANDLE_TTL_SEC
+    )
+    warmup_task = asyncio.create_task(warm_up_until_ready(warmup_state, app.state.tts))
+    yield
+    warmup_task.cancel()
+    await asyncio.gather(warmup_task, return_exceptions=True)
+    await comment_batcher.close()
+    await app.state.audio_handles.close()
+    await app.state.tts.aclose()
+
+
 app = FastAPI(
     default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 # proxy機能は削除済み
 
@@ -40,6 +92,342 @@ t_fmt = current_time.strftime("%Y%m%d_%H%M%S")
 log_filename_json = pathlib.Path(__file__).parent.parent.parent / "log" / f"log_{t_fmt}.json"
 log_filename_csv = pathlib.Path(__file__).parent.parent.parent / "log" / f"log_{t_fmt}.csv"
 
+# リクエスト単位でトレースを記録するパス
+TRACED_PATHS = {
+    "/reply",
+    "/voice",
+    "/voice/v2",
+    "/voice/azure",
+    "/voice/male",
+    "/voice/stream",
+    "/voice/v2/stream",
+    "/voice/azure/stream",
+    "/voice/male/stream",
+    "/hallucination",
+}
+TRACE_ID_HEADER = "X-Trace-Id"
+
+# 同一内容の同時リクエストは1回の処理にまとめる
+reply_flight = SingleFlight("reply")
+voice_flight = SingleFlight("voice")
+
+
+# /voice* のエンドポイント -> (TextToSpeech の合成メソッド, 引数)
+VOICE_SYNTHESIS = {
+    "voice": ("text_to_speech_stream", {}),
+    "voice/v2": ("text_to_speech_with_azure_tts", {}),
+    "voice/azure": ("azure_text_to_speech", {}),
+    "voice/male": ("azure_text_to_speech", {"voice_name": "ja-JP-KeitaNeural"}),
+}
+# /voice*/stream で使うストリーミング版の合成メソッド(音声キャッシュは対応する /voice* と共有する)
+# ここにないものは常に文単位のパイプライン合成で返す
+VOICE_STREAMING = {
+    "voice": "open_text_to_speech_stream",
+    "voice/v2": "open_text_to_speech_with_azure_tts_stream",
+}
+# 文単位のパイプライン合成で同時合成数を制限するバックエンド(/voice/v2 は STS がボトルネック)
+VOICE_BACKENDS = {
+    "voice": "elevenlabs",
+    "voice/v2": "elevenlabs",
+    "voice/azure": "azure",
+    "voice/male": "azure",
+}
+# Azure TTS -> ElevenLabs STS で合成するエンドポイント
+# 文単位のパイプライン合成では、文ごとに Azure TTS と STS の枠を別々に取り、STS の枠を待つ間も後の文の Azure TTS を進める
+VOICE_STS_CHAINS = {"voice/v2"}
+# エンドポイントごとの PCM の後処理(TTS_POSTPROCESS。設定の誤りは起動時に分かるようにここで読む)
+VOICE_POSTPROCESS = {voice: postprocess_for(voice) for voice in VOICE_SYNTHESIS}
+# バックエンド -> プロバイダが直接出力できる形式(ここにない圧縮形式は ffmpeg で変換する)
+NATIVE_AUDIO_FORMATS = {
+    "elevenlabs": ELEVENLABS_OUTPUT_FORMATS,
+    "azure": AZURE_OUTPUT_FORMATS,
+}
+
+
+def _negotiate_audio_format(request: Request, voice: str, *, streaming: bool = False) -> AudioFormat:
+    """format クエリか Accept ヘッダーから出力形式を決める(返せない形式なら 400 / 406)"""
+    return _audio_format_for(voice, request.query_params.get("format"), request.headers.get("accept"), streaming=streaming)
+
+
+def _audio_format_for(voice: str, name: str | None, accept: str | None = None, *, streaming: bool = False) -> AudioFormat:
+    try:
+        audio_format = negotiate_audio_format(name, accept, servable=lambda candidate: _servable(voice, candidate, streaming=streaming))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    if audio_format.is_pcm:
+        return audio_format
+    if streaming:
+        # ストリーミングは WAV ヘッダー + PCM を届いた順に流すので、圧縮形式には対応しない
+        raise HTTPException(status_code=406, detail=f"{audio_format.name} is not available for streaming (use wav_*)")
+    if not _servable(voice, audio_format, streaming=streaming):
+        raise HTTPException(status_code=406, detail=f"{audio_format.name} is not available for /{voice}")
+    return audio_format
+
+
+def _servable(voice: str, audio_format: AudioFormat, *, streaming: bool) -> bool:
+    """voice のエンドポイントが audio_format で返せるか"""
+    if audio_format.is_pcm:
+        return True
+    if streaming:
+        return False
+    return audio_format.name in NATIVE_AUDIO_FORMATS[VOICE_BACKENDS[voice]] or transcoder_available()
+
+
+async def _template_audio(voice: str, text: str, audio_format: AudioFormat) -> Response | None:
+    """テンプレートパックに audio_format で事前合成済みの音声があれば返す"""
+    path = template_pack.audio_path(voice, text, audio_format.name)
+    record_cache("template_pack_audio", path is not None)
+    if path is None:
+        return None
+    return Response(content=await asyncio.to_thread(path.read_bytes), media_type=audio_format.media_type)
+
+
+async def _stored_audio(voice: str, text: str, key: str, audio_format: AudioFormat) -> Response | None:
+    """テンプレートパック、音声キャッシュの順に探し、保存済みの音声があれば返す
+
+    音声キャッシュのファイルは返す前に別のリクエストの保存で追い出されることがあるので、パスではなく読み込んだ音声を返す
+    """
+    if (packed := await _template_audio(voice, text, audio_format)) is not None:
+        return packed
+    if not settings.TTS_CACHE_ENABLED:
+        return None
+    cached = await asyncio.to_thread(audio_cache.read, key)
+    record_cache("tts_audio", cached is not None)
+    if cached is None:
+        return None
+    audio, media_type = cached
+    return Response(content=audio, media_type=media_type)
+
+
+async def _voice_audio(text_to_speech: TextToSpeech, voice: str, text: str) -> bytes:
+    """保存済みの WAV があれば読み込み、なければ合成して音声キャッシュに保存する(文単位のパイプライン合成で1文ごとに使う)"""
+    key = _voice_cache_key(text_to_speech, voice, text)
+    stored = await _stored_audio(voice, text, key, text_to_speech.audio_format)
+    if stored is not None and stored.media_type == "audio/wav":
+        return stored.body
+    return await _synthesize_voice(text_to_speech, voice, text, key, pipelined=True)
+
+
+async def _synthesize_voice(text_to_speech: TextToSpeech, voice: str, text: str, key: str, *, pipelined: bool = False) -> bytes:
+    """合成して音声キャッシュに保存する(同じテキストの同時リクエストは1回の合成にまとめる)
+
+    pipelined なら文単位のパイプライン合成用に、まとめた合成の中でバックエンドの枠を取る(Azure TTS -> STS は段階ごとに取る)。
+    待っているリクエストがすべてキャンセルされたら合成もやめる
+    """
+
+    async def synthesize() -> bytes:
+        method, kwargs = VOICE_SYNTHESIS[voice]
+        if pipelined and voice in VOICE_STS_CHAINS:
+            audio = await _synthesize_sts_chain(text_to_speech, text)
+        elif pipelined:
+            # 相乗りしたリクエストの分もこの枠で数える
+            async with backend_slot(VOICE_BACKENDS[voice]):
+                audio = await getattr(text_to_speech, method)(text, **kwargs)
+        else:
+            audio = await getattr(text_to_speech, method)(text, **kwargs)
+        await _store_audio(key, audio, suffix=text_to_speech.audio_format.suffix)
+        return audio
+
+    # 大文字・小文字や全角・半角で読みが変わりうるので、テキストは正規化せずにまとめる
+    return await voice_flight.do((voice, text_to_speech.audio_format.name, text), synthesize)
+
+
+async def _synthesize_sts_chain(text_to_speech: TextToSpeech, text: str) -> bytes:
+    """text_to_speech_with_azure_tts と同じ音声を、Azure TTS は azure、STS は elevenlabs の枠で合成する"""
+    async with backend_slot("azure"):
+        wav = await text_to_speech.azure_tts_for_sts(text)
+    async with backend_slot("elevenlabs"):
+        return await text_to_speech.speech_to_speech(wav)
+
+
+async def _open_sts_chain_stream(text_to_speech: TextToSpeech, text: str) -> AsyncIterator[bytes]:
+    """_synthesize_sts_chain のストリーミング版(STS の枠は流し終えるまで取ったままにする)"""
+    # 枠はイテレータの中で取るので、返したイテレータが読まれずに捨てられても枠は返る
+    return await prime(_sts_chain_chunks(text_to_speech, text))
+
+
+async def _sts_chain_chunks(text_to_speech: TextToSpeech, text: str) -> AsyncIterator[bytes]:
+    async with backend_slot("azure"):
+        wav = await text_to_speech.azure_tts_for_sts(text)
+    async with backend_slot("elevenlabs"):
+        chunks = await text_to_speech.open_speech_to_speech_stream(wav)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+
+async def _store_audio(key: str, audio: bytes | list[bytes], *, suffix: str = ".wav") -> None:
+    """合成した音声を音声キャッシュに保存する(保存できなくても合成した音声は返せるので、失敗は警告のみ)"""
+    if not settings.TTS_CACHE_ENABLED:
+        return
+    try:
+        await asyncio.to_thread(functools.partial(audio_cache.put, key, audio, suffix=suffix))
+    except OSError as e:
+        LOGGER.warning(f"音声キャッシュへの保存に失敗: {e}")
+
+
+def _voice_cache_key(text_to_speech: TextToSpeech, voice: str, text: str) -> str:
+    method, kwargs = VOICE_SYNTHESIS[voice]
+    return audio_cache_key(text, **text_to_speech.cache_params(method, **kwargs))
+
+
+async def _voice_response(tts: TTSService, voice: str, text: str, audio_format: AudioFormat) -> Response:
+    """保存済みの音声があれば返し、なければ合成して音声キャッシュに保存する"""
+    text_to_speech = TextToSpeech(tts, audio_format, VOICE_POSTPROCESS[voice])
+    key = _voice_cache_key(text_to_speech, voice, text)
+    if (stored := await _stored_audio(voice, text, key, audio_format)) is not None:
+        stored.headers["Vary"] = "Accept"
+        return stored
+
+    audio = await _synthesize_voice(text_to_speech, voice, text, key)
+    # 出力形式は Accept ヘッダーでも変わる
+    return Response(content=audio, media_type=audio_format.media_type, headers={"Vary": "Accept"})
+
+
+async def _voice_stream_response(tts: TTSService, voice: str, text: str, audio_format: AudioFormat) -> Response:
+    """保存済みの音声があれば返し、なければ合成しながら返す(最後まで送れたら音声キャッシュに保存する)
+
+    複数の文からなるテキストは、文ごとに並行して合成して文の順に返す(文ごとの音声も音声キャッシュに保存し、別の回答でも使い回す)。
+    最初の音声が届くまでに失敗した場合は通常のエラーレスポンスになる。テキスト全体が同じ同時リクエストはまとめない。
+    audio_format は WAV のみ
+    """
+    text_to_speech = TextToSpeech(tts, audio_format, VOICE_POSTPROCESS[voice])
+    key = _voice_cache_key(text_to_speech, voice, text)
+    if (stored := await _stored_audio(voice, text, key, audio_format)) is not None:
+        stored.headers["Vary"] = "Accept"
+        return stored
+    # 出力形式は Accept ヘッダーでも変わる
+    return StreamingResponse(await _open_voice_chunks(text_to_speech, voice, text, key), media_type="audio/wav", headers={"Vary": "Accept"})
+
+
+async def _open_voice_chunks(text_to_speech: TextToSpeech, voice: str, text: str, key: str) -> AsyncIterator[bytes]:
+    """合成しながら WAV ヘッダー(長さ未定) + PCM を返すイテレータを開く(最後まで流せたら音声キャッシュに保存する)"""
+    sentences = split_for_synthesis(text) or [text]
+    streaming = voice in VOICE_STREAMING
+    if streaming and (not settings.TTS_PIPELINE_ENABLED or len(sentences) == 1):
+        chunks = await _open_provider_stream(text_to_speech, voice, text)
+        return _store_after_streaming(key, chunks, text_to_speech)
+
+    chunks = await open_sentence_pipeline(
+        sentences,
+        lambda sentence: _voice_audio(text_to_speech, voice, sentence),
+        # 最初の文のストリームの枠(Azure TTS -> STS はストリームの中で段階ごとに枠を取る)
+        backend=None if voice in VOICE_STS_CHAINS else VOICE_BACKENDS[voice],
+        # プロバイダのストリーミングが使えれば、最初の文は届いた順に流す
+        open_stream=(lambda sentence: _open_voice_stream(text_to_speech, voice, sentence)) if streaming else None,
+        sample_rate=text_to_speech.audio_format.sample_rate,
+    )
+    if len(sentences) == 1:
+        # 1文だけなら、文ごとの保存でテキスト全体も保存済み
+        return chunks
+    return _store_after_streaming(key, chunks, text_to_speech)
+
+
+async def _open_provider_stream(text_to_speech: TextToSpeech, voice: str, text: str) -> AsyncIterator[bytes]:
+    _, kwargs = VOICE_SYNTHESIS[voice]
+    return await getattr(text_to_speech, VOICE_STREAMING[voice])(text, **kwargs)
+
+
+async def _open_voice_stream(text_to_speech: TextToSpeech, voice: str, text: str) -> AsyncIterator[bytes]:
+    """保存済みの WAV があればそれを、なければプロバイダのストリームを返す(どちらも WAV ヘッダー + PCM の順)"""
+    key = _voice_cache_key(text_to_speech, voice, text)
+    stored = await _stored_audio(voice, text, key, text_to_speech.audio_format)
+    if stored is not None and stored.media_type == "audio/wav":
+        return _wav_chunks(stored.body)
+    if voice in VOICE_STS_CHAINS:
+        chunks = await _open_sts_chain_stream(text_to_speech, text)
+    else:
+        chunks = await _open_provider_stream(text_to_speech, voice, text)
+    return _store_after_streaming(key, chunks, text_to_speech)
+
+
+async def _wav_chunks(wav: bytes) -> AsyncIterator[bytes]:
+    yield wav[:WAV_HEADER_SIZE]
+    yield wav[WAV_HEADER_SIZE:]
+
+
+async def _store_after_streaming(key: str, chunks: AsyncIterator[bytes], text_to_speech: TextToSpeech) -> AsyncIterator[bytes]:
+    """chunks(長さ未定の WAV ヘッダー + PCM)をそのまま流し、最後まで送れたら長さ入りの WAV にして保存する"""
+    # 先頭は WAV ヘッダー
+    yield await anext(chunks)
+    pcm = []
+    async for chunk in chunks:
+        pcm.append(chunk)
+        yield chunk
+    try:
+        parts = text_to_speech.stored_wav_parts(pcm)
+    except SilentAudioError as e:
+        LOGGER.warning(f"無音の音声は音声キャッシュに保存しません: {e}")
+        return
+    # 連結せずにヘッダーとチャンクを順に書き込む
+    await _store_audio(key, parts)
+
+
+async def _presynthesize(tts: TTSService, handle: AudioHandle, reply_trace_id: str) -> None:
+    """/reply の回答を /voice* と同じ手順で先行して合成し、handle にチャンクを溜める
+
+    WAV は合成しながら(文単位のパイプライン合成・プロバイダのストリーミング)溜め、圧縮形式は合成し終えてから溜める。
+    同じテキストの /voice* は音声キャッシュと single-flight で同じ合成を使う
+    """
+    with start_trace("presynthesize", voice=handle.voice, audio_id=handle.id, **{"reply.trace_id": reply_trace_id}):
+        text_to_speech = TextToSpeech(tts, handle.audio_format, VOICE_POSTPROCESS[handle.voice])
+        key = _voice_cache_key(text_to_speech, handle.voice, handle.text)
+        if (stored := await _stored_audio(handle.voice, handle.text, key, handle.audio_format)) is not None:
+            handle.append(stored.body)
+            return
+        if not handle.audio_format.is_pcm:
+            handle.append(await _synthesize_voice(text_to_speech, handle.voice, handle.text, key))
+            return
+        handle.streamed_wav = True
+        async for chunk in await _open_voice_chunks(text_to_speech, handle.voice, handle.text, key):
+            handle.append(chunk)
+
+
+async def _handle_audio(tts: TTSService, handle: AudioHandle) -> Response:
+    """先行合成が終わるのを待って音声ファイル全体を返す"""
+    chunks = await handle.wait()
+    if not handle.streamed_wav:
+        return Response(content=b"".join(chunks), media_type=handle.audio_format.media_type)
+    # 合成しながら溜めた WAV はヘッダーの長さが未定なので、保存済みの(後処理を済ませた)ファイルがあればそれを返す
+    text_to_speech = TextToSpeech(tts, handle.audio_format, VOICE_POSTPROCESS[handle.voice])
+    key = _voice_cache_key(text_to_speech, handle.voice, handle.text)
+    if (stored := await _stored_audio(handle.voice, handle.text, key, handle.audio_format)) is not None:
+        return stored
+    # 保存できなかった場合も、/voice* と同じ後処理をしてから返す
+    return Response(content=b"".join(text_to_speech.stored_wav_parts(chunks[1:], fallback=True)), media_type="audio/wav")
+
+
+async def _handle_stream(handle: AudioHandle) -> AsyncIterator[bytes]:
+    """先行合成の最初のチャンクが届くまで待ち、溜まった分から順に返すイテレータを返す(最初のチャンクまでの失敗は通常のエラーレスポンスになる)"""
+    chunks = handle.iter_chunks()
+    first = await anext(chunks, b"")
+    return _prepend(first, chunks)
+
+
+async def _prepend(first: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+def get_tts_service(request: Request) -> TTSService:
+    """lifespan で作った TTSService"""
+    return request.app.state.tts
+
+
+def get_audio_handles(request: Request) -> AudioHandleStore:
+    """lifespan で作った AudioHandleStore"""
+    return request.app.state.audio_handles
+
+
+def _get_audio_handle(audio_id: str, handles: AudioHandleStore = Depends(get_audio_handles)) -> AudioHandle:
+    handle = handles.get(audio_id)
+    if handle is None:
+        raise HTTPException(status_code=404, detail=f"audio {audio_id} is not found or has expired")
+    return handle
+
 
 def get_session(request: Request) -> Iterator[Session]:
     """Get session from Session Local"""
@@ -47,76 +435,371 @@ def get_session(request: Request) -> Iterator[Session]:
         yield session
 
 
+class TraceRequestMiddleware:
+    """/reply, /voice* などのリクエストごとにトレースを記録し、トレースIDをレスポンスヘッダーで返す
+
+    ルート Span はレスポンス本文を送り終える(または中断される)まで続け、ストリーミング中の子 Span も同じトレースに記録する
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] not in TRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        method, path = scope["method"], scope["path"]
+        with start_trace(f"{method} {path}", **{"http.method": method, "http.route": path}) as root:
+
+            async def send_with_trace_id(message: Message) -> None:
+                if message["type"] == "http.response.start":
+                    root.set_attribute("http.status_code", message["status"])
+                    MutableHeaders(scope=message).append(TRACE_ID_HEADER, root.trace_id)
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+
+
+app.add_middleware(TraceRequestMiddleware)
+
+
 @app.post("/reply")
-async def reply(inputtext: str = Form(...)):
-    """GPT に問い合わせた回答結果を取得する"""
-    res1, res2 = await generate_response(
-        text=inputtext, log_filename_json=log_filename_json, log_filename_csv=log_filename_csv, doc_retrieval_type=DocumentRetrievalType.multi, check_hal=True
-    )
+async def reply(
+    inputtext: str = Form(...),
+    voice: str | None = Form(None, description="指定すると回答をこのエンドポイント(voice, voice/v2 など)の音声で先行して合成し、audio_id を返す"),
+    audio_format: str | None = Form(None, alias="format", description="先行合成の出力形式(/voice* の format と同じ)"),
+    tts: TTSService = Depends(get_tts_service),
+    handles: AudioHandleStore = Depends(get_audio_handles),
+):
+    """GPT に問い合わせた回答結果を取得する
+
+    voice を指定した場合は回答の音声合成をバックグラウンドで始め、GET /voice/handle/{audio_id}(/stream)で取得できるようにする
+    """
+    if voice is not None and voice not in VOICE_SYNTHESIS:
+        raise HTTPException(status_code=400, detail=f"unsupported voice: {voice} (supported: {', '.join(VOICE_SYNTHESIS)})")
+    presynthesis_format = _audio_format_for(voice, audio_format) if voice is not None else None
+
+    res1, res2 = await _generate_reply(inputtext)
+    response = {"response_text": res1, "image_filename": res2}
+    if voice is not None and res1:
+        response.update(_start_presynthesis(tts, handles, voice, res1, presynthesis_format))
+
+    return ORJSONResponse(content=response)
+
+
+async def _generate_reply(inputtext: str) -> tuple[str, str]:
+    """(回答, スライドのファイル名)。テンプレート質問は事前生成済みの回答を返し、同じ質問の同時リクエストは1回の生成にまとめる"""
+    packed = template_pack.reply(inputtext)
+    record_cache("template_pack_reply", packed is not None)
+
+    with stage_timer(STAGE_REPLY):
+        if packed is not None:
+            # 事前生成済みの回答でも NG チェックと対話ログは通常の回答と同じく行う
+            res1, res2 = await generate_response(
+                text=inputtext,
+                log_filename_json=log_filename_json,
+                log_filename_csv=log_filename_csv,
+                doc_retrieval_type=DocumentRetrievalType.multi,
+                packed_reply=packed,
+            )
+        else:
+            res1, res2 = await reply_flight.do(
+                # generate_response のキーワードの判定は大文字・小文字などを区別するので、テキストは正規化せずにまとめる
+                (inputtext, DocumentRetrievalType.multi, True),
+                lambda: generate_response(
+                    text=inputtext,
+                    log_filename_json=log_filename_json,
+                    log_filename_csv=log_filename_csv,
+                    doc_retrieval_type=DocumentRetrievalType.multi,
+                    check_hal=True,
+                    deadline=Deadline.for_reply(),
+                ),
+            )
 
     if isinstance(res1, bytes):
         res1 = res1.decode("utf-8")
     if isinstance(res2, bytes):
         res2 = res2.decode("utf-8")
+    return res1, res2
 
-    response = {"response_text": res1, "image_filename": res2}
 
-    return ORJSONResponse(content=response)
+def _start_presynthesis(tts: TTSService, handles: AudioHandleStore, voice: str, text: str, audio_format: AudioFormat) -> dict:
+    """回答の先行合成を始め、レスポンスに足す audio_id と取得先を返す"""
+    reply_trace_id = current_trace_id()
+    handle = handles.start(voice, text, audio_format, lambda handle: _presynthesize(tts, handle, reply_trace_id))
+    return {"audio_id": handle.id, "audio_url": str(app.url_path_for("voice_handle", audio_id=handle.id))}
 
 
 # YouTube Live関連のエンドポイントは削除済み（使用しない方針のため）
 
 
 @app.api_route("/voice", methods=["POST"], response_class=Response)
-async def voice(request: Request):
+async def voice(request: Request, tts: TTSService = Depends(get_tts_service)):
     """テキストを音声に変換する"""
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
-
-    text_to_speech = TextToSpeech()
-
-    audio = await text_to_speech.text_to_speech_stream(text)
-
-    return Response(content=audio, media_type="audio/wav")
+    return await _voice_response(tts, "voice", text, _negotiate_audio_format(request, "voice"))
 
 
 @app.api_route("/voice/v2", methods=["POST"], response_class=Response)
-async def voice_v2(request: Request):
+async def voice_v2(request: Request, tts: TTSService = Depends(get_tts_service)):
     """テキストを音声に変換する"""
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
+    return await _voice_response(tts, "voice/v2", text, _negotiate_audio_format(request, "voice/v2"))
 
-    text_to_speech = TextToSpeech()
-
-    audio = await text_to_speech.text_to_speech_with_azure_tts(text)
 
-    return Response(content=audio, media_type="audio/wav")
+@app.api_route("/voice/azure", methods=["POST"], response_class=Response)
+async def voice_azure(request: Request, tts: TTSService = Depends(get_tts_service)):
+    """テキストを音声に変換する"""
+    # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
+    text = request.query_params["text"]
+    return await _voice_response(tts, "voice/azure", text, _negotiate_audio_format(request, "voice/azure"))
 
 
-@app.api_route("/voice/azure", methods=["POST"], response_class=Response)
-async def voice_azure(request: Request):
+@app.api_route("/voice/male", methods=["POST"], response_class=Response)
+async def voice_male(request: Request, tts: TTSService = Depends(get_tts_service)):
     """テキストを音声に変換する"""
     # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
     text = request.query_params["text"]
+    return await _voice_response(tts, "voice/male", text, _negotiate_audio_format(request, "voice/male"))
 
-    text_to_speech = TextToSpeech()
 
-    audio = await text_to_speech.azure_text_to_speech(text)
+@app.api_route("/voice/stream", methods=["POST"], response_class=StreamingResponse)
+async def voice_stream(request: Request, tts: TTSService = Depends(get_tts_service)):
+    """テキストを音声に変換し、合成しながら返す(/voice のストリーミング版)"""
+    text = request.query_params["text"]
+    return await _voice_stream_response(tts, "voice", text, _negotiate_audio_format(request, "voice", streaming=True))
 
-    return Response(content=audio, media_type="audio/wav")
 
+@app.api_route("/voice/v2/stream", methods=["POST"], response_class=StreamingResponse)
+async def voice_v2_stream(request: Request, tts: TTSService = Depends(get_tts_service)):
+    """テキストを音声に変換し、合成しながら返す(/voice/v2 のストリーミング版)"""
+    text = request.query_params["text"]
+    return await _voice_stream_response(tts, "voice/v2", text, _negotiate_audio_format(request, "voice/v2", streaming=True))
 
-@app.api_route("/voice/male", methods=["POST"], response_class=Response)
-async def voice_male(request: Request):
-    """テキストを音声に変換する"""
-    # NOTE: クエリパラメータから受け取るのが気持ち悪いが、unity側での修正が必要なので一旦既存実装を踏襲する
+
+@app.api_route("/voice/azure/stream", methods=["POST"], response_class=StreamingResponse)
+async def voice_azure_stream(request: Request, tts: TTSService = Depends(get_tts_service)):
+    """テキストを音声に変換し、文ごとに合成しながら返す(/voice/azure のストリーミング版)"""
+    text = request.query_params["text"]
+    return await _voice_stream_response(tts, "voice/azure", text, _negotiate_audio_format(request, "voice/azure", streaming=True))
+
+
+@app.api_route("/voice/male/stream", methods=["POST"], response_class=StreamingResponse)
+async def voice_male_stream(request: Request, tts: TTSService = Depends(get_tts_service)):
+    """テキストを音声に変換し、文ごとに合成しながら返す(/voice/male のストリーミング版)"""
     text = request.query_params["text"]
+    return await _voice_stream_response(tts, "voice/male", text, _negotiate_audio_format(request, "voice/male", streaming=True))
+
+
+@app.get("/voice/handle/{audio_id}", response_class=Response)
+async def voice_handle(handle: AudioHandle = Depends(_get_audio_handle), tts: TTSService = Depends(get_tts_service)):
+    """/reply で先行して合成した音声を取得する(合成中なら終わるまで待つ)"""
+    try:
+        return await _handle_audio(tts, handle)
+    except AudioHandleError as e:
+        raise HTTPException(status_code=502, detail=str(e)) from e
+
+
+@app.get("/voice/handle/{audio_id}/stream", response_class=StreamingResponse)
+async def voice_handle_stream(handle: AudioHandle = Depends(_get_audio_handle)):
+    """/reply で先行して合成した音声を、合成中なら届いた分から返す(WAV 以外は合成し終えてから返す)"""
+    try:
+        chunks = await _handle_stream(handle)
+    except AudioHandleError as e:
+        raise HTTPException(status_code=502, detail=str(e)) from e
+    return StreamingResponse(chunks, media_type=handle.audio_format.media_type)
+
+
+# WebSocket /session で1つのバイナリフレームに入れる音声の上限(クライアントのメッセージサイズの上限に掛からないよう、文ごとの音声なども分けて送る)
+SESSION_AUDIO_FRAME_BYTES = 64 * 1024
+
 
-    text_to_speech = TextToSpeech()
+@app.websocket("/session")
+async def session(websocket: WebSocket):
+    """Unity のアバターとの常時接続(1つの接続で質問を送り、回答のテキスト・スライド・音声・完了を届いた順に受け取る)
+
+    メッセージの型は src.schema.session を参照
+    """
+    await websocket.accept()
+    await _Session(websocket, websocket.app.state.tts).run()
 
-    audio = await text_to_speech.azure_text_to_speech(text, voice_name="ja-JP-KeitaNeural")
 
-    return Response(content=audio, media_type="audio/wav")
+class _Session:
+    """WebSocket /session の1接続
+
+    質問は接続ごとに SESSION_MAX_INFLIGHT 件まで並行して処理し、各質問の最後には done か error を1つだけ送る。
+    送信は1つのタスクが SendQueue(SESSION_SEND_BUFFER_BYTES)から順に行い、相手が読まずに溜まった分だけ回答の送信・音声の読み出しを待たせる
+    (音声の合成もパイプラインの先読みの分で止まる)。1メッセージを SESSION_SEND_TIMEOUT_SEC 秒で送れなければ切断する。
+    受信側から送るエラー・テンプレート・取り消しの応答は、cancel を受け取り続けられるよう送信バッファが空くのを待たない
+    (SESSION_CONTROL_BUFFER_BYTES を超えて溜まったら切断する)。
+    """
+
+    def __init__(self, websocket: WebSocket, tts: TTSService) -> None:
+        self._websocket = websocket
+        self._tts = tts
+        # 送信するフレームの組(audio の JSON とバイナリは間に他のメッセージが入らないよう1つにまとめる)
+        self._outbox: SendQueue[list[str | bytes]] = SendQueue(settings.SESSION_SEND_BUFFER_BYTES, headroom_bytes=settings.SESSION_CONTROL_BUFFER_BYTES)
+        self._questions: dict[str, asyncio.Task] = {}
+        self._slow_consumer = False
+
+    async def run(self) -> None:
+        record_session(opened=True)
+        receiver = asyncio.create_task(self._receive_loop())
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            # 切断されるか、送信が詰まって切断したら終わる
+            done, _ = await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            # 先にキューを閉じ、取り消した質問が送信待ちで止まらないようにする
+            await self._outbox.close()
+            tasks = [receiver, sender, *self._questions.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            record_session(opened=False)
+        if self._slow_consumer:
+            # 閉じないとクライアントが切るまで接続が残る(close フレームも送れなければサーバーが接続を打ち切る)
+            await self._websocket.close(code=1008, reason="slow consumer")
+
+    async def _receive_loop(self) -> None:
+        try:
+            await self._receive_requests()
+        except SendQueueFullError:
+            LOGGER.warning("WebSocket /session の応答が読まれずに溜まり続けているため切断します")
+            record_session_slow_disconnect()
+            self._slow_consumer = True
+
+    async def _receive_requests(self) -> None:
+        while True:
+            message = await self._websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("text") is None:
+                await self._send_control(ErrorMessage(id=None, status=400, detail="binary frames are not accepted"))
+                continue
+            try:
+                request = client_message_adapter.validate_json(message["text"])
+            except ValidationError as e:
+                await self._send_control(ErrorMessage(id=None, status=422, detail=str(e)))
+                continue
+            if isinstance(request, QuestionMessage):
+                await self._start_question(request)
+            elif isinstance(request, CancelMessage):
+                await self._cancel_question(request.id)
+            else:
+                choices = TEMPLATE_MESSAGES if request.kind == "message" else TEMPLATE_QUESTIONS
+                await self._send_control(TemplateMessage(id=request.id, kind=request.kind, text=random.choice(choices)))  # noqa: S311
+
+    async def _start_question(self, question: QuestionMessage) -> None:
+        if question.id in self._questions:
+            await self._send_control(ErrorMessage(id=question.id, status=409, detail=f"question {question.id} is already in progress"))
+            return
+        if len(self._questions) >= settings.SESSION_MAX_INFLIGHT:
+            await self._send_control(ErrorMessage(id=question.id, status=429, detail=f"too many questions in progress (max {settings.SESSION_MAX_INFLIGHT})"))
+            return
+        self._questions[question.id] = asyncio.create_task(self._answer(question))
+
+    async def _cancel_question(self, question_id: str) -> None:
+        """処理中の質問を取り消して done(cancelled)を送る(終わった質問なら何もしない)
+
+        タスクが動き始める前に取り消すと _answer は何も送れないので、done はここで送る
+        (送信待ちの put は取り消されるので、done がこの質問の最後のメッセージになる)
+        """
+        task = self._questions.pop(question_id, None)
+        if task is None:
+            return
+        task.cancel()
+        await self._send_control(DoneMessage(id=question_id, cancelled=True))
+
+    async def _answer(self, question: QuestionMessage) -> None:
+        """質問に答え、最後に done か error を送る(取り消された場合は _cancel_question が送る)"""
+        try:
+            with start_trace("WS /session question", voice=question.voice or ""):
+                await self._reply(question)
+        except HTTPException as e:
+            await self._send_last(ErrorMessage(id=question.id, status=e.status_code, detail=str(e.detail)))
+        except Exception as e:
+            LOGGER.exception(f"WebSocket /session の質問の処理に失敗: id={question.id}")
+            await self._send_last(ErrorMessage(id=question.id, status=500, detail=f"{type(e).__name__}: {e}"))
+        else:
+            await self._send_last(DoneMessage(id=question.id))
+        finally:
+            if self._questions.get(question.id) is asyncio.current_task():
+                del self._questions[question.id]
+
+    async def _reply(self, question: QuestionMessage) -> None:
+        audio_format = None
+        if question.voice is not None:
+            if question.voice not in VOICE_SYNTHESIS:
+                raise HTTPException(status_code=400, detail=f"unsupported voice: {question.voice} (supported: {', '.join(VOICE_SYNTHESIS)})")
+            audio_format = _audio_format_for(question.voice, question.format, streaming=True)
+
+        response_text, image_filename = await _generate_reply(question.text)
+        sentences = split_for_synthesis(response_text) or [response_text]
+        for index, sentence in enumerate(sentences):
+            await self._send(ReplyTextMessage(id=question.id, index=index, text=sentence))
+        if image_filename:
+            await self._send(SlideMessage(id=question.id, image_filename=image_filename))
+        if audio_format is None or not response_text:
+            return
+
+        text_to_speech = TextToSpeech(self._tts, audio_format, VOICE_POSTPROCESS[question.voice])
+        key = _voice_cache_key(text_to_speech, question.voice, response_text)
+        if (stored := await _stored_audio(question.voice, response_text, key, audio_format)) is not None:
+            chunks = _wav_chunks(stored.body)
+        else:
+            chunks = await _open_voice_chunks(text_to_speech, question.voice, response_text, key)
+        seq = 0
+        async for chunk in chunks:
+            for start in range(0, len(chunk), SESSION_AUDIO_FRAME_BYTES):
+                frame = chunk if len(chunk) <= SESSION_AUDIO_FRAME_BYTES else chunk[start : start + SESSION_AUDIO_FRAME_BYTES]
+                header = AudioMessage(id=question.id, seq=seq, size=len(frame), media_type=audio_format.media_type).model_dump_json()
+                await self._outbox.put([header, frame], len(header) + len(frame))
+                seq += 1
+
+    async def _send(self, message: BaseModel) -> None:
+        frame = message.model_dump_json()
+        await self._outbox.put([frame], len(frame))
+
+    async def _send_control(self, message: BaseModel) -> None:
+        """受信側からの応答を、送信バッファが空くのを待たずに送る(溜まりすぎていれば SendQueueFullError)"""
+        frame = message.model_dump_json()
+        await self._outbox.put([frame], len(frame), wait=False)
+
+    async def _send_last(self, message: BaseModel) -> None:
+        """質問の最後のメッセージを送る(接続を閉じている最中なら送らない)"""
+        try:
+            await self._send(message)
+        except SendQueueClosedError:
+            pass
+
+    async def _send_loop(self) -> None:
+        while True:
+            try:
+                frames = await self._outbox.get()
+            except SendQueueClosedError:
+                return
+            try:
+                async with asyncio.timeout(settings.SESSION_SEND_TIMEOUT_SEC):
+                    for frame in frames:
+                        if isinstance(frame, bytes):
+                            await self._websocket.send_bytes(frame)
+                        else:
+                            await self._websocket.send_text(frame)
+            except TimeoutError:
+                LOGGER.warning(f"WebSocket /session の送信が {settings.SESSION_SEND_TIMEOUT_SEC} 秒で終わらないため切断します")
+                record_session_slow_disconnect()
+                self._slow_consumer = True
+                return
+            except Exception as e:
+                # 送信中に切断された(例外の型はサーバーの実装による)
+                LOGGER.info(f"WebSocket /session の送信に失敗したため終了します: {type(e).__name__}: {e}")
+                return
 
 
 @app.get("/get_info")
@@ -137,6 +820,30 @@ async def get_information(
 
 
 
+@app.get("/single_flight/stats")
+async def single_flight_stats():
+    """single-flight の相乗り件数などのカウンタを取得する"""
+    return ORJSONResponse(content={"reply": reply_flight.stats(), "voice": voice_flight.stats()})
+
+
+@app.get("/ready")
+async def ready():
+    """ウォームアップが完了していれば 200、未完了なら 503 を返す(ロードバランサーのヘルスチェック用)
+
+    ウォームアップに失敗した音声合成プロバイダがあっても 200 を返し、本文の degraded に列挙する
+    """
+    status_code = 200 if warmup_state.ready else 503
+    return ORJSONResponse(content=warmup_state.as_dict(), status_code=status_code)
+
+
+@app.get("/metrics", response_class=Response)
+async def metrics():
+    """ステージごとのレイテンシ・キャッシュヒット・フォールバックを Prometheus 形式で取得する"""
+    content, content_type = render_metrics()
+    # media_type を使うと charset が二重に付くのでヘッダーをそのまま渡す
+    return Response(content=content, headers={"Content-Type": content_type})
+
+
 @app.post("/hallucination")
 async def hallucination(request: HallucinationRequest) -> HallucinationResponse:
     """ハルシネーション判定を実施"""
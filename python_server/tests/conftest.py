@@ -0,0 +1,6 @@
+import os
+
+# 設定の読み込みに必要な API キー(テストでは実サービスを呼ばない)
+for key in ("ELEVENLABS_API_KEY", "AZURE_SPEECH_KEY", "GOOGLE_API_KEY"):
+    os.environ.setdefault(key, "fake")
+os.environ.setdefault("TRACE_EXPORTER", "none")
@@ -0,0 +1,48 @@
+import asyncio
+import struct
+
+from src.audio_format import default_audio_format
+from src.audio_postprocess import LeadingSilenceTrimmer, PostProcess
+from src.azure_speech_synthesizer import wav_header
+from src.text_to_speech import TextToSpeech
+
+SAMPLE_RATE = 24000
+
+
+def _pcm(amplitude: int, ms: int) -> bytes:
+    return struct.pack(f"<{SAMPLE_RATE * ms // 1000}h", *([amplitude] * (SAMPLE_RATE * ms // 1000)))
+
+
+def test_trimmer_flushes_all_silent_pcm():
+    trimmer = LeadingSilenceTrimmer(SAMPLE_RATE, PostProcess(trim=True))
+    chunks = [_pcm(0, 250), _pcm(0, 333), _pcm(0, 7)]
+
+    assert [trimmer.feed(chunk) for chunk in chunks] == [b"", b"", b""]
+    assert trimmer.flush() == b"".join(chunks)
+
+
+def test_trimmer_flushes_nothing_after_voice_started():
+    trimmer = LeadingSilenceTrimmer(SAMPLE_RATE, PostProcess(trim=True))
+
+    assert trimmer.feed(_pcm(0, 500)) == b""
+    # 声の前の無音は padding_ms だけ残る
+    assert trimmer.feed(_pcm(0, 500) + _pcm(8000, 100)) == _pcm(0, 100) + _pcm(8000, 100)
+    assert trimmer.flush() == b""
+
+
+def test_relay_wav_sends_untrimmed_pcm_for_all_silent_stream():
+    text_to_speech = TextToSpeech(None, default_audio_format(), PostProcess(trim=True))
+    sample_rate = text_to_speech.audio_format.sample_rate
+    silence = [struct.pack(f"<{sample_rate // 10}h", *([0] * (sample_rate // 10))) for _ in range(5)]
+
+    async def stream():
+        for chunk in silence[1:]:
+            yield chunk
+
+    async def relay() -> list[bytes]:
+        return [chunk async for chunk in text_to_speech._relay_wav(silence[0], stream(), lambda *args, **kwargs: None)]
+
+    chunks = asyncio.run(relay())
+
+    assert chunks[0] == wav_header(sample_rate=sample_rate)
+    assert b"".join(chunks[1:]) == b"".join(silence)